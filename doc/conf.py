@@ -333,6 +333,8 @@ man_pages = [
         u'Creates a new qube', _man_pages_author, 1),
     ('manpages/qvm-device', 'qvm-device',
         u'List/set VM devices', _man_pages_author, 1),
+    ('manpages/qvm-device-autoattach', 'qvm-device-autoattach',
+        u'Automatically attach devices to qubes', _man_pages_author, 1),
     ('manpages/qvm-features', 'qvm-features',
         u'Manage VM features', _man_pages_author, 1),
     ('manpages/qvm-firewall', 'qvm-firewall',
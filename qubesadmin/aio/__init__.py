@@ -0,0 +1,148 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Marek Marczykowski-Górecki
+#                               <marmarek@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+'''Asyncio-based Admin API transport, require Python >=3.4 for asyncio.
+
+Objects defined here are regular Qubes() objects (all the synchronous API is
+still available), additionally providing :py:meth:`qubesd_call_async`
+coroutine. It does not block the event loop, so many calls can be in flight
+at the same time::
+
+    app = qubesadmin.aio.AsyncQubes()
+    loop = asyncio.get_event_loop()
+    lists = loop.run_until_complete(asyncio.gather(*[
+        app.qubesd_call_async(vm.name, 'admin.vm.volume.List')
+        for vm in app.domains]))
+'''
+
+import asyncio
+import os
+import subprocess
+
+import qubesadmin.app
+import qubesadmin.config
+import qubesadmin.exc
+
+
+class AsyncQubesLocal(qubesadmin.app.QubesLocal):
+    '''Application object communicating through local socket, with
+    asyncio support.
+
+    Used when running in dom0.
+    '''
+
+    @asyncio.coroutine
+    def qubesd_call_async(self, dest, method, arg=None, payload=None,
+            payload_stream=None):
+        '''
+        Execute Admin API method, without blocking event loop.
+
+        This is coroutine. See :py:meth:`qubesadmin.app.QubesLocal.qubesd_call`
+        for description of arguments and return value.
+
+        .. warning:: *payload_stream* will get closed by this function
+        '''
+        if payload and payload_stream:
+            raise ValueError(
+                'Only one of payload and payload_stream can be used')
+        if payload_stream:
+            # see QubesLocal.qubesd_call for the reason of not using the
+            # socket here
+            method_path = os.path.join(
+                qubesadmin.config.QREXEC_SERVICES_DIR, method)
+            if not os.path.exists(method_path):
+                raise qubesadmin.exc.QubesDaemonCommunicationError(
+                    '{} not found'.format(method_path))
+            qrexec_call_env = os.environ.copy()
+            qrexec_call_env['QREXEC_REMOTE_DOMAIN'] = 'dom0'
+            qrexec_call_env['QREXEC_REQUESTED_TARGET'] = dest
+            proc = yield from asyncio.create_subprocess_exec(
+                method_path, arg, stdin=payload_stream,
+                stdout=subprocess.PIPE, env=qrexec_call_env)
+            if hasattr(payload_stream, 'attach_process'):
+                payload_stream.attach_process(proc)
+            payload_stream.close()
+            (return_data, _) = yield from proc.communicate()
+            return self._parse_qubesd_response(return_data)
+
+        reader, writer = yield from asyncio.open_unix_connection(
+            qubesadmin.config.QUBESD_SOCKET)
+        try:
+            # src, method, dest, arg
+            for call_arg in ('dom0', method, dest, arg):
+                if call_arg is not None:
+                    writer.write(call_arg.encode('ascii'))
+                writer.write(b'\0')
+            if payload is not None:
+                writer.write(payload)
+            writer.write_eof()
+
+            return_data = yield from reader.read()
+        finally:
+            writer.close()
+        return self._parse_qubesd_response(return_data)
+
+
+class AsyncQubesRemote(qubesadmin.app.QubesRemote):
+    '''Application object communicating through qrexec services, with
+    asyncio support.
+
+    Used when running in VM.
+    '''
+
+    @asyncio.coroutine
+    def qubesd_call_async(self, dest, method, arg=None, payload=None,
+            payload_stream=None):
+        '''
+        Execute Admin API method, without blocking event loop.
+
+        This is coroutine. See
+        :py:meth:`qubesadmin.app.QubesRemote.qubesd_call` for description
+        of arguments and return value.
+
+        .. warning:: *payload_stream* will get closed by this function
+        '''
+        if payload and payload_stream:
+            raise ValueError(
+                'Only one of payload and payload_stream can be used')
+        service_name = method
+        if arg is not None:
+            service_name += '+' + arg
+        proc = yield from asyncio.create_subprocess_exec(
+            qubesadmin.config.QREXEC_CLIENT_VM, dest, service_name,
+            stdin=(payload_stream or subprocess.PIPE),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        if payload_stream is not None:
+            if hasattr(payload_stream, 'attach_process'):
+                payload_stream.attach_process(proc)
+            payload_stream.close()
+        (stdout, stderr) = yield from proc.communicate(payload)
+        if proc.returncode != 0:
+            raise qubesadmin.exc.QubesException('Service call error: %s',
+                stderr.decode())
+
+        return self._parse_qubesd_response(stdout)
+
+
+if os.path.exists(qubesadmin.config.QUBESD_SOCKET):
+    AsyncQubes = AsyncQubesLocal
+else:
+    AsyncQubes = AsyncQubesRemote
@@ -26,9 +26,17 @@ import os
 import shlex
 import socket
 import subprocess
+import sys
+import time
 
 import logging
 
+try:
+    import concurrent.futures
+except ImportError:
+    # Python 2 without futures backport - calls will be made sequentially
+    concurrent = None  # pylint: disable=invalid-name
+
 import qubesadmin.base
 import qubesadmin.exc
 import qubesadmin.label
@@ -37,8 +45,44 @@ import qubesadmin.utils
 import qubesadmin.vm
 import qubesadmin.config
 
+have_events = False
+if sys.version_info[0:2] >= (3, 5):
+    # qubesadmin.events requires Python >= 3.5 (see setup.py)
+    try:
+        # pylint: disable=wrong-import-position
+        import qubesadmin.events.utils
+        have_events = True
+    except (ImportError, AttributeError):
+        # not installed, or no asyncio.coroutine (Python >= 3.11)
+        pass
+
 BUF_SIZE = 4096
 VM_ENTRY_POINT = 'qubesadmin.vm'
+#: events after which info about volumes of the event subject is outdated
+VOLUME_EVENTS = (
+    'domain-start',
+    'domain-shutdown',
+    'domain-volume-import-begin',
+    'domain-volume-import-end',
+)
+
+#: events after which cached property values of the event subject may be
+#: outdated - values derived from the runtime state are not announced with
+#: property-* events
+RUNTIME_STATE_EVENTS = (
+    'domain-spawn',
+    'domain-start',
+    'domain-start-failed',
+    'domain-shutdown',
+)
+
+#: events (prefixes, followed by device class) after which cached devices
+#: info of the event subject is dropped
+DEVICE_EVENTS = (
+    'device-list-change:',
+    'device-attach:',
+    'device-detach:',
+)
 
 class VMCollection(object):
     '''Collection of VMs objects'''
@@ -46,29 +90,30 @@ class VMCollection(object):
         self.app = app
         self._vm_list = None
         self._vm_objects = {}
+        #: power state tracker: name -> (timestamp, state)
+        self._power_states = {}
+        #: VMs added since the list was fetched, not fetched yet
+        self._vm_added = set()
 
     def clear_cache(self):
         '''Clear cached list of VMs'''
         self._vm_list = None
+        self._vm_added.clear()
+        self._power_states.clear()
 
     def refresh_cache(self, force=False):
         '''Refresh cached list of VMs'''
         if not force and self._vm_list is not None:
+            self._fetch_added()
             return
         vm_list_data = self.app.qubesd_call(
             'dom0',
             'admin.vm.List'
         )
-        new_vm_list = {}
-        # FIXME: this will probably change
-        for vm_data in vm_list_data.splitlines():
-            vm_name, props = vm_data.decode('ascii').split(' ', 1)
-            vm_name = str(vm_name)
-            props = props.split(' ')
-            new_vm_list[vm_name] = dict(
-                [vm_prop.split('=', 1) for vm_prop in props])
-
-        self._vm_list = new_vm_list
+        self._vm_list = self._parse_vm_list(vm_list_data)
+        self._vm_added.clear()
+        self._power_states.clear()
+        self._update_power_states(self._vm_list)
         for name, vm in list(self._vm_objects.items()):
             if vm.name not in self._vm_list:
                 # VM no longer exists
@@ -82,6 +127,123 @@ class VMCollection(object):
                 self._vm_objects[vm.name] = vm
                 del self._vm_objects[name]
 
+    @staticmethod
+    def _parse_vm_list(vm_list_data):
+        '''Parse admin.vm.List output into dict of name -> properties'''
+        vm_list = {}
+        # FIXME: this will probably change
+        for vm_data in vm_list_data.splitlines():
+            vm_name, props = vm_data.decode('ascii').split(' ', 1)
+            vm_name = str(vm_name)
+            props = props.split(' ')
+            vm_list[vm_name] = dict(
+                [vm_prop.split('=', 1) for vm_prop in props])
+        return vm_list
+
+    def _update_power_states(self, vm_list):
+        '''Seed power state tracker with states from admin.vm.List output'''
+        # pylint: disable=protected-access
+        timestamp = qubesadmin.base._clock()
+        for vm_name, vm_data in vm_list.items():
+            if 'state' in vm_data:
+                self._power_states[vm_name] = (timestamp, vm_data['state'])
+
+    def get_cached_power_state(self, name):
+        '''Get VM power state from the tracker, without calling qubesd.
+
+        The tracker is used only when :py:attr:`QubesBase.cache_enabled` is
+        set. Without events connection keeping it up to date, the state is
+        considered valid for :py:attr:`QubesBase.cache_ttl` seconds.
+
+        :param str name: VM name
+        :return: power state, or None if not known (or outdated)
+        '''
+        # pylint: disable=protected-access
+        if not self.app.cache_enabled:
+            return None
+        try:
+            timestamp, state = self._power_states[name]
+        except KeyError:
+            return None
+        if not self.app._cache_coherent and \
+                qubesadmin.base._clock() - timestamp >= self.app.cache_ttl:
+            return None
+        return state
+
+    def set_cached_power_state(self, name, state):
+        '''Record VM power state in the tracker (for example on lifecycle
+        event)
+
+        :param str name: VM name
+        :param str state: power state, or None to forget it
+        '''
+        if state is None:
+            self._power_states.pop(name, None)
+        else:
+            # pylint: disable=protected-access
+            self._power_states[name] = (qubesadmin.base._clock(), state)
+
+    def cache_add(self, name):
+        '''Add a single VM to cached list of VMs (for example on
+        `domain-add` event), without fetching the whole list again.
+
+        This does not call qubesd (it may be called from an event handler);
+        the VM is fetched on the next access to the collection.
+        '''
+        if self._vm_list is None:
+            # nothing cached yet, whole list will be fetched when needed
+            return
+        self._vm_added.add(name)
+
+    def _fetch_added(self):
+        '''Fetch VMs recorded by :py:meth:`cache_add`'''
+        while self._vm_added:
+            name = self._vm_added.pop()
+            try:
+                vm_list_data = self.app.qubesd_call(name, 'admin.vm.List')
+            except qubesadmin.exc.QubesException:
+                # VM may be already gone
+                continue
+            new_vm_list = self._parse_vm_list(vm_list_data)
+            self._vm_list.update(new_vm_list)
+            self._update_power_states(new_vm_list)
+            for vm_name, vm_data in new_vm_list.items():
+                vm = self._vm_objects.get(vm_name)
+                if vm is not None and \
+                        vm.__class__.__name__ != vm_data['class']:
+                    # VM re-created with different class
+                    del self._vm_objects[vm_name]
+
+    def cache_remove(self, name):
+        '''Remove a single VM from cached list of VMs (for example on
+        `domain-delete` event)'''
+        if self._vm_list is not None:
+            self._vm_list.pop(name, None)
+        self._vm_added.discard(name)
+        self._vm_objects.pop(name, None)
+        self._power_states.pop(name, None)
+
+    def cache_rename(self, old_name, new_name):
+        '''Rename a single VM in cached list of VMs (for example on
+        `property-set:name` event)'''
+        if old_name in self._vm_added:
+            self._vm_added.discard(old_name)
+            self._vm_added.add(new_name)
+        elif self._vm_list is not None:
+            if old_name not in self._vm_list:
+                # out of sync, get the whole list
+                self.clear_cache()
+            else:
+                self._vm_list[new_name] = self._vm_list.pop(old_name)
+        if old_name in self._power_states:
+            self._power_states[new_name] = self._power_states.pop(old_name)
+        vm = self._vm_objects.pop(old_name, None)
+        if vm is not None:
+            # if renamed by other client, the object still uses old name
+            # pylint: disable=protected-access
+            vm._method_dest = new_name
+            self._vm_objects[new_name] = vm
+
     def __getitem__(self, item):
         if item not in self:
             raise KeyError(item)
@@ -97,7 +259,7 @@ class VMCollection(object):
 
     def __delitem__(self, key):
         self.app.qubesd_call(key, 'admin.vm.Remove')
-        self.clear_cache()
+        self.cache_remove(key)
 
     def __iter__(self):
         self.refresh_cache()
@@ -109,6 +271,10 @@ class VMCollection(object):
         self.refresh_cache()
         return self._vm_list.keys()
 
+    def cached_objects(self):
+        '''List VM objects already created, without calling qubesd'''
+        return list(self._vm_objects.values())
+
 
 class QubesBase(qubesadmin.base.PropertyHolder):
     '''Main Qubes application'''
@@ -123,9 +289,17 @@ class QubesBase(qubesadmin.base.PropertyHolder):
     qubesd_connection_type = None
     #: logger
     log = None
+    #: cache property values (opt-in); see also
+    #: :py:class:`qubesadmin.events.EventsDispatcher`
+    cache_enabled = False
+    #: maximum age (in seconds) of cached values, used when there is no
+    #: events connection keeping the cache up to date
+    cache_ttl = qubesadmin.config.CACHE_TTL
 
     def __init__(self):
         super(QubesBase, self).__init__(self, 'admin.property.', 'dom0')
+        #: cache is kept up to date by events (no need to expire entries)
+        self._cache_coherent = False
         self.domains = VMCollection(self)
         self.labels = qubesadmin.base.WrapperObjectsCollection(
             self, 'admin.label.List', qubesadmin.label.Label)
@@ -135,6 +309,44 @@ class QubesBase(qubesadmin.base.PropertyHolder):
         self._pool_drivers = None
         self.log = logging.getLogger('app')
 
+    def _invalidate_cache(self, subject, event, **kwargs):
+        '''Update cached data according to an event.
+
+        This is called by :py:class:`qubesadmin.events.EventsDispatcher`
+        (when created with `enable_cache=True`), before calling any event
+        handlers.
+
+        :param subject: VM object or None
+        :param str event: event name
+        '''
+        # pylint: disable=unused-argument,protected-access
+        if event == 'connection-established':
+            # some events may have been lost in the meantime
+            self.clear_cache()
+            for vm in self.domains.cached_objects():
+                vm.clear_cache()
+        elif event.startswith(('property-set:', 'property-del:',
+                'property-reset:')):
+            if subject is None:
+                subject = self
+            subject._properties_cache.pop(event.split(':', 1)[1], None)
+            # default values may depend on other objects' properties
+            self._invalidate_cached_defaults()
+            for vm in self.domains.cached_objects():
+                vm._invalidate_cached_defaults()
+        elif event in qubesadmin.vm.POWER_STATE_EVENTS and \
+                subject is not None:
+            self.domains.set_cached_power_state(subject.name,
+                qubesadmin.vm.POWER_STATE_EVENTS[event])
+        elif event.startswith(DEVICE_EVENTS) and subject is not None:
+            devclass = event.split(':', 1)[1]
+            if devclass in subject.devices:
+                subject.devices[devclass].clear_cache()
+        if event in RUNTIME_STATE_EVENTS and subject is not None:
+            subject._properties_cache.clear()
+        if event in VOLUME_EVENTS and subject is not None:
+            subject.clear_volumes_cache()
+
     def _refresh_pool_drivers(self):
         '''
         Refresh cached storage pool drivers and their parameters.
@@ -184,6 +396,431 @@ class QubesBase(qubesadmin.base.PropertyHolder):
         ''' Remove a storage pool '''
         self.qubesd_call('dom0', 'admin.pool.Remove', name, None)
 
+    def qubesd_call_many(self, calls, max_workers=None):
+        '''Execute multiple Admin API calls concurrently.
+
+        Each call is made with :py:meth:`qubesd_call`, using a pool of at
+        most *max_workers* threads, so the calls overlap instead of waiting
+        for each other round trip.
+
+        Example usage:
+
+        >>> app = qubesadmin.Qubes()
+        >>> calls = [(vm.name, 'admin.vm.volume.List', None, None)
+        >>>     for vm in app.domains]
+        >>> for vm, result in zip(app.domains, app.qubesd_call_many(calls)):
+        >>>     if isinstance(result, Exception):
+        >>>         print('{}: {!s}'.format(vm, result))
+
+        :param calls: iterable of (dest, method, arg, payload) tuples, \
+            where the last elements can be omitted, as in \
+            :py:meth:`qubesd_call`
+        :param int max_workers: maximum number of calls in flight, \
+            :py:data:`qubesadmin.config.QUBESD_MAX_CONCURRENT_CALLS` by default
+        :return: list of results, in the same order as *calls*; if a call \
+            failed, the exception raised by it is placed on the list instead
+        '''
+        calls = list(calls)
+        if max_workers is None:
+            max_workers = qubesadmin.config.QUBESD_MAX_CONCURRENT_CALLS
+
+        def do_call(call):
+            '''Make a single call, return exception instead of raising it'''
+            try:
+                return self.qubesd_call(*call)
+            except Exception as e:  # pylint: disable=broad-except
+                return e
+
+        if max_workers <= 1 or len(calls) <= 1 or concurrent is None:
+            return [do_call(call) for call in calls]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(max_workers, len(calls))) as executor:
+            return list(executor.map(do_call, calls))
+
+    def _fetch_volumes_info(self, volumes):
+        '''Fetch `Info` of many volumes concurrently.
+
+        :param list volumes: list of :py:class:`qubesadmin.storage.Volume`
+        :return: list of volumes for which info was fetched; volumes of VMs \
+            removed in the meantime are skipped
+        '''
+        # pylint: disable=protected-access
+        results = self.qubesd_call_many(
+            volume._call_args('Info') for volume in volumes)
+        fetched = []
+        for volume, result in zip(volumes, results):
+            if isinstance(result, qubesadmin.exc.QubesVMNotFoundError):
+                continue
+            if isinstance(result, Exception):
+                raise result
+            volume._set_info(result)
+            fetched.append(volume)
+        return fetched
+
+    def volume_inventory(self, domains=None, pools=None, internal=True,
+            unattached=False, revisions=False):
+        '''Get information about many volumes at once.
+
+        Lists of volumes and `Info` of each of them are fetched concurrently
+        (see :py:meth:`qubesd_call_many`), instead of one call at a time.
+        Volume objects of VMs are updated with the fetched info, so accessing
+        their properties later does not need another call (if caching is
+        enabled, see :py:attr:`cache_enabled`).
+
+        Example usage:
+
+        >>> by_pool = {}
+        >>> for entry in app.volume_inventory():
+        >>>     by_pool.setdefault(entry.pool, []).append(entry)
+
+        :param domains: VMs to list volumes of, all of them by default
+        :param pools: include only volumes from those pools (names or \
+            :py:class:`qubesadmin.storage.Pool` objects)
+        :param bool internal: include internal volumes
+        :param bool unattached: include also volumes of *pools* (of all the \
+            pools, if not given), which are not attached to any of listed VMs
+        :param bool revisions: fetch also list of revisions of each volume
+        :return: list of :py:class:`qubesadmin.storage.VolumeInventoryEntry`, \
+            sorted by pool, volume id, VM and volume name
+        '''
+        # pylint: disable=too-many-locals,protected-access
+        if domains is None:
+            domains = list(self.domains)
+        else:
+            domains = list(domains)
+        if pools is not None:
+            pools = set(str(pool) for pool in pools)
+
+        def pool_vid(volume):
+            '''Pool and vid of a volume, from already fetched info'''
+            return (volume._pool or str(volume._info['pool']),
+                volume._vid or str(volume._info['vid']))
+
+        calls = [(vm.name, 'admin.vm.volume.List') for vm in domains]
+        if unattached:
+            if pools is None:
+                pool_names = [pool.name for pool in self.pools]
+            else:
+                pool_names = sorted(pools)
+            calls.extend(('dom0', 'admin.pool.volume.List', pool)
+                for pool in pool_names)
+        results = self.qubesd_call_many(calls)
+
+        # Volume objects are not hashable, key them by identity
+        owners = {}
+        attached = []
+        for vm, result in zip(domains, results):
+            if isinstance(result, qubesadmin.exc.QubesVMNotFoundError):
+                # removed in the meantime
+                continue
+            if isinstance(result, Exception):
+                raise result
+            vm._set_volumes(result)
+            for name, volume in vm._volumes.items():
+                owners[id(volume)] = (vm, name)
+                attached.append(volume)
+        volumes = self._fetch_volumes_info(attached)
+
+        if unattached:
+            known = set(pool_vid(volume) for volume in volumes)
+            pool_volumes = []
+            for pool, result in zip(pool_names, results[len(domains):]):
+                if isinstance(result, Exception):
+                    raise result
+                for vid in result.decode('ascii').splitlines():
+                    if vid and (pool, vid) not in known:
+                        pool_volumes.append(
+                            qubesadmin.storage.Volume(self, pool, vid))
+            volumes.extend(self._fetch_volumes_info(pool_volumes))
+
+        if pools is not None:
+            volumes = [v for v in volumes if pool_vid(v)[0] in pools]
+        if not internal:
+            volumes = [v for v in volumes
+                if v._info.get('internal') != 'True']
+
+        revisions_lists = [None] * len(volumes)
+        if revisions:
+            revisions_lists = []
+            for result in self.qubesd_call_many(
+                    volume._call_args('ListSnapshots') for volume in volumes):
+                if isinstance(result, Exception):
+                    raise result
+                revisions_lists.append(result.decode('ascii').splitlines())
+
+        inventory = []
+        for volume, volume_revisions in zip(volumes, revisions_lists):
+            vm, name = owners.get(id(volume), (None, None))
+            pool, vid = pool_vid(volume)
+            inventory.append(qubesadmin.storage.VolumeInventoryEntry(
+                pool, vid, vm, name,
+                int(volume._info.get('size', 0)),
+                int(volume._info.get('usage', 0)),
+                volume, volume_revisions))
+        inventory.sort(key=lambda e: (e.pool, e.vid,
+            e.vm.name if e.vm else '', e.name or ''))
+        return inventory
+
+    def volumes_revisions(self, volumes, max_workers=None):
+        '''List revisions of many volumes concurrently.
+
+        :param list volumes: list of :py:class:`qubesadmin.storage.Volume`
+        :param int max_workers: maximum number of calls in flight, see \
+            :py:meth:`qubesd_call_many`
+        :return: list of revisions lists (oldest first), in the same order as \
+            *volumes*; if listing revisions of a volume failed, the exception \
+            is placed on the list instead
+        '''
+        # pylint: disable=protected-access
+        volumes = list(volumes)
+        results = self.qubesd_call_many(
+            (volume._call_args('ListSnapshots') for volume in volumes),
+            max_workers=max_workers)
+        return [result if isinstance(result, Exception)
+            else result.decode('ascii').splitlines()
+            for result in results]
+
+    def revert_volumes(self, targets, max_workers=None):
+        '''Revert many volumes concurrently.
+
+        Use :py:meth:`volumes_revisions` and
+        :py:func:`qubesadmin.storage.select_revision` to choose revisions.
+
+        Example usage:
+
+        >>> volumes = [vm.volumes['private'] for vm in vms]
+        >>> revisions = app.volumes_revisions(volumes)
+        >>> app.revert_volumes(
+        >>>     (volume, qubesadmin.storage.select_revision(revs))
+        >>>     for volume, revs in zip(volumes, revisions))
+
+        :param targets: iterable of (volume, revision) tuples
+        :param int max_workers: maximum number of calls in flight, see \
+            :py:meth:`qubesd_call_many`
+        :return: list of results, in the same order as *targets*: None if \
+            a volume was reverted, or the exception raised otherwise
+        '''
+        # pylint: disable=protected-access
+        targets = list(targets)
+        for _, revision in targets:
+            if not isinstance(revision, str):
+                raise TypeError('revision must be a str')
+        results = self.qubesd_call_many(
+            (volume._call_args('Revert', revision.encode('ascii'))
+                for volume, revision in targets),
+            max_workers=max_workers)
+        for volume, _ in targets:
+            volume.clear_cache()
+        return [result if isinstance(result, Exception) else None
+            for result in results]
+
+    def prune_revisions(self, volumes, keep, max_workers=None):
+        '''Limit number of revisions kept for many volumes concurrently.
+
+        This sets `revisions_to_keep` of each volume. Revisions above the
+        limit are removed by the storage driver, the next time the volume
+        is committed (usually at its VM shutdown).
+
+        :param list volumes: list of :py:class:`qubesadmin.storage.Volume`
+        :param int keep: number of most recent revisions to keep
+        :param int max_workers: maximum number of calls in flight, see \
+            :py:meth:`qubesd_call_many`
+        :return: list of results, in the same order as *volumes*: None if \
+            succeeded, or the exception raised otherwise
+        '''
+        # pylint: disable=protected-access
+        volumes = list(volumes)
+        if keep < 0:
+            raise ValueError('keep must not be negative')
+        results = self.qubesd_call_many(
+            (volume._call_args('Set.revisions_to_keep',
+                str(keep).encode('ascii')) for volume in volumes),
+            max_workers=max_workers)
+        for volume in volumes:
+            volume.clear_cache()
+        return [result if isinstance(result, Exception) else None
+            for result in results]
+
+    def device_index(self, devclass, domains=None):
+        '''Build index of device assignments of many domains.
+
+        Assignments of all the domains are listed concurrently (see
+        :py:meth:`qubesd_call_many`), with a single call per domain, instead
+        of asking each domain about each device separately.
+
+        Example usage:
+
+        >>> index = app.device_index('usb')
+        >>> for dev in backend.devices['usb'].available():
+        >>>     frontends = [a.frontend_domain
+        >>>         for a in index.get((dev.backend_domain.name, dev.ident),
+        >>>             [])]
+
+        :param str devclass: device class, like `pci` or `usb`
+        :param domains: domains to list assignments of, all of them by default
+        :return: dict mapping (backend domain name, device ident) to list of \
+            :py:class:`qubesadmin.devices.DeviceAssignment` of that device, \
+            with *frontend_domain* set; domains removed in the meantime are \
+            skipped
+        '''
+        # pylint: disable=protected-access
+        if domains is None:
+            domains = self.domains
+        domains = list(domains)
+        results = self.qubesd_call_many(
+            (domain.name, 'admin.vm.device.{}.List'.format(devclass))
+            for domain in domains)
+        index = {}
+        for domain, result in zip(domains, results):
+            if isinstance(result, qubesadmin.exc.QubesVMNotFoundError):
+                continue
+            if isinstance(result, Exception):
+                raise result
+            for assignment in domain.devices[devclass]._parse_assignments(
+                    result):
+                index.setdefault(
+                    (assignment.backend_domain.name, assignment.ident),
+                    []).append(assignment)
+        return index
+
+    def _devices_batch(self, assignments, detach, max_workers=None):
+        '''Attach or detach many devices concurrently, see
+        :py:meth:`attach_devices`'''
+        # pylint: disable=protected-access
+        calls = []
+        for assignment in assignments:
+            if assignment.frontend_domain is None or \
+                    assignment.devclass is None:
+                raise ValueError(
+                    'frontend_domain and devclass of {!r} must be set'.format(
+                        assignment))
+            collection = assignment.frontend_domain.devices[
+                assignment.devclass]
+            if detach:
+                calls.append(collection._detach_call_args(assignment))
+            else:
+                calls.append(collection._attach_call_args(assignment))
+        results = self.qubesd_call_many(calls, max_workers=max_workers)
+        for assignment in assignments:
+            assignment.frontend_domain.devices[
+                assignment.devclass]._assignments_cache = None
+        return [result if isinstance(result, Exception) else None
+            for result in results]
+
+    def _devices_batch_rollback(self, assignments, detach, rollback,
+            max_workers=None):
+        '''Attach or detach many devices, optionally reverting successful
+        operations if any has failed'''
+        assignments = list(assignments)
+        results = self._devices_batch(assignments, detach,
+            max_workers=max_workers)
+        if not rollback or all(result is None for result in results):
+            return results
+        done = [i for i, result in enumerate(results) if result is None]
+        rollback_results = self._devices_batch(
+            [assignments[i] for i in done], not detach,
+            max_workers=max_workers)
+        for i, rollback_result in zip(done, rollback_results):
+            if rollback_result is None:
+                rollback_result = qubesadmin.exc.DeviceOperationRolledBack(
+                    'Device {!r} {} {!s} reverted, because other operation '
+                    'failed'.format(assignments[i],
+                        'detach from' if detach else 'attach to',
+                        assignments[i].frontend_domain))
+            else:
+                self.log.error('Failed to revert device %r %s %s: %s',
+                    assignments[i], 'detach from' if detach else 'attach to',
+                    assignments[i].frontend_domain, rollback_result)
+            results[i] = rollback_result
+        return results
+
+    def attach_devices(self, assignments, rollback=False, max_workers=None):
+        '''Attach many devices, possibly to many domains, concurrently.
+
+        Example usage:
+
+        >>> assignments = [
+        >>>     qubesadmin.devices.DeviceAssignment(sys_usb, ident,
+        >>>         frontend_domain=work, devclass='usb')
+        >>>     for ident in ('2-1', '2-2', '2-3')]
+        >>> for assignment, result in zip(assignments,
+        >>>         app.attach_devices(assignments, rollback=True)):
+        >>>     if result is not None:
+        >>>         print('{!r}: {!s}'.format(assignment, result))
+
+        :param assignments: iterable of \
+            :py:class:`qubesadmin.devices.DeviceAssignment`, each with \
+            *frontend_domain* and *devclass* set
+        :param bool rollback: if attaching any of the devices fails, detach \
+            the ones attached successfully
+        :param int max_workers: maximum number of calls in flight, see \
+            :py:meth:`qubesd_call_many`
+        :return: list of results, in the same order as *assignments*: None \
+            if device was attached, or the exception raised otherwise; \
+            devices detached back because of *rollback* have \
+            :py:class:`qubesadmin.exc.DeviceOperationRolledBack` there
+        '''
+        return self._devices_batch_rollback(assignments, False, rollback,
+            max_workers=max_workers)
+
+    def detach_devices(self, assignments, rollback=False, max_workers=None):
+        '''Detach many devices, possibly from many domains, concurrently.
+
+        See :py:meth:`attach_devices` for details. When rolling back, devices
+        are attached again with the same options - use assignments obtained
+        from :py:meth:`qubesadmin.devices.DeviceCollection.assignments` to
+        preserve them.
+
+        :param assignments: iterable of \
+            :py:class:`qubesadmin.devices.DeviceAssignment`, each with \
+            *frontend_domain* and *devclass* set
+        :param bool rollback: if detaching any of the devices fails, attach \
+            again the ones detached successfully
+        :param int max_workers: maximum number of calls in flight, see \
+            :py:meth:`qubesd_call_many`
+        :return: list of results, in the same order as *assignments*, see \
+            :py:meth:`attach_devices`
+        '''
+        return self._devices_batch_rollback(assignments, True, rollback,
+            max_workers=max_workers)
+
+    def wait_for_states(self, states, timeout=None):
+        '''Wait for VMs to reach given power states.
+
+        All the VMs are watched using a single events connection (if
+        :py:mod:`qubesadmin.events` is available, otherwise their state is
+        polled once a second). This function does not initiate state change
+        itself.
+
+        Example usage:
+
+        >>> for vm in vms:
+        >>>     vm.shutdown()
+        >>> for vm in app.wait_for_states({vm: 'Halted' for vm in vms}, 60):
+        >>>     vm.kill()
+
+        :param dict states: VM object -> expected power state (as returned \
+            by :py:meth:`qubesadmin.vm.QubesVM.get_power_state`)
+        :param timeout: timeout in seconds, use None for no timeout; with \
+            0 the states are checked just once
+        :return: sorted list of VMs which did not reach expected state \
+            before timeout
+        '''
+        if have_events:
+            return qubesadmin.events.utils.wait_for_states(self, states,
+                timeout)
+
+        remaining = dict(states)
+        start = time.time()
+        while True:
+            remaining = dict((vm, state) for vm, state in remaining.items()
+                if vm.get_power_state() != state)
+            if not remaining or (timeout is not None and
+                    time.time() - start >= timeout):
+                break
+            time.sleep(1)
+        return sorted(remaining)
+
     def get_label(self, label):
         '''Get label as identified by index or name
 
@@ -348,7 +985,10 @@ class QubesLocal(QubesBase):
         :param method: Full API method name ('admin...')
         :param arg: Method argument (if any)
         :param payload: Payload send to the method
-        :param payload_stream: file-like object to read payload from
+        :param payload_stream: file-like object to read payload from; if \
+            it has `attach_process` method (see \
+            :py:class:`qubesadmin.storage.StreamFeeder`), it is called with \
+            the process reading the payload
         :return: Data returned by qubesd (string)
 
         .. warning:: *payload_stream* will get closed by this function
@@ -371,6 +1011,8 @@ class QubesLocal(QubesBase):
             qrexec_call_env['QREXEC_REQUESTED_TARGET'] = dest
             proc = subprocess.Popen([method_path, arg], stdin=payload_stream,
                 stdout=subprocess.PIPE, env=qrexec_call_env)
+            if hasattr(payload_stream, 'attach_process'):
+                payload_stream.attach_process(proc)
             payload_stream.close()
             (return_data, _) = proc.communicate()
             return self._parse_qubesd_response(return_data)
@@ -456,7 +1098,10 @@ class QubesRemote(QubesBase):
         :param method: Full API method name ('admin...')
         :param arg: Method argument (if any)
         :param payload: Payload send to the method
-        :param payload_stream: file-like object to read payload from
+        :param payload_stream: file-like object to read payload from; if \
+            it has `attach_process` method (see \
+            :py:class:`qubesadmin.storage.StreamFeeder`), it is called with \
+            the process reading the payload
         :return: Data returned by qubesd (string)
 
         .. warning:: *payload_stream* will get closed by this function
@@ -473,6 +1118,8 @@ class QubesRemote(QubesBase):
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
         if payload_stream is not None:
+            if hasattr(payload_stream, 'attach_process'):
+                payload_stream.attach_process(p)
             payload_stream.close()
         (stdout, stderr) = p.communicate(payload)
         if p.returncode != 0:
@@ -21,10 +21,15 @@
 '''Base classes for managed objects'''
 
 import ast
+import time
+
 import qubesadmin.exc
 
 DEFAULT = object()
 
+# monotonic clock, if available
+_clock = getattr(time, 'monotonic', time.time)
+
 
 class PropertyHolder(object):
     '''A base class for object having properties retrievable using mgmt API.
@@ -36,6 +41,9 @@ class PropertyHolder(object):
     #: a place for appropriate Qubes() object (QubesLocal or QubesRemote),
     # use None for self
     app = None
+    #: properties reflecting runtime state, for which no events are sent on
+    #: change - those are never cached
+    _volatile_properties = ()
 
     def __init__(self, app, method_prefix, method_dest):
         #: appropriate Qubes() object (QubesLocal or QubesRemote), use None
@@ -45,6 +53,10 @@ class PropertyHolder(object):
         self._method_dest = method_dest
         self._properties = None
         self._properties_help = None
+        #: cached property values - dict of name -> (timestamp, raw value)
+        self._properties_cache = {}
+        #: bulk ``GetAll`` call failed already, don't try it again
+        self._get_all_failed = False
 
     def qubesd_call(self, dest, method, arg=None, payload=None,
             payload_stream=None):
@@ -104,6 +116,55 @@ class PropertyHolder(object):
             raise qubesadmin.exc.QubesDaemonCommunicationError(
                 'Invalid response format')
 
+    def clear_cache(self):
+        '''Clear cached property values'''
+        self._properties_cache.clear()
+
+    def _invalidate_cached_property(self, name):
+        '''Drop cached value of a property, called when it has changed.
+
+        Values which are defaults may be computed from other properties,
+        so drop those too.
+        '''
+        self._properties_cache.pop(name, None)
+        self._invalidate_cached_defaults()
+
+    def _invalidate_cached_defaults(self):
+        '''Drop cached values of properties having default value'''
+        for name, (_, property_str) in list(self._properties_cache.items()):
+            if property_str.startswith(b'default=True '):
+                del self._properties_cache[name]
+
+    def _fetch_property(self, item):
+        '''Get raw property value, as returned by qubesd.
+
+        If caching is enabled (see
+        :py:attr:`qubesadmin.app.QubesBase.cache_enabled`), use cached value
+        if it is still valid.
+
+        :param str item: name of property
+        :return: bytes in format \
+            ``default={True|False} type=<type> <value>``
+        '''
+        if self.app.cache_enabled and item in self._properties_cache:
+            timestamp, property_str = self._properties_cache[item]
+            # pylint: disable=protected-access
+            if self.app._cache_coherent or \
+                    _clock() - timestamp < self.app.cache_ttl:
+                return property_str
+        property_str = self.qubesd_call(
+            self._method_dest,
+            self._method_prefix + 'Get',
+            item,
+            None)
+        self._cache_property(item, property_str)
+        return property_str
+
+    def _cache_property(self, item, property_str):
+        '''Store raw property value in cache, if caching is enabled'''
+        if self.app.cache_enabled and item not in self._volatile_properties:
+            self._properties_cache[item] = (_clock(), property_str)
+
     def property_list(self):
         '''
         List available properties (their names).
@@ -142,31 +203,120 @@ class PropertyHolder(object):
         '''
         if item.startswith('_'):
             raise AttributeError(item)
-        property_str = self.qubesd_call(
-            self._method_dest,
-            self._method_prefix + 'Get',
-            item,
-            None)
+        property_str = self._fetch_property(item)
         (default, _value) = property_str.split(b' ', 1)
+        return self._parse_is_default(default)
+
+    @staticmethod
+    def _parse_is_default(default):
+        '''Parse ``default=...`` part of property value, as returned by
+        qubesd.
+
+        :param bytes default: ``default={True|False}`` string
+        :return: bool
+        '''
         assert default.startswith(b'default=')
         is_default_str = default.split(b'=')[1]
         is_default = ast.literal_eval(is_default_str.decode('ascii'))
         assert isinstance(is_default, bool)
         return is_default
 
+    def properties_snapshot(self, properties=None):
+        '''
+        Get values of all the properties at once.
+
+        Use a single bulk call (``GetAll``) if qubesd supports it, otherwise
+        get properties concurrently (see \
+        :py:meth:`qubesadmin.app.QubesBase.qubesd_call_many`). Properties
+        without a value (or not accessible) are not included.
+
+        :param list properties: names of properties, as returned by \
+            :py:meth:`property_list` - used if bulk call is not supported; \
+            fetched when needed if not given
+        :return: dict of name -> (value, type, is_default), where value is \
+            the same as returned by attribute access and type is the name \
+            of the property type, as reported by qubesd
+        '''
+        properties_str = None
+        if not self._get_all_failed:
+            try:
+                properties_str = self.qubesd_call(
+                    self._method_dest,
+                    self._method_prefix + 'GetAll',
+                    None,
+                    None)
+            except qubesadmin.exc.QubesException:
+                # no bulk method (older qubesd), or access denied
+                self._get_all_failed = True
+        if properties_str is None:
+            property_strs = self._get_properties_concurrently(properties)
+        else:
+            property_strs = []
+            for line in properties_str.split(b'\n'):
+                if not line:
+                    continue
+                name, property_str = line.split(b' ', 1)
+                # value is escaped to fit in a single line
+                property_str = b'\\'.join(part.replace(b'\\n', b'\n')
+                    for part in property_str.split(b'\\\\'))
+                property_strs.append((name.decode('ascii'), property_str))
+
+        snapshot = {}
+        for name, property_str in property_strs:
+            self._cache_property(name, property_str)
+            (default, prop_type, value) = property_str.split(b' ', 2)
+            try:
+                value = self._parse_type_value(prop_type, value)
+            except AttributeError:
+                continue
+            prop_type = prop_type.decode('ascii').split('=', 1)[1]
+            snapshot[name] = (value, prop_type,
+                self._parse_is_default(default))
+        return snapshot
+
+    def _get_properties_concurrently(self, names=None):
+        '''Get raw values of all properties, using a separate call for each
+        of them.
+
+        :param list names: names of properties, all of them if not given
+        :return: list of (name, raw value) tuples
+        '''
+        if names is None:
+            names = self.property_list()
+        results = self.app.qubesd_call_many(
+            (self._method_dest, self._method_prefix + 'Get', name, None)
+            for name in names)
+        property_strs = []
+        for name, result in zip(names, results):
+            if isinstance(result, (AttributeError,
+                    qubesadmin.exc.QubesDaemonNoResponseError)):
+                # no value, or no access to it
+                continue
+            if isinstance(result, Exception):
+                raise result
+            property_strs.append((name, result))
+        return property_strs
+
     def __getattr__(self, item):
-        # pylint: disable=too-many-return-statements
         if item.startswith('_'):
             raise AttributeError(item)
         try:
-            property_str = self.qubesd_call(
-                self._method_dest,
-                self._method_prefix + 'Get',
-                item,
-                None)
+            property_str = self._fetch_property(item)
         except qubesadmin.exc.QubesDaemonNoResponseError:
             raise qubesadmin.exc.QubesPropertyAccessError(item)
         (_default, prop_type, value) = property_str.split(b' ', 2)
+        return self._parse_type_value(prop_type, value)
+
+    def _parse_type_value(self, prop_type, value):
+        '''Parse type and value parts of property value, as returned by
+        qubesd.
+
+        :param bytes prop_type: ``type=...`` string
+        :param bytes value: property value
+        :return: value converted to appropriate Python object
+        :raises AttributeError: when property have no value
+        '''
+        # pylint: disable=too-many-return-statements
         prop_type = prop_type.decode('ascii')
         if not prop_type.startswith('type='):
             raise qubesadmin.exc.QubesDaemonCommunicationError(
@@ -199,6 +349,7 @@ class PropertyHolder(object):
     def __setattr__(self, key, value):
         if key.startswith('_') or key in dir(self):
             return super(PropertyHolder, self).__setattr__(key, value)
+        self._invalidate_cached_property(key)
         if value is qubesadmin.DEFAULT:
             try:
                 self.qubesd_call(
@@ -225,6 +376,7 @@ class PropertyHolder(object):
     def __delattr__(self, name):
         if name.startswith('_') or name in dir(self):
             return super(PropertyHolder, self).__delattr__(name)
+        self._invalidate_cached_property(name)
         try:
             self.qubesd_call(
                 self._method_dest,
@@ -26,6 +26,17 @@ QREXEC_CLIENT = '/usr/lib/qubes/qrexec-client'
 QREXEC_CLIENT_VM = '/usr/bin/qrexec-client-vm'
 QUBESD_RECONNECT_DELAY = 1.0
 QREXEC_SERVICES_DIR = '/etc/qubes-rpc'
+#: default limit of concurrent calls made by
+#: :py:meth:`qubesadmin.app.QubesBase.qubesd_call_many`
+QUBESD_MAX_CONCURRENT_CALLS = 8
+#: default maximum age (in seconds) of cached values, when there is no events
+#: connection keeping them up to date
+CACHE_TTL = 5.0
+#: default maximum age (in seconds) of volume info snapshot, see
+#: :py:attr:`qubesadmin.storage.Volume.info_max_age`
+VOLUME_INFO_MAX_AGE = 1.0
+#: size of a single read/write when streaming volume data
+IMPORT_BUF_SIZE = 1024 * 1024
 
 defaults = {
     'template_label': 'black',
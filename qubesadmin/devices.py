@@ -31,6 +31,10 @@ Devices are identified by pair of (backend domain, `ident`), where `ident` is
 :py:class:`str`.
 '''
 
+import collections
+
+import qubesadmin.base
+
 class DeviceAssignment(object):  # pylint: disable=too-few-public-methods
     ''' Maps a device to a frontend_domain. '''
 
@@ -124,14 +128,33 @@ class DeviceCollection(object):
     def __init__(self, vm, class_):
         self._vm = vm
         self._class = class_
-        self._dev_cache = {}
-
-    def attach(self, device_assignment):
-        '''Attach (add) device to domain.
-
-        :param DeviceAssignment device_assignment: device object
+        #: table of available devices: ident -> DeviceInfo
+        self._dev_cache = collections.OrderedDict()
+        #: time when :py:attr:`_dev_cache` was filled, None if never
+        self._dev_cache_timestamp = None
+        #: cached assignments list: (timestamp, raw `List` call response)
+        self._assignments_cache = None
+
+    def _cache_valid(self, timestamp):
+        '''Check if data cached at *timestamp* can still be used.
+
+        Cache is used only when `cache_enabled` is set on the app object.
+        Without events connection keeping it up to date, cached data is
+        considered valid for `cache_ttl` seconds.
+        '''
+        # pylint: disable=protected-access
+        app = self._vm.app
+        if not app.cache_enabled or timestamp is None:
+            return False
+        return app._cache_coherent or \
+            qubesadmin.base._clock() - timestamp < app.cache_ttl
+
+    def _attach_call_args(self, device_assignment):
+        '''Build arguments for `Attach` call, see :py:meth:`attach`
+
+        :return: (dest, method, arg, payload) tuple, as accepted by \
+            :py:meth:`qubesadmin.app.QubesBase.qubesd_call_many`
         '''
-
         if not device_assignment.frontend_domain:
             device_assignment.frontend_domain = self._vm
         else:
@@ -147,17 +170,17 @@ class DeviceCollection(object):
             options['persistent'] = 'yes'
         options_str = ' '.join('{}={}'.format(opt,
             val) for opt, val in sorted(options.items()))
-        self._vm.qubesd_call(None,
+        return (self._vm.name,
             'admin.vm.device.{}.Attach'.format(self._class),
             '{!s}+{!s}'.format(device_assignment.backend_domain,
                 device_assignment.ident),
             options_str.encode('utf-8'))
 
-    def detach(self, device_assignment):
-        '''Detach (remove) device from domain.
+    def _detach_call_args(self, device_assignment):
+        '''Build arguments for `Detach` call, see :py:meth:`detach`
 
-        :param DeviceAssignment device_assignment: device to detach
-        (obtained from :py:meth:`assignments`)
+        :return: (dest, method, arg, payload) tuple, as accepted by \
+            :py:meth:`qubesadmin.app.QubesBase.qubesd_call_many`
         '''
         if not device_assignment.frontend_domain:
             device_assignment.frontend_domain = self._vm
@@ -169,10 +192,31 @@ class DeviceCollection(object):
         else:
             assert device_assignment.devclass == self._class
 
-        self._vm.qubesd_call(None,
+        return (self._vm.name,
             'admin.vm.device.{}.Detach'.format(self._class),
             '{!s}+{!s}'.format(device_assignment.backend_domain,
-                device_assignment.ident))
+                device_assignment.ident),
+            None)
+
+    def attach(self, device_assignment):
+        '''Attach (add) device to domain.
+
+        :param DeviceAssignment device_assignment: device object
+        '''
+
+        _, method, arg, payload = self._attach_call_args(device_assignment)
+        self._vm.qubesd_call(None, method, arg, payload)
+        self._assignments_cache = None
+
+    def detach(self, device_assignment):
+        '''Detach (remove) device from domain.
+
+        :param DeviceAssignment device_assignment: device to detach
+        (obtained from :py:meth:`assignments`)
+        '''
+        _, method, arg, _ = self._detach_call_args(device_assignment)
+        self._vm.qubesd_call(None, method, arg)
+        self._assignments_cache = None
 
     def assignments(self, persistent=None):
         '''List assignments for devices which are (or may be) attached to the
@@ -186,9 +230,23 @@ class DeviceCollection(object):
         attached persistently.
         '''
 
-        assignments_str = self._vm.qubesd_call(None,
-            'admin.vm.device.{}.List'.format(self._class)).decode()
-        for assignment_str in assignments_str.splitlines():
+        # pylint: disable=protected-access
+        if self._assignments_cache is not None and \
+                self._cache_valid(self._assignments_cache[0]):
+            assignments_str = self._assignments_cache[1]
+        else:
+            assignments_str = self._vm.qubesd_call(None,
+                'admin.vm.device.{}.List'.format(self._class))
+            self._assignments_cache = (qubesadmin.base._clock(),
+                assignments_str)
+        return self._parse_assignments(assignments_str, persistent)
+
+    def _parse_assignments(self, assignments_str, persistent=None):
+        '''Parse `admin.vm.device.<class>.List` call response.
+
+        See :py:meth:`assignments` for the description of *persistent*.
+        '''
+        for assignment_str in assignments_str.decode().splitlines():
             device, _, options_all = assignment_str.partition(' ')
             backend_domain, ident = device.split('+', 1)
             options = dict(opt_single.split('=', 1)
@@ -202,38 +260,72 @@ class DeviceCollection(object):
                 persistent=dev_persistent, frontend_domain=self._vm,
                 devclass=self._class)
 
+    def _assigned_devices(self, assignments):
+        '''Get devices of given assignments.
+
+        Devices are looked up in tables of devices available in their backend
+        domains, each refreshed (if needed) only once, so there is at most one
+        `Available` call per backend domain.
+        '''
+        # pylint: disable=protected-access
+        assignments = list(assignments)
+        backends = {}
+        for assignment in assignments:
+            backend = assignment.backend_domain
+            if backend.name not in backends:
+                backends[backend.name] = backend.devices[self._class]
+        for collection in backends.values():
+            if not collection._cache_valid(collection._dev_cache_timestamp):
+                collection._refresh_available()
+        for assignment in assignments:
+            backend = assignment.backend_domain
+            try:
+                yield backends[backend.name]._dev_cache[assignment.ident]
+            except KeyError:
+                yield UnknownDevice(backend, assignment.ident)
+
     def attached(self):
         '''List devices which are (or may be) attached to this vm '''
 
-        for assignment in self.assignments():
-            yield assignment.device
+        return self._assigned_devices(self.assignments())
 
     def persistent(self):
         ''' Devices persistently attached and safe to access before libvirt
             bootstrap.
         '''
 
-        for assignment in self.assignments(True):
-            yield assignment.device
+        return self._assigned_devices(self.assignments(True))
 
-    def available(self):
-        '''List devices exposed by this vm'''
+    def _refresh_available(self):
+        '''Fill table of available devices, with a single `Available` call'''
         devices_str = self._vm.qubesd_call(None,
             'admin.vm.device.{}.Available'.format(self._class)).decode()
+        dev_cache = collections.OrderedDict()
         for dev_str in devices_str.splitlines():
             ident, _, info = dev_str.partition(' ')
             # description is special that it can contain spaces
             info, _, description = info.partition('description=')
             info_dict = dict(info_single.split('=', 1)
                 for info_single in info.split(' ') if info_single)
-            yield DeviceInfo(self._vm, ident, description=description,
-                options=None, **info_dict)
+            dev_cache[ident] = DeviceInfo(self._vm, ident,
+                description=description, options=None, **info_dict)
+        self._dev_cache = dev_cache
+        # pylint: disable=protected-access
+        self._dev_cache_timestamp = qubesadmin.base._clock()
+
+    def available(self):
+        '''List devices exposed by this vm'''
+        if not self._cache_valid(self._dev_cache_timestamp):
+            self._refresh_available()
+        return iter(list(self._dev_cache.values()))
 
     __iter__ = available
 
     def clear_cache(self):
-        '''Clear cache of available devices'''
+        '''Clear cache of available devices and assignments'''
         self._dev_cache.clear()
+        self._dev_cache_timestamp = None
+        self._assignments_cache = None
 
     def __getitem__(self, item):
         '''Get device object with given ident.
@@ -249,10 +341,10 @@ class DeviceCollection(object):
         if item in self._dev_cache:
             return self._dev_cache[item]
         # then look for available devices
-        for dev in self.available():
-            if dev.ident == item:
-                self._dev_cache[item] = dev
-                return dev
+        if not self._cache_valid(self._dev_cache_timestamp):
+            self._refresh_available()
+            if item in self._dev_cache:
+                return self._dev_cache[item]
         # if still nothing, return UnknownDevice instance for the reason
         # explained in docstring, but don't cache it
         return UnknownDevice(self._vm, item)
@@ -272,3 +364,8 @@ class DeviceManager(dict):
     def __missing__(self, key):
         self[key] = DeviceCollection(self._vm, key)
         return self[key]
+
+    def clear_cache(self):
+        '''Clear cached devices info of all device classes'''
+        for collection in self.values():
+            collection.clear_cache()
@@ -30,14 +30,25 @@ import qubesadmin.exc
 class EventsDispatcher(object):
     ''' Events dispatcher, responsible for receiving events and calling
     appropriate handlers'''
-    def __init__(self, app):
-        '''Initialize EventsDispatcher'''
+    def __init__(self, app, enable_cache=False):
+        '''Initialize EventsDispatcher
+
+        :param app: Qubes() object
+        :param enable_cache: enable caching in *app* and keep the cache up to
+        date using received events (see \
+        :py:attr:`qubesadmin.app.QubesBase.cache_enabled`)
+        '''
         #: Qubes() object
         self.app = app
 
         #: event handlers - dict of event -> handlers
         self.handlers = {}
 
+        #: keep app cache up to date
+        self.enable_cache = enable_cache
+        if self.enable_cache:
+            self.app.cache_enabled = True
+
     def add_handler(self, event, handler):
         '''Register handler for event
 
@@ -143,6 +154,12 @@ class EventsDispatcher(object):
         '''
 
         reader, cleanup_func = yield from self._get_events_reader(vm)
+        if vm is None:
+            # some events may have been lost while not connected
+            self.app.domains.clear_cache()
+        if self.enable_cache and vm is None:
+            # pylint: disable=protected-access
+            self.app._cache_coherent = True
         try:
             some_event_received = False
             while not reader.at_eof():
@@ -170,20 +187,34 @@ class EventsDispatcher(object):
 
                 some_event_received = True
         finally:
+            if self.enable_cache and vm is None:
+                # events can't be received anymore, fallback to cache ttl
+                # pylint: disable=protected-access
+                self.app._cache_coherent = False
             cleanup_func()
         return some_event_received
 
     def handle(self, subject, event, **kwargs):
         '''Call handlers for given event'''
+        # update cached list of VMs on best-effort basis
         if subject:
-            if event in ['property-set:name']:
-                self.app.domains.clear_cache()
+            if event == 'property-set:name':
+                if 'oldvalue' in kwargs:
+                    self.app.domains.cache_rename(kwargs['oldvalue'], subject)
+                else:
+                    self.app.domains.clear_cache()
             subject = self.app.domains[subject]
         else:
-            # handle cache refreshing on best-effort basis
-            if event in ['domain-add', 'domain-delete']:
+            if event == 'domain-add' and 'vm' in kwargs:
+                self.app.domains.cache_add(kwargs['vm'])
+            elif event == 'domain-delete' and 'vm' in kwargs:
+                self.app.domains.cache_remove(kwargs['vm'])
+            elif event in ['domain-add', 'domain-delete']:
                 self.app.domains.clear_cache()
             subject = None
+        if self.enable_cache:
+            # pylint: disable=protected-access
+            self.app._invalidate_cache(subject, event, **kwargs)
         for handler in self.handlers.get(event, []):
             handler(subject, event, **kwargs)
         for handler in self.handlers.get('*', []):
@@ -25,6 +25,7 @@ import functools
 
 import qubesadmin.events
 import qubesadmin.exc
+import qubesadmin.vm
 
 
 
@@ -71,3 +72,61 @@ def wait_for_domain_shutdown(vm, timeout):
             'VM %s shutdown timeout expired', vm.name)
     except Interrupt:
         pass
+
+
+def wait_for_states(app, states, timeout=None):
+    ''' Helper function to wait for multiple VMs to reach given power
+    states, using a single events connection.
+
+    This function do not initiate state changes itself.
+
+    :param app: Qubes() object
+    :param dict states: VM object -> expected power state
+    :param timeout: Timeout in seconds, use None for no timeout; with 0 the
+        states are checked just once
+    :return: sorted list of VMs which did not reach expected state before
+        timeout
+    '''
+    remaining = dict(states)
+    if not remaining:
+        return []
+    if timeout is not None and timeout <= 0:
+        return sorted(vm for vm, state in remaining.items()
+            if vm.get_power_state() != state)
+
+    def check_states(subject, event, **kwargs):
+        '''Update remaining VMs list, interrupt when it is empty'''
+        # pylint: disable=unused-argument
+        if event == 'connection-established':
+            # VMs might have reached their state before connecting
+            vms = list(remaining)
+        elif subject in remaining:
+            vms = [subject]
+        else:
+            return
+        for vm in vms:
+            state = qubesadmin.vm.POWER_STATE_EVENTS.get(event)
+            if state is None:
+                state = vm.get_power_state()
+            if state == remaining[vm]:
+                del remaining[vm]
+        if not remaining:
+            raise Interrupt
+
+    events = qubesadmin.events.EventsDispatcher(app)
+    events.add_handler('connection-established', check_states)
+    for event in qubesadmin.vm.POWER_STATE_EVENTS:
+        events.add_handler(event, check_states)
+    loop = asyncio.get_event_loop()
+    events_task = asyncio.ensure_future(events.listen_for_events(),
+        loop=loop)
+    if timeout is not None:
+        # pylint: disable=no-member
+        loop.call_later(timeout, events_task.cancel)
+    try:
+        loop.run_until_complete(events_task)
+    except asyncio.CancelledError:
+        pass
+    except Interrupt:
+        pass
+    return sorted(remaining)
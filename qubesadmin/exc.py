@@ -130,6 +130,11 @@ class DeviceAlreadyAttached(QubesException, KeyError):
     pass
 
 
+class DeviceOperationRolledBack(QubesException):
+    '''Device was attached (or detached), but the operation was reverted,
+    because other operation of the same batch failed'''
+
+
 # pylint: disable=too-many-ancestors
 class QubesDaemonNoResponseError(QubesDaemonCommunicationError):
     '''Got empty response from qubesd'''
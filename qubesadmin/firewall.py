@@ -21,6 +21,8 @@
 
 '''Firewall configuration interface'''
 
+import binascii
+import bisect
 import datetime
 import socket
 
@@ -384,6 +386,247 @@ class Rule(object):
         return 'Rule(\'{}\')'.format(self.rule)
 
 
+#: Default DNS servers as seen by qubes, used for specialtarget=dns rules
+DNS_SERVERS = ('10.139.1.1', '10.139.1.2')
+
+#: Port interval matching any port, including queries without one
+_ANY_PORT = (-1, 65536)
+
+_FAMILIES = ((4, socket.AF_INET, 32), (6, socket.AF_INET6, 128))
+
+
+def _parse_address(address):
+    '''Convert IP address to (family, int) tuple, family being 4 or 6
+
+    :raises ValueError: if *address* is not an IPv4 or IPv6 address
+    '''
+    for family, addr_family, _ in _FAMILIES:
+        try:
+            packed = socket.inet_pton(addr_family, address)
+        except (socket.error, UnicodeError):
+            continue
+        return family, int(binascii.hexlify(packed), 16)
+    raise ValueError('Invalid IP address: ' + str(address))
+
+
+def _parse_network(network):
+    '''Convert 'address[/prefixlen]' to (family, first, last) integer range'''
+    address, _, prefixlen = network.partition('/')
+    family, value = _parse_address(address)
+    bits = 32 if family == 4 else 128
+    prefixlen = int(prefixlen) if prefixlen else bits
+    hostmask = (1 << (bits - prefixlen)) - 1
+    first = value & ~hostmask
+    return family, first, first | hostmask
+
+
+def _port_table(entries):
+    '''Build first-match table of sorted, disjoint port intervals.
+
+    :param entries: list of (rule index, first port, last port), in rule
+    order
+    :return: tuple (starts, ends, rule indexes), one element per interval
+    '''
+    points = sorted(set([first for _, first, _ in entries] +
+                        [last + 1 for _, _, last in entries]))
+    starts, ends, indexes = [], [], []
+    for start, stop in zip(points, points[1:]):
+        index = next((index for index, first, last in entries
+            if first <= start <= last), None)
+        if index is None:
+            continue
+        if indexes and indexes[-1] == index and ends[-1] == start - 1:
+            ends[-1] = stop - 1
+            continue
+        starts.append(start)
+        ends.append(stop - 1)
+        indexes.append(index)
+    return starts, ends, indexes
+
+
+class RuleMatcher(object):
+    '''Compiled firewall rule list, answering "which rule would match this
+    packet?" without touching live networking.
+
+    Destination networks are converted to integer ranges, which split the
+    address space of each family into segments covered by the same set of
+    rules. For each segment and protocol, ports are resolved into sorted,
+    disjoint intervals mapped to the first matching rule. A query is then
+    two binary searches, regardless of the number of rules.
+
+    Rules with a DNS name as a destination can be matched only if
+    *resolve* is given; otherwise they are listed in :py:attr:`unresolved`
+    and never match. Expired rules are ignored, as in qubesd.
+
+    :param list rules: list of :py:class:`Rule`
+    :param policy: action to report when no rule matches
+    :param resolve: function returning list of IP addresses of a host name
+    :param dns_servers: addresses matched by `specialtarget=dns` rules
+    '''
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, rules, policy=None, resolve=None,
+            dns_servers=DNS_SERVERS):
+        self.rules = list(rules)
+        self.policy = policy
+        #: rules with DNS name destination, that were not compiled
+        self.unresolved = []
+        self._dns_servers = [_parse_network(server)
+            for server in dns_servers]
+        #: family -> sorted list of segment starts
+        self._bounds = {}
+        #: family -> list of {proto: port table}, one per segment
+        self._tables = {}
+
+        entries = []
+        for index, rule in enumerate(self.rules):
+            if rule.expire is not None and rule.expire.expired:
+                continue
+            networks = self._rule_networks(rule, resolve)
+            if networks is None:
+                self.unresolved.append(rule)
+                continue
+            ports = self._rule_ports(rule)
+            if ports is None:
+                continue
+            for family, first, last in networks:
+                for proto in self._rule_protos(rule):
+                    entries.append((family, first, last, proto, index,
+                        ports))
+
+        for family, _, bits in _FAMILIES:
+            self._compile_family(family, bits,
+                [entry[1:] for entry in entries if entry[0] == family])
+
+    def _rule_networks(self, rule, resolve):
+        '''List of (family, first, last) matched by the rule, None if the
+        destination could not be resolved'''
+        if rule.dsthost is None:
+            networks = [(family, 0, (1 << bits) - 1)
+                for family, _, bits in _FAMILIES]
+        elif rule.dsthost.type == 'dsthost':
+            if resolve is None:
+                return None
+            networks = [_parse_network(address)
+                for address in resolve(str(rule.dsthost))]
+        else:
+            networks = [_parse_network(str(rule.dsthost))]
+        if rule.specialtarget == 'dns':
+            networks = [server for server in self._dns_servers
+                if any(server[0] == family and first <= server[1] <= last
+                    for family, first, last in networks)]
+        return networks
+
+    @staticmethod
+    def _rule_protos(rule):
+        '''Protocols matched by the rule, None standing for any other'''
+        if rule.proto is not None:
+            return (str(rule.proto),)
+        if rule.specialtarget == 'dns':
+            return ('tcp', 'udp')
+        return ('tcp', 'udp', 'icmp', None)
+
+    @staticmethod
+    def _rule_ports(rule):
+        '''Port (or ICMP type) interval matched by the rule, None if the
+        rule can't match anything'''
+        if rule.dstports is not None:
+            ports = tuple(rule.dstports.range)
+        elif rule.icmptype is not None:
+            ports = (int(str(rule.icmptype)),) * 2
+        else:
+            ports = _ANY_PORT
+        if rule.specialtarget == 'dns' and rule.proto != 'icmp':
+            if not ports[0] <= 53 <= ports[1]:
+                return None
+            ports = (53, 53)
+        return ports
+
+    def _compile_family(self, family, bits, entries):
+        '''Build segments and port tables for a single address family'''
+        bounds = sorted(set([0] + [last + 1 for _, last, _, _, _ in entries
+            if last + 1 < (1 << bits)] + [first for first, _, _, _, _ in
+            entries]))
+        tables = []
+        # segments covered by the same rules share the tables
+        shared = {}
+        for start in bounds:
+            covering = tuple(entry for entry in entries
+                if entry[0] <= start <= entry[1])
+            if covering not in shared:
+                by_proto = {}
+                for _, _, proto, index, ports in covering:
+                    by_proto.setdefault(proto, []).append(
+                        (index,) + ports)
+                shared[covering] = dict(
+                    (proto, _port_table(sorted(proto_entries)))
+                    for proto, proto_entries in by_proto.items())
+            tables.append(shared[covering])
+        self._bounds[family] = bounds
+        self._tables[family] = tables
+
+    def _segment(self, dst):
+        '''Find port tables of the segment containing *dst*'''
+        family, address = _parse_address(dst)
+        bounds = self._bounds[family]
+        return self._tables[family][bisect.bisect_right(bounds, address) - 1]
+
+    def _lookup(self, segment, proto, port):
+        '''Find the first matching rule in the segment tables'''
+        if proto not in ('tcp', 'udp', 'icmp'):
+            proto = None
+        try:
+            starts, ends, indexes = segment[proto]
+        except KeyError:
+            return None
+        if port is None:
+            port = _ANY_PORT[0]
+        num = bisect.bisect_right(starts, int(port)) - 1
+        if num < 0 or int(port) > ends[num]:
+            return None
+        return self.rules[indexes[num]]
+
+    def match(self, dst, proto=None, port=None):
+        '''Find the first rule matching a packet.
+
+        :param str dst: destination IPv4 or IPv6 address
+        :param str proto: protocol name ('tcp', 'udp', 'icmp', or any other)
+        :param int port: destination port for TCP/UDP, ICMP type for ICMP
+        :return: :py:class:`Rule`, or None if no rule matches
+        :raises ValueError: if *dst* is not an IP address
+        '''
+        return self._lookup(self._segment(dst), proto, port)
+
+    def match_many(self, queries):
+        '''Find the first matching rule for each of many packets.
+
+        Each destination address is parsed and located only once, so large
+        batches with repeating destinations are cheap.
+
+        :param queries: iterable of (dst, proto, port) tuples, as for
+        :py:meth:`match`
+        :return: list of :py:class:`Rule` (or None), in the order of
+        *queries*
+        '''
+        segments = {}
+        results = []
+        for dst, proto, port in queries:
+            try:
+                segment = segments[dst]
+            except KeyError:
+                segment = segments[dst] = self._segment(dst)
+            results.append(self._lookup(segment, proto, port))
+        return results
+
+    def action(self, dst, proto=None, port=None):
+        '''Action taken for a packet: the one of the first matching rule, or
+        :py:attr:`policy` if none matches'''
+        rule = self.match(dst, proto, port)
+        if rule is None:
+            return self.policy
+        return rule.action
+
+
 class Firewall(object):
     '''Firewal manager for a VM'''
     def __init__(self, vm):
@@ -440,6 +683,13 @@ class Firewall(object):
         self.vm.qubesd_call(None, 'admin.vm.firewall.SetPolicy', payload=str(
             value).encode('ascii'))
 
+    def compile(self, **kwargs):
+        '''Compile current rules and policy into a :py:class:`RuleMatcher`
+
+        :param kwargs: additional arguments for :py:class:`RuleMatcher`
+        '''
+        return RuleMatcher(self.rules, policy=self.policy, **kwargs)
+
     def reload(self):
         '''Force reload the same firewall rules.
 
@@ -20,9 +20,68 @@
 
 '''Storage subsystem.'''
 
+import collections
+import errno
+import hashlib
+import itertools
+import os
+import stat
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import qubesadmin.config
+import qubesadmin.exc
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+#: single row of :py:meth:`qubesadmin.app.QubesBase.volume_inventory` result;
+#: *vm* and *name* are None for a volume not attached to any (listed) VM,
+#: *size* and *usage* are in bytes, as of the time of the inventory,
+#: *revisions* is None if not requested
+VolumeInventoryEntry = collections.namedtuple('VolumeInventoryEntry',
+    ['pool', 'vid', 'vm', 'name', 'size', 'usage', 'volume', 'revisions'])
+
 
 class Volume(object):
-    '''Storage volume.'''
+    '''Storage volume.
+
+    Volume properties are retrieved with a single `Info` call. By default
+    it is made on every property access. When caching is enabled (see
+    :py:attr:`qubesadmin.app.QubesBase.cache_enabled`), the result is kept
+    as a snapshot - valid for :py:attr:`qubesadmin.app.QubesBase.cache_ttl`
+    seconds, or until invalidated by events. Values which change over time
+    (:py:attr:`size`, :py:attr:`usage`) are re-fetched when the snapshot is
+    older than :py:attr:`info_max_age`. Use :py:meth:`refresh` to get a fresh
+    snapshot explicitly.
+    '''
+    #: maximum age (in seconds) of volume info snapshot (if caching is
+    #: enabled), used for :py:attr:`size` and :py:attr:`usage`; 0 means
+    #: always re-fetch
+    info_max_age = qubesadmin.config.VOLUME_INFO_MAX_AGE
+
     def __init__(self, app, pool=None, vid=None, vm=None, vm_name=None):
         '''Construct a Volume object.
 
@@ -47,24 +106,21 @@ class Volume(object):
         self._vm = vm
         self._vm_name = vm_name
         self._info = None
+        self._info_timestamp = None
 
-    def _qubesd_call(self, func_name, payload=None, payload_stream=None):
-        '''Make a call to qubesd regarding this volume
+    def _call_args(self, func_name, payload=None):
+        '''Build arguments for a call to qubesd regarding this volume
 
         :param str func_name: API function name, like `Info` or `Resize`
         :param bytes payload: Payload to send.
-        :param file payload_stream: Stream to pipe payload from. Only one of
-        `payload` and `payload_stream` can be used.
+        :return: (dest, method, arg, payload) tuple, as accepted by \
+            :py:meth:`qubesadmin.app.QubesBase.qubesd_call_many`
         '''
         if self._vm is not None:
             method = 'admin.vm.volume.' + func_name
             dest = self._vm
             arg = self._vm_name
         else:
-            if payload_stream:
-                raise NotImplementedError(
-                    'payload_stream not implemented for '
-                    'admin.pool.volume.* calls')
             method = 'admin.pool.volume.' + func_name
             dest = 'dom0'
             arg = self._pool
@@ -72,21 +128,59 @@ class Volume(object):
                 payload = self._vid.encode('ascii') + b' ' + payload
             else:
                 payload = self._vid.encode('ascii')
+        return dest, method, arg, payload
+
+    def _qubesd_call(self, func_name, payload=None, payload_stream=None):
+        '''Make a call to qubesd regarding this volume
+
+        :param str func_name: API function name, like `Info` or `Resize`
+        :param bytes payload: Payload to send.
+        :param file payload_stream: Stream to pipe payload from. Only one of
+        `payload` and `payload_stream` can be used.
+        '''
+        if self._vm is None and payload_stream:
+            raise NotImplementedError(
+                'payload_stream not implemented for '
+                'admin.pool.volume.* calls')
+        dest, method, arg, payload = self._call_args(func_name, payload)
         return self.app.qubesd_call(dest, method, arg, payload=payload,
             payload_stream=payload_stream)
 
-    def _fetch_info(self, force=True):
+    def _fetch_info(self, force=True, max_age=None):
         '''Fetch volume properties
 
         Populate self._info dict
 
         :param bool force: refresh self._info, even if already populated.
+        :param max_age: refresh self._info if it is older than given number \
+            of seconds; if None, use app's `cache_ttl`, unless the cache is \
+            kept up to date by events
         '''
-        if not force and self._info is not None:
-            return
+        if not force and self._info is not None and self.app.cache_enabled:
+            if max_age is None:
+                # pylint: disable=protected-access
+                if self.app._cache_coherent:
+                    return
+                max_age = self.app.cache_ttl
+            if _clock() - self._info_timestamp < max_age:
+                return
         info = self._qubesd_call('Info')
+        self._set_info(info)
+
+    def _set_info(self, info):
+        '''Set volume info snapshot from raw `Info` call response'''
         info = info.decode('ascii')
         self._info = dict([line.split('=', 1) for line in info.splitlines()])
+        self._info_timestamp = _clock()
+
+    def refresh(self):
+        '''Fetch a fresh volume info snapshot now'''
+        self._fetch_info(force=True)
+
+    def clear_cache(self):
+        '''Drop volume info snapshot, it will be fetched again when needed'''
+        self._info = None
+        self._info_timestamp = None
 
     def __eq__(self, other):
         if isinstance(other, Volume):
@@ -98,7 +192,7 @@ class Volume(object):
         '''Storage volume pool name.'''
         if self._pool is not None:
             return self._pool
-        self._fetch_info()
+        self._fetch_info(force=False)
         return str(self._info['pool'])
 
     @property
@@ -106,37 +200,37 @@ class Volume(object):
         '''Storage volume id, unique within given pool.'''
         if self._vid is not None:
             return self._vid
-        self._fetch_info()
+        self._fetch_info(force=False)
         return str(self._info['vid'])
 
     @property
     def size(self):
         '''Size of volume, in bytes.'''
-        self._fetch_info(True)
+        self._fetch_info(force=False, max_age=self.info_max_age)
         return int(self._info['size'])
 
     @property
     def usage(self):
         '''Used volume space, in bytes.'''
-        self._fetch_info(True)
+        self._fetch_info(force=False, max_age=self.info_max_age)
         return int(self._info['usage'])
 
     @property
     def rw(self):
         '''True if volume is read-write.'''
-        self._fetch_info()
+        self._fetch_info(force=False)
         return self._info['rw'] == 'True'
 
     @property
     def snap_on_start(self):
         '''Create a snapshot from source on VM start.'''
-        self._fetch_info()
+        self._fetch_info(force=False)
         return self._info['snap_on_start'] == 'True'
 
     @property
     def save_on_stop(self):
         '''Commit changes to original volume on VM stop.'''
-        self._fetch_info()
+        self._fetch_info(force=False)
         return self._info['save_on_stop'] == 'True'
 
     @property
@@ -145,7 +239,7 @@ class Volume(object):
 
         If None, this volume itself will be used.
         '''
-        self._fetch_info()
+        self._fetch_info(force=False)
         if self._info['source']:
             return self._info['source']
         return None
@@ -153,15 +247,22 @@ class Volume(object):
     @property
     def internal(self):
         '''If `True` volume is hidden when qvm-block is used'''
-        self._fetch_info()
+        self._fetch_info(force=False)
         return self._info['internal'] == 'True'
 
     @property
     def revisions_to_keep(self):
         '''Number of revisions to keep around'''
-        self._fetch_info()
+        self._fetch_info(force=False)
         return int(self._info['revisions_to_keep'])
 
+    @revisions_to_keep.setter
+    def revisions_to_keep(self, value):
+        '''Set number of revisions to keep around'''
+        self._qubesd_call('Set.revisions_to_keep',
+            str(int(value)).encode('ascii'))
+        self.clear_cache()
+
     def resize(self, size):
         '''Resize volume.
 
@@ -170,6 +271,7 @@ class Volume(object):
         :param int size: new size in bytes.
         '''
         self._qubesd_call('Resize', str(size).encode('ascii'))
+        self.clear_cache()
 
     @property
     def revisions(self):
@@ -185,15 +287,98 @@ class Volume(object):
         if not isinstance(revision, str):
             raise TypeError('revision must be a str')
         self._qubesd_call('Revert', revision.encode('ascii'))
+        self.clear_cache()
 
-    def import_data(self, stream):
+    def import_data(self, stream, sparse=False, digests=None, expected=None,
+            compression=None, progress=None, size=None):
+        # pylint: disable=too-many-arguments,too-many-branches
         ''' Import volume data from a given file-like object.
 
         This function override existing volume content
 
-        :param stream: file-like object, must support fileno()
+        Digests of the data can be calculated while it is streamed, in a
+        separate thread. If digest of imported data does not match the
+        *expected* one, :py:class:`qubesadmin.exc.QubesException` is raised
+        after the import - volume content should be considered invalid then.
+
+        :param stream: file-like object, must support fileno(); or an \
+            iterable of bytes chunks
+        :param bool sparse: *stream* is a regular (possibly sparse) file; \
+            if the data needs to go through this process (to calculate \
+            digests, report progress or decompress it), read only its data \
+            extents from disk and send holes as zeros, without reading them; \
+            otherwise the file is given to the service directly anyway
+        :param digests: names of hash algorithms (as accepted by \
+            :py:func:`hashlib.new`) to calculate over imported data
+        :param dict expected: expected digests (hexadecimal strings) of \
+            imported data, keyed by hash algorithm name
+        :param str compression: decompress the data before importing: \
+            'xz', 'gzip', 'zstd' or 'auto' to detect the format from magic \
+            bytes (uncompressed data is imported as is then); see \
+            :py:func:`decompressed_chunks`
+        :param progress: function called with :py:class:`ImportProgress` \
+            object periodically during the import, and once at the end; \
+            it is called from a separate thread
+        :param int size: total size of imported data, used to estimate \
+            the remaining time; size of *stream* file is used if not given \
+            (and the data is not compressed)
+        :return: dict of algorithm name -> hexadecimal digest, for each \
+            algorithm given in *digests* or *expected*
         '''
-        self._qubesd_call('Import', payload_stream=stream)
+        chunks = None
+        if not hasattr(stream, 'read'):
+            chunks = iter(stream)
+        elif sparse and (compression or digests or expected or
+                progress is not None):
+            extents = data_extents(stream.fileno())
+            if extents != [(0, os.fstat(stream.fileno()).st_size)]:
+                chunks = sparse_file_chunks(stream, extents)
+
+        if compression:
+            if chunks is None:
+                chunks = file_chunks(stream)
+            chunks = decompressed_chunks(chunks, compression)
+
+        hasher = None
+        if digests or expected:
+            hasher = StreamHasher(set(digests or ()) | set(expected or ()))
+            if chunks is None:
+                chunks = file_chunks(stream)
+            chunks = hasher.wrap(chunks)
+
+        import_progress = None
+        if progress is not None:
+            if size is None and not compression and hasattr(stream, 'fileno'):
+                stream_stat = os.fstat(stream.fileno())
+                if stat.S_ISREG(stream_stat.st_mode):
+                    size = stream_stat.st_size
+            import_progress = ImportProgress(progress, size)
+            if chunks is None:
+                chunks = file_chunks(stream)
+
+        feeder = None
+        if chunks is not None:
+            feeder = StreamFeeder(chunks, progress=import_progress)
+        try:
+            self._qubesd_call('Import', payload_stream=(
+                feeder if feeder is not None else stream))
+        finally:
+            if feeder is not None:
+                feeder.close()
+                feeder.wait()
+                if hasattr(stream, 'close'):
+                    stream.close()
+            self.clear_cache()
+
+        if hasher is None:
+            return {}
+        result = hasher.hexdigests()
+        for algorithm, digest in sorted((expected or {}).items()):
+            if result[algorithm] != digest.lower():
+                raise qubesadmin.exc.QubesException(
+                    'Imported data {} digest mismatch: expected {}, got {}'
+                    .format(algorithm, digest, result[algorithm]))
+        return result
 
 
 class Pool(object):
@@ -231,13 +416,17 @@ class Pool(object):
         if self._config is None:
             pool_info_data = self.app.qubesd_call(
                 'dom0', 'admin.pool.Info', self.name, None)
-            pool_info_data = pool_info_data.decode('utf-8')
-            assert pool_info_data.endswith('\n')
-            pool_info_data = pool_info_data[:-1]
-            self._config = dict(
-                l.split('=', 1) for l in pool_info_data.splitlines())
+            self._set_config(pool_info_data)
         return self._config
 
+    def _set_config(self, pool_info_data):
+        '''Set pool config from raw `admin.pool.Info` call response'''
+        pool_info_data = pool_info_data.decode('utf-8')
+        assert pool_info_data.endswith('\n')
+        pool_info_data = pool_info_data[:-1]
+        self._config = dict(
+            l.split('=', 1) for l in pool_info_data.splitlines())
+
     @property
     def driver(self):
         ''' Storage pool driver '''
@@ -252,3 +441,671 @@ class Pool(object):
         volumes_data = volumes_data[:-1].decode('ascii')
         for vid in volumes_data.splitlines():
             yield Volume(self.app, self.name, vid)
+
+
+def revision_timestamp(revision):
+    '''Extract creation time from a revision identifier.
+
+    Drivers supporting multiple revisions (like `lvm_thin`) name them after
+    the (unix) time they were created, for example `1521065904-back`.
+
+    :param str revision: revision identifier
+    :return: creation time as int, or None if not known
+    '''
+    timestamp = revision.split('-', 1)[0]
+    if not timestamp.isdigit():
+        return None
+    return int(timestamp)
+
+
+def select_revision(revisions, nth=1, min_age=None, now=None):
+    '''Select a revision to revert to, according to a policy.
+
+    :param list revisions: revision identifiers, oldest first - as returned \
+        by :py:attr:`Volume.revisions`
+    :param int nth: select *nth* most recent matching revision (1 - the \
+        most recent one)
+    :param int min_age: consider only revisions at least *min_age* seconds \
+        old; revisions with unknown creation time are skipped then
+    :param int now: current time, for *min_age*; :py:func:`time.time` by \
+        default
+    :return: revision identifier, or None if there is no matching one
+    '''
+    if nth < 1:
+        raise ValueError('nth must be positive')
+    if min_age is not None:
+        if now is None:
+            now = time.time()
+        revisions = [revision for revision in revisions
+            if revision_timestamp(revision) is not None and
+            revision_timestamp(revision) <= now - min_age]
+    if len(revisions) < nth:
+        return None
+    return revisions[-nth]
+
+
+def data_extents(fd):
+    '''List data extents of a file, using `SEEK_DATA`/`SEEK_HOLE`.
+
+    If the system or the filesystem does not support finding holes, the
+    whole file is reported as a single extent.
+
+    :param int fd: file descriptor of a regular file
+    :return: list of (offset, length) tuples
+    '''
+    size = os.fstat(fd).st_size
+    # an empty file has no extents at all
+    whole_file = [(0, size)] if size else []
+    seek_data = getattr(os, 'SEEK_DATA', None)
+    seek_hole = getattr(os, 'SEEK_HOLE', None)
+    if seek_data is None or seek_hole is None:
+        return whole_file
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, seek_data)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # no more data, only a hole up to the end
+                    break
+                raise
+            end = min(os.lseek(fd, start, seek_hole), size)
+            extents.append((start, end - start))
+            offset = end
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        # not supported by the filesystem
+        extents = whole_file
+    os.lseek(fd, 0, os.SEEK_SET)
+    return extents
+
+
+def sparse_file_chunks(fileobj, extents=None,
+        bufsize=qubesadmin.config.IMPORT_BUF_SIZE):
+    '''Read a (sparse) file in chunks, without reading holes from disk.
+
+    Holes are generated as zero-filled chunks.
+
+    :param fileobj: file object of a regular file
+    :param list extents: data extents, as returned by \
+        :py:func:`data_extents`; found automatically if not given
+    :param int bufsize: maximum size of a single chunk
+    :return: iterator of bytes
+    '''
+    fd = fileobj.fileno()
+    size = os.fstat(fd).st_size
+    if extents is None:
+        extents = data_extents(fd)
+    zeros = b'\0' * bufsize
+    offset = 0
+    for start, length in extents + [(size, 0)]:
+        while offset < start:
+            hole = min(start - offset, bufsize)
+            yield zeros[:hole]
+            offset += hole
+        os.lseek(fd, start, os.SEEK_SET)
+        while offset < start + length:
+            data = os.read(fd, min(start + length - offset, bufsize))
+            if not data:
+                raise IOError(errno.EIO,
+                    'file truncated while reading: {}'.format(fileobj.name))
+            yield data
+            offset += len(data)
+
+
+def file_chunks(fileobj, bufsize=qubesadmin.config.IMPORT_BUF_SIZE):
+    '''Read a file in chunks
+
+    :param fileobj: file object
+    :param int bufsize: maximum size of a single chunk
+    :return: iterator of bytes
+    '''
+    while True:
+        data = fileobj.read(bufsize)
+        if not data:
+            break
+        yield data
+
+
+class ChunksReader(object):
+    '''Read-only file-like object, reading data from an iterable of bytes
+    chunks'''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        '''Read up to *size* bytes (till the end of data if negative)'''
+        data = [self._buffer]
+        available = len(self._buffer)
+        while size < 0 or available < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            data.append(chunk)
+            available += len(chunk)
+        data = b''.join(data)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        '''Stop reading, let the producer clean up'''
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+
+
+def threaded_chunks(chunks, queue_size=4):
+    '''Produce chunks in a separate thread, running ahead of the consumer.
+
+    This allows the producer (reading from disk, decompressing) to run
+    concurrently with the consumer (of the returned iterator).
+
+    :param chunks: iterable of bytes
+    :param int queue_size: maximum number of chunks produced in advance
+    :return: iterator of bytes
+    '''
+    chunks_queue = queue.Queue(queue_size)
+    stop = threading.Event()
+    # list, to be modified from the thread
+    error = []
+
+    def produce():
+        '''Put chunks into the queue, followed by None'''
+        try:
+            for chunk in chunks:
+                while not stop.is_set():
+                    try:
+                        chunks_queue.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    break
+        except Exception as e:  # pylint: disable=broad-except
+            error.append(e)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            while not stop.is_set():
+                try:
+                    chunks_queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = chunks_queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        if error:
+            raise error[0]
+    finally:
+        stop.set()
+        thread.join()
+
+
+#: magic bytes of supported compression formats
+COMPRESSION_MAGIC = (
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+
+def detect_compression(header):
+    '''Detect compression format from the first bytes of data
+
+    :param bytes header: beginning of the data (at least 6 bytes, \
+        if available)
+    :return: format name (see :py:data:`COMPRESSION_MAGIC`) or None
+    '''
+    for magic, compression in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def _new_gzip_decompressor():
+    '''Decompressor of a single gzip member'''
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def _stream_finished(decompressor):
+    '''Check if decompressor reached the end of its stream'''
+    # zlib on Python < 3.3 has no 'eof', but puts data after the stream
+    # end in 'unused_data'
+    return getattr(decompressor, 'eof', False) or \
+        bool(decompressor.unused_data)
+
+
+def _gzip_finished(decompressor):
+    '''Check if all the input of gzip decompressor was a complete stream;
+    call before :py:meth:`flush`'''
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    # Python < 3.3: data passed after the stream end lands in unused_data,
+    # otherwise it is consumed as a part of the (truncated) stream
+    probe = decompressor.copy()
+    try:
+        probe.decompress(b'\0')
+    except zlib.error:
+        return False
+    return bool(probe.unused_data)
+
+
+def _zstd_decompress_stream(chunks, bufsize):
+    '''Decompress zstd data, possibly consisting of multiple frames'''
+    if zstandard is None:
+        raise qubesadmin.exc.QubesException(
+            'zstd decompression requires zstandard module')
+    # read through stream_reader, as decompressobj() does not limit the size
+    # of its output - mostly-zero images decompress to huge chunks
+    try:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            ChunksReader(chunks), read_size=bufsize, read_across_frames=True)
+    except TypeError:
+        # older zstandard would silently stop after the first frame
+        raise qubesadmin.exc.QubesException(
+            'zstd decompression requires zstandard module supporting '
+            'read_across_frames')
+    while True:
+        data = reader.read(bufsize)
+        if not data:
+            break
+        yield data
+
+
+def _decompress_stream(chunks, compression, bufsize):
+    '''Decompress data, possibly consisting of multiple concatenated
+    streams (like pigz or pixz output)'''
+    if compression == 'zstd':
+        for data in _zstd_decompress_stream(chunks, bufsize):
+            yield data
+        return
+    if compression == 'gzip':
+        new_decompressor = _new_gzip_decompressor
+    elif compression == 'xz':
+        if lzma is None:
+            raise qubesadmin.exc.QubesException(
+                'xz decompression requires lzma module')
+        new_decompressor = lzma.LZMADecompressor
+    else:
+        raise qubesadmin.exc.QubesException(
+            'Unsupported compression: {}'.format(compression))
+
+    decompressor = new_decompressor()
+    # there is no data after the last stream end (yet)
+    finished = False
+    for chunk in chunks:
+        while chunk:
+            if finished:
+                decompressor = new_decompressor()
+                finished = False
+            data = decompressor.decompress(chunk, bufsize)
+            if compression == 'gzip':
+                chunk = decompressor.unconsumed_tail
+            else:
+                chunk = b''
+            if data:
+                yield data
+            if compression == 'xz':
+                # get the rest of buffered output
+                while not decompressor.eof and not decompressor.needs_input:
+                    data = decompressor.decompress(b'', bufsize)
+                    if data:
+                        yield data
+            if _stream_finished(decompressor):
+                finished = True
+                # on Python < 3.3, unconsumed_tail holds the same data
+                chunk = decompressor.unused_data
+    if compression == 'gzip' and not finished:
+        finished = _gzip_finished(decompressor)
+        data = decompressor.flush()
+        if data:
+            yield data
+    if not finished:
+        raise qubesadmin.exc.QubesException(
+            'Compressed data truncated ({})'.format(compression))
+
+
+def decompressed_chunks(chunks, compression='auto',
+        bufsize=qubesadmin.config.IMPORT_BUF_SIZE):
+    '''Decompress stream of chunks.
+
+    Reading the input, decompression and consuming the output run in
+    separate threads (see :py:func:`threaded_chunks`); zlib, lzma and zstd
+    release the GIL while working, so the pipeline keeps multiple CPU cores
+    busy.
+
+    :param chunks: iterable of bytes
+    :param str compression: compression format (see \
+        :py:data:`COMPRESSION_MAGIC`), or 'auto' to detect it from magic \
+        bytes; if not detected, chunks are passed through unchanged
+    :param int bufsize: maximum size of a single decompressed chunk
+    :return: iterator of bytes
+    '''
+    chunks = iter(chunks)
+    header = b''
+    first_chunks = []
+    for chunk in chunks:
+        first_chunks.append(chunk)
+        header += chunk[:6]
+        if len(header) >= 6:
+            break
+    if compression == 'auto':
+        compression = detect_compression(header)
+    input_chunks = itertools.chain(first_chunks, chunks)
+    if compression is None:
+        return input_chunks
+    return threaded_chunks(_decompress_stream(
+        threaded_chunks(input_chunks), compression, bufsize))
+
+
+class StreamHasher(object):
+    '''Calculate digests of streamed data, in a separate thread.
+
+    Data flows through :py:meth:`wrap` unchanged, while a copy of each
+    chunk is queued for hashing. :py:mod:`hashlib` releases the GIL while
+    hashing larger buffers, so this does not slow down the copy itself
+    (as long as hashing keeps up - the queue is bounded).
+    '''
+    #: maximum number of chunks waiting for hashing
+    queue_size = 16
+
+    def __init__(self, algorithms):
+        '''Start the hashing thread
+
+        :param algorithms: names of hash algorithms, as accepted by \
+            :py:func:`hashlib.new`
+        :raise ValueError: on unsupported algorithm
+        '''
+        self._hashes = dict((name, hashlib.new(name))
+            for name in algorithms)
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._hash)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _hash(self):
+        '''Hash queued chunks until None is received'''
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            for hash_obj in self._hashes.values():
+                hash_obj.update(chunk)
+
+    def wrap(self, chunks):
+        '''Pass chunks through, hashing them on the way
+
+        :param chunks: iterable of bytes
+        :return: iterator of bytes
+        '''
+        try:
+            for chunk in chunks:
+                self._queue.put(chunk)
+                yield chunk
+        finally:
+            self._queue.put(None)
+
+    def hexdigests(self):
+        '''Wait for all the data to be hashed and return the digests.
+
+        :return: dict of algorithm name -> hexadecimal digest
+        '''
+        self._thread.join()
+        return dict((name, hash_obj.hexdigest())
+            for name, hash_obj in self._hashes.items())
+
+
+class ImportProgress(object):
+    '''Progress of data import, reported to a callback function.
+
+    Besides the amount of data transferred and the transfer rate, it tracks
+    how long the transfer waited for the source (reading from disk,
+    decompressing etc) - :py:attr:`read_time` - and for the receiving end
+    (qubesd and the pool driver) - :py:attr:`write_time`. Comparing those
+    tells where the bottleneck is.
+
+    All the rates are in bytes per second.
+    '''
+    #: minimum interval between callback calls, in seconds
+    interval = 0.5
+
+    def __init__(self, callback, total_size=None):
+        '''
+        :param callback: function called with this object as an argument
+        :param int total_size: total size of the data, if known
+        '''
+        self.callback = callback
+        #: total size of the data (None if unknown)
+        self.total_size = total_size
+        #: bytes transferred so far
+        self.transferred = 0
+        #: time spent waiting for the data source, in seconds
+        self.read_time = 0.0
+        #: time spent waiting for the receiving end, in seconds
+        self.write_time = 0.0
+        #: transfer rate over the last reporting interval
+        self.current_rate = 0.0
+        #: True when reporting for the last time
+        self.finished = False
+        self.start_time = _clock()
+        self._last_report = (self.start_time, 0)
+
+    @property
+    def elapsed(self):
+        '''Time since the transfer start, in seconds'''
+        return _clock() - self.start_time
+
+    @property
+    def average_rate(self):
+        '''Average transfer rate since the start'''
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.0
+        return self.transferred / elapsed
+
+    @property
+    def eta(self):
+        '''Estimated remaining time (in seconds), or None if unknown'''
+        if self.finished:
+            return 0.0
+        rate = self.average_rate
+        if self.total_size is None or not rate:
+            return None
+        return max(self.total_size - self.transferred, 0) / rate
+
+    def _report(self, now):
+        '''Update current rate and call the callback'''
+        last_time, last_transferred = self._last_report
+        if now > last_time:
+            self.current_rate = \
+                (self.transferred - last_transferred) / (now - last_time)
+        self._last_report = (now, self.transferred)
+        self.callback(self)
+
+    def update(self, transferred, read_time, write_time):
+        '''Account a transferred chunk, call the callback if it is time to
+
+        :param int transferred: size of the chunk
+        :param float read_time: time spent waiting for the chunk
+        :param float write_time: time spent writing the chunk
+        '''
+        self.transferred += transferred
+        self.read_time += read_time
+        self.write_time += write_time
+        now = _clock()
+        if now - self._last_report[0] >= self.interval:
+            self._report(now)
+
+    def finish(self):
+        '''Report the end of the transfer'''
+        self.finished = True
+        self._report(_clock())
+
+
+class StreamFeeder(object):
+    '''Feed chunks of data into a pipe, from a separate thread.
+
+    The object is file-like: it can be used where a real file is required
+    (for example as `payload_stream` of
+    :py:meth:`qubesadmin.app.QubesBase.qubesd_call`); read end of the pipe
+    is also available as :py:attr:`stream`. After the reader is done, call
+    :py:meth:`wait` to collect the result.
+
+    If producing the data fails, the reader must not see a clean end of
+    data, as it would take truncated data as complete. A reader in this
+    process gets the exception from :py:meth:`read`. A reader process
+    registered with :py:meth:`attach_process` is killed before the pipe
+    gets closed; until then, the write end is kept open.
+    '''
+    def __init__(self, chunks, progress=None):
+        '''Start feeding the data
+
+        :param chunks: iterable of bytes
+        :param ImportProgress progress: object to report progress to
+        '''
+        self._progress = progress
+        read_fd, self._write_fd = os.pipe()
+        if fcntl is not None and sys.platform.startswith('linux'):
+            # use larger pipe buffer (F_SETPIPE_SZ); it is just an
+            # optimization, so ignore failures (like hitting the limit in
+            # /proc/sys/fs/pipe-max-size)
+            try:
+                fcntl.fcntl(self._write_fd, 1031,
+                    qubesadmin.config.IMPORT_BUF_SIZE)
+            except (IOError, OSError):
+                pass
+        #: read end of the pipe
+        self.stream = os.fdopen(read_fd, 'rb')
+        #: exception raised while producing or writing the data, if any
+        self.error = None
+        # protects _write_fd, _processes, _read_locally and _closed
+        self._lock = threading.Lock()
+        self._processes = []
+        self._read_locally = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._feed, args=(chunks,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _close_write_fd(self):
+        '''Close write end of the pipe, if not closed already; call with
+        :py:attr:`_lock` held'''
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+    def _feed(self, chunks):
+        '''Write all the chunks into the pipe, then close it'''
+        progress = self._progress
+        chunks = iter(chunks)
+        try:
+            while True:
+                read_start = _clock()
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                write_start = _clock()
+                view = memoryview(chunk)
+                while view:
+                    written = os.write(self._write_fd, view)
+                    view = view[written:]
+                if progress is not None:
+                    progress.update(len(chunk),
+                        write_start - read_start, _clock() - write_start)
+            if progress is not None:
+                progress.finish()
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                self.error = e
+        except Exception as e:  # pylint: disable=broad-except
+            self.error = e
+        finally:
+            if hasattr(chunks, 'close'):
+                # let the producer clean up, if interrupted
+                chunks.close()
+            with self._lock:
+                if self.error is not None:
+                    for proc in self._processes:
+                        self._kill(proc)
+                if self.error is None or self._processes or \
+                        self._read_locally or self._closed:
+                    self._close_write_fd()
+                # otherwise keep the pipe open until we know who reads it
+
+    @staticmethod
+    def _kill(proc):
+        '''Kill reader process, ignoring already terminated one'''
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+    def attach_process(self, proc):
+        '''Register a process reading the data (having :py:meth:`fileno` as
+        its stdin). It will be killed if producing the data fails, so it
+        will not see the end of data.
+
+        :param proc: object with `kill()` method, like \
+            :py:class:`subprocess.Popen`
+        '''
+        with self._lock:
+            self._processes.append(proc)
+            if self.error is not None:
+                self._kill(proc)
+                self._close_write_fd()
+
+    def fileno(self):
+        '''File descriptor of the read end of the pipe'''
+        return self.stream.fileno()
+
+    def read(self, size=-1):
+        '''Read data from the pipe
+
+        :raise: exception raised while producing the data, instead of \
+            reporting the end of data
+        '''
+        with self._lock:
+            self._read_locally = True
+            if self.error is not None:
+                self._close_write_fd()
+        data = self.stream.read(size)
+        if (size < 0 or not data) and self.error is not None:
+            raise self.error
+        return data
+
+    def close(self):
+        '''Close the read end of the pipe'''
+        self.stream.close()
+        with self._lock:
+            self._closed = True
+            if self.error is not None and not self._processes:
+                # nobody (known) to abort, don't block the writer
+                self._close_write_fd()
+
+    def wait(self):
+        '''Wait for the feeding thread to finish.
+
+        The reader should have either consumed the whole stream or closed it
+        before calling this function.
+
+        :raise: exception raised while producing or writing the data
+        '''
+        self._thread.join()
+        with self._lock:
+            self._close_write_fd()
+        if self.error is not None:
+            raise self.error
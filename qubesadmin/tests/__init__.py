@@ -64,7 +64,8 @@ class TestProcess(object):
         self.stderr = stderr
         self.returncode = 0
 
-    def communicate(self, input=None):
+    def communicate(self, input=None, timeout=None):
+        # pylint: disable=unused-argument
         if input is not None:
             self.stdin.write(input)
         self.stdin.close()
@@ -0,0 +1,179 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Marek Marczykowski-Górecki
+#                               <marmarek@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+import socket
+import subprocess
+import unittest
+
+import qubesadmin.tests
+try:
+    # qubesadmin.aio require python3, so this tests can also use python3
+    # features
+    import asyncio
+    import unittest.mock
+    import qubesadmin.aio
+except ImportError:
+    # don't run any tests on python2
+    def load_tests(loader, tests, pattern):
+        return unittest.TestSuite()
+    # don't fail on coroutine decorator
+    class asyncio(object):
+        @staticmethod
+        def coroutine(f):
+            return f
+
+
+class TC_00_AsyncQubesLocal(unittest.TestCase):
+    def setUp(self):
+        super(TC_00_AsyncQubesLocal, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.app = qubesadmin.aio.AsyncQubesLocal()
+        #: requests received by "qubesd" mock
+        self.requests = []
+
+    def tearDown(self):
+        self.loop.close()
+        super(TC_00_AsyncQubesLocal, self).tearDown()
+
+    def read_all(self, sock):
+        buf = b''
+        for data in iter(lambda: sock.recv(4096), b''):
+            buf += data
+        return buf
+
+    def qubesd_mock(self, sock, send_data):
+        '''Receive the whole request and send *send_data* in response'''
+        self.requests.append(self.read_all(sock))
+        sock.sendall(send_data)
+        sock.close()
+
+    def mock_open_unix_connection(self, send_data, path):
+        self.assertEqual(path, qubesadmin.config.QUBESD_SOCKET)
+        sock1, sock2 = socket.socketpair()
+        self.loop.run_in_executor(None, self.qubesd_mock, sock2, send_data)
+        return asyncio.open_connection(sock=sock1)
+
+    def test_000_qubesd_call(self):
+        with unittest.mock.patch('asyncio.open_unix_connection',
+                lambda path: self.mock_open_unix_connection(
+                    b'0\0return-value', path)):
+            value = self.loop.run_until_complete(
+                self.app.qubesd_call_async('test-vm', 'some.method', 'arg1',
+                    b'payload'))
+        self.assertEqual(value, b'return-value')
+        self.assertEqual(self.requests,
+            [b'dom0\0some.method\0test-vm\0arg1\0payload'])
+
+    def test_001_qubesd_call_none_arg(self):
+        with unittest.mock.patch('asyncio.open_unix_connection',
+                lambda path: self.mock_open_unix_connection(b'0\0', path)):
+            self.loop.run_until_complete(
+                self.app.qubesd_call_async('test-vm', 'some.method', None,
+                    None))
+        self.assertEqual(self.requests,
+            [b'dom0\0some.method\0test-vm\0\0'])
+
+    def test_002_qubesd_call_exception(self):
+        with unittest.mock.patch('asyncio.open_unix_connection',
+                lambda path: self.mock_open_unix_connection(
+                    b'2\0QubesVMNotFoundError\0\0No such VM: %s\0test-vm\0',
+                    path)):
+            with self.assertRaises(qubesadmin.exc.QubesVMNotFoundError):
+                self.loop.run_until_complete(
+                    self.app.qubesd_call_async('test-vm', 'some.method'))
+
+    def test_003_qubesd_call_concurrent(self):
+        with unittest.mock.patch('asyncio.open_unix_connection',
+                lambda path: self.mock_open_unix_connection(
+                    b'0\0return-value', path)):
+            values = self.loop.run_until_complete(asyncio.gather(*[
+                self.app.qubesd_call_async('test-vm{}'.format(i),
+                    'some.method')
+                for i in range(100)]))
+        self.assertEqual(values, [b'return-value'] * 100)
+        self.assertEqual(sorted(self.requests), sorted(
+            'dom0\0some.method\0test-vm{}\0\0'.format(i).encode()
+            for i in range(100)))
+
+    def test_004_qubesd_call_payload_and_stream(self):
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(
+                self.app.qubesd_call_async('test-vm', 'some.method',
+                    payload=b'payload', payload_stream=unittest.mock.Mock()))
+
+
+class TC_10_AsyncQubesRemote(unittest.TestCase):
+    def setUp(self):
+        super(TC_10_AsyncQubesRemote, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.app = qubesadmin.aio.AsyncQubesRemote()
+        self.proc_mock = unittest.mock.Mock()
+        self.proc_mock.return_value.returncode = 0
+
+    def tearDown(self):
+        self.loop.close()
+        super(TC_10_AsyncQubesRemote, self).tearDown()
+
+    @asyncio.coroutine
+    def mock_coroutine(self, mock, *args, **kwargs):
+        return mock(*args, **kwargs)
+
+    def set_proc_output(self, stdout, stderr=b''):
+        self.proc_mock.return_value.communicate = \
+            lambda input: self.mock_coroutine(
+                unittest.mock.Mock(return_value=(stdout, stderr)), input)
+
+    def test_000_qubesd_call(self):
+        self.set_proc_output(b'0\0return-value')
+        with unittest.mock.patch('asyncio.create_subprocess_exec',
+                lambda *args, **kwargs: self.mock_coroutine(self.proc_mock,
+                    *args, **kwargs)):
+            value = self.loop.run_until_complete(
+                self.app.qubesd_call_async('test-vm', 'some.method', 'arg1',
+                    b'payload'))
+        self.assertEqual(value, b'return-value')
+        self.proc_mock.assert_called_once_with(
+            qubesadmin.config.QREXEC_CLIENT_VM, 'test-vm',
+            'some.method+arg1',
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+    def test_001_qubesd_call_none_arg(self):
+        self.set_proc_output(b'0\0')
+        with unittest.mock.patch('asyncio.create_subprocess_exec',
+                lambda *args, **kwargs: self.mock_coroutine(self.proc_mock,
+                    *args, **kwargs)):
+            self.loop.run_until_complete(
+                self.app.qubesd_call_async('test-vm', 'some.method'))
+        self.proc_mock.assert_called_once_with(
+            qubesadmin.config.QREXEC_CLIENT_VM, 'test-vm', 'some.method',
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+    def test_002_qubesd_call_error(self):
+        self.set_proc_output(b'', b'Request refused')
+        self.proc_mock.return_value.returncode = 1
+        with unittest.mock.patch('asyncio.create_subprocess_exec',
+                lambda *args, **kwargs: self.mock_coroutine(self.proc_mock,
+                    *args, **kwargs)):
+            with self.assertRaises(qubesadmin.exc.QubesException):
+                self.loop.run_until_complete(
+                    self.app.qubesd_call_async('test-vm', 'some.method'))
@@ -32,6 +32,7 @@ except ImportError:
 
 import tempfile
 
+import qubesadmin.devices
 import qubesadmin.tests
 
 
@@ -79,6 +80,84 @@ class TC_00_VMCollection(qubesadmin.tests.QubesTestCase):
         del self.app.domains['test-vm']
         self.assertAllCalled()
 
+    def list_calls(self):
+        return self.app.actual_calls.count(
+            ('dom0', 'admin.vm.List', None, None))
+
+    def test_010_cache_add(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n'
+        self.app.expected_calls[('test-vm2', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm2 class=AppVM state=Halted\n'
+        self.assertNotIn('test-vm2', self.app.domains)
+        self.app.domains.cache_add('test-vm2')
+        # fetched lazily, not from within event handler
+        self.assertNotIn(('test-vm2', 'admin.vm.List', None, None),
+            self.app.actual_calls)
+        self.assertEqual(self.app.domains['test-vm2'].name, 'test-vm2')
+        self.assertEqual(sorted(self.app.domains.keys()),
+            ['test-vm', 'test-vm2'])
+        self.assertEqual(self.list_calls(), 1)
+        self.assertAllCalled()
+
+    def test_011_cache_add_not_cached(self):
+        self.app.domains.cache_add('test-vm2')
+        self.assertEqual(self.app.actual_calls, [])
+
+    def test_012_cache_add_gone(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n'
+        self.app.expected_calls[('test-vm2', 'admin.vm.List', None, None)] = \
+            b'2\x00QubesVMNotFoundError\x00\x00No such domain\x00'
+        self.assertNotIn('test-vm2', self.app.domains)
+        self.app.domains.cache_add('test-vm2')
+        self.assertNotIn('test-vm2', self.app.domains)
+        self.assertEqual(self.list_calls(), 1)
+        self.assertAllCalled()
+
+    def test_013_cache_remove(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n' \
+            b'test-vm2 class=AppVM state=Running\n'
+        vm = self.app.domains['test-vm2']
+        self.app.domains.cache_remove('test-vm2')
+        self.assertNotIn('test-vm2', self.app.domains)
+        self.assertNotIn(vm, self.app.domains.cached_objects())
+        self.assertIn('test-vm', self.app.domains)
+        self.assertEqual(self.list_calls(), 1)
+        self.assertAllCalled()
+
+    def test_014_cache_rename(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n'
+        vm = self.app.domains['test-vm']
+        self.app.domains.cache_rename('test-vm', 'test-vm-new')
+        self.assertNotIn('test-vm', self.app.domains)
+        self.assertIs(self.app.domains['test-vm-new'], vm)
+        self.assertEqual(vm.name, 'test-vm-new')
+        self.assertEqual(self.list_calls(), 1)
+        self.assertAllCalled()
+
+    def test_015_cache_rename_out_of_sync(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n'
+        self.assertIn('test-vm', self.app.domains)
+        self.app.domains.cache_rename('test-vm2', 'test-vm3')
+        self.assertIn('test-vm', self.app.domains)
+        self.assertEqual(self.list_calls(), 2)
+        self.assertAllCalled()
+
+    def test_016_cache_add_removed(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n'
+        self.assertNotIn('test-vm2', self.app.domains)
+        self.app.domains.cache_add('test-vm2')
+        self.app.domains.cache_remove('test-vm2')
+        self.assertNotIn('test-vm2', self.app.domains)
+        self.assertEqual(self.app.actual_calls,
+            [('dom0', 'admin.vm.List', None, None)])
+        self.assertAllCalled()
+
 
 class TC_10_QubesBase(qubesadmin.tests.QubesTestCase):
     def test_010_new_simple(self):
@@ -196,6 +275,290 @@ class TC_10_QubesBase(qubesadmin.tests.QubesTestCase):
         self.assertEqual(new_vm.name, 'new-name')
         self.assertAllCalled()
 
+    def test_040_qubesd_call_many(self):
+        for i in range(20):
+            self.app.expected_calls[('test-vm{}'.format(i),
+                'admin.vm.volume.List', None, None)] = \
+                '0\x00root\nprivate-{}\n'.format(i).encode()
+        results = self.app.qubesd_call_many(
+            [('test-vm{}'.format(i), 'admin.vm.volume.List', None, None)
+                for i in range(20)], max_workers=4)
+        self.assertEqual(results,
+            ['root\nprivate-{}\n'.format(i).encode() for i in range(20)])
+        self.assertAllCalled()
+
+    def test_041_qubesd_call_many_exceptions(self):
+        self.app.expected_calls[('test-vm', 'admin.vm.property.Get', 'qid',
+            None)] = b'0\x00default=False type=int 1'
+        self.app.expected_calls[('test-vm', 'admin.vm.property.Get', 'xxx',
+            None)] = \
+            b'2\x00QubesNoSuchPropertyError\x00\x00Invalid property ' \
+            b'\'xxx\' of test-vm\x00'
+        self.app.expected_calls[('test-vm', 'admin.vm.property.Set', 'qid',
+            b'2')] = b'0\x00'
+        results = self.app.qubesd_call_many([
+            ('test-vm', 'admin.vm.property.Get', 'qid'),
+            ('test-vm', 'admin.vm.property.Get', 'xxx', None),
+            ('test-vm', 'admin.vm.property.Set', 'qid', b'2'),
+        ])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], b'default=False type=int 1')
+        self.assertIsInstance(results[1],
+            qubesadmin.exc.QubesNoSuchPropertyError)
+        self.assertEqual(str(results[1]), 'Invalid property \'xxx\' of test-vm')
+        self.assertEqual(results[2], b'')
+        self.assertAllCalled()
+
+    def test_042_qubesd_call_many_empty(self):
+        self.assertEqual(self.app.qubesd_call_many([]), [])
+        self.assertAllCalled()
+
+    def setup_volumes(self, vms=('vm1', 'vm2')):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00' + b''.join(vm.encode() + b' class=AppVM state=Halted\n'
+                for vm in vms)
+        for vm in vms:
+            self.app.expected_calls[
+                (vm, 'admin.vm.volume.List', None, None)] = \
+                b'0\x00root\nprivate\n'
+            for vol in ('root', 'private'):
+                self.app.expected_calls[
+                    (vm, 'admin.vm.volume.Info', vol, None)] = \
+                    b'0\x00pool=' + \
+                    (b'pool-root' if vol == 'root' else b'pool-private') + \
+                    b'\nvid=' + vm.encode() + b'-' + vol.encode() + b'\n' \
+                    b'internal=' + str(vol == 'root').encode() + b'\n' \
+                    b'size=2048\nusage=1024\n'
+
+    def test_050_volume_inventory(self):
+        self.setup_volumes()
+        inventory = self.app.volume_inventory()
+        self.assertEqual(
+            [(e.pool, e.vid, e.vm.name, e.name, e.size, e.usage, e.revisions)
+                for e in inventory],
+            [('pool-private', 'vm1-private', 'vm1', 'private', 2048, 1024,
+                None),
+             ('pool-private', 'vm2-private', 'vm2', 'private', 2048, 1024,
+                None),
+             ('pool-root', 'vm1-root', 'vm1', 'root', 2048, 1024, None),
+             ('pool-root', 'vm2-root', 'vm2', 'root', 2048, 1024, None)])
+        self.assertAllCalled()
+        self.assertEqual(len(self.app.actual_calls), 7)
+        # volume objects of the VM got the info
+        self.assertIs(inventory[0].volume,
+            self.app.domains['vm1'].volumes['private'])
+        self.app.cache_enabled = True
+        self.assertEqual(inventory[0].volume.pool, 'pool-private')
+        self.assertEqual(len(self.app.actual_calls), 7)
+
+    def test_051_volume_inventory_filter(self):
+        self.setup_volumes()
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.ListSnapshots', 'private', None)] = \
+            b'0\x00snap1\nsnap2\n'
+        inventory = self.app.volume_inventory(
+            domains=[self.app.domains['vm1']], pools=['pool-private'],
+            internal=False, revisions=True)
+        self.assertEqual(
+            [(e.vid, e.vm.name, e.name, e.revisions) for e in inventory],
+            [('vm1-private', 'vm1', 'private', ['snap1', 'snap2'])])
+        self.assertNotIn(
+            ('vm2', 'admin.vm.volume.List', None, None),
+            self.app.actual_calls)
+
+    def test_052_volume_inventory_unattached(self):
+        self.setup_volumes()
+        self.app.expected_calls[
+            ('dom0', 'admin.pool.volume.List', 'pool-private', None)] = \
+            b'0\x00vm1-private\nvm2-private\nold-private\n'
+        self.app.expected_calls[
+            ('dom0', 'admin.pool.volume.Info', 'pool-private',
+                b'old-private')] = \
+            b'0\x00pool=pool-private\nvid=old-private\ninternal=False\n' \
+            b'size=4096\nusage=512\n'
+        inventory = self.app.volume_inventory(pools=['pool-private'],
+            unattached=True)
+        self.assertEqual(
+            [(e.vid, e.vm and e.vm.name, e.name, e.size) for e in inventory],
+            [('old-private', None, None, 4096),
+             ('vm1-private', 'vm1', 'private', 2048),
+             ('vm2-private', 'vm2', 'private', 2048)])
+        self.assertAllCalled()
+
+    def test_053_volume_inventory_vm_removed(self):
+        self.setup_volumes()
+        self.app.expected_calls[('vm2', 'admin.vm.volume.List', None, None)] = \
+            b'2\x00QubesVMNotFoundError\x00\x00No such domain: vm2\x00'
+        del self.app.expected_calls[
+            ('vm2', 'admin.vm.volume.Info', 'root', None)]
+        del self.app.expected_calls[
+            ('vm2', 'admin.vm.volume.Info', 'private', None)]
+        inventory = self.app.volume_inventory()
+        self.assertEqual([e.vid for e in inventory],
+            ['vm1-private', 'vm1-root'])
+        self.assertAllCalled()
+
+    def test_054_volume_inventory_error(self):
+        self.setup_volumes()
+        self.app.expected_calls[('vm2', 'admin.vm.volume.Info', 'root',
+            None)] = \
+            b'2\x00QubesException\x00\x00Something went wrong\x00'
+        with self.assertRaises(qubesadmin.exc.QubesException):
+            self.app.volume_inventory()
+
+    def test_060_volumes_revisions(self):
+        self.app.expected_calls[('vm1', 'admin.vm.volume.ListSnapshots',
+            'private', None)] = b'0\x00rev1\nrev2\n'
+        self.app.expected_calls[('vm2', 'admin.vm.volume.ListSnapshots',
+            'private', None)] = \
+            b'2\x00QubesException\x00\x00Something went wrong\x00'
+        volumes = [
+            qubesadmin.storage.Volume(self.app, vm='vm1', vm_name='private'),
+            qubesadmin.storage.Volume(self.app, vm='vm2', vm_name='private'),
+        ]
+        result = self.app.volumes_revisions(volumes)
+        self.assertEqual(result[0], ['rev1', 'rev2'])
+        self.assertIsInstance(result[1], qubesadmin.exc.QubesException)
+        self.assertAllCalled()
+
+    def test_061_revert_volumes(self):
+        self.app.expected_calls[('vm1', 'admin.vm.volume.Revert',
+            'private', b'rev2')] = b'0\x00'
+        self.app.expected_calls[('vm2', 'admin.vm.volume.Revert',
+            'private', b'rev1')] = \
+            b'2\x00QubesException\x00\x00Something went wrong\x00'
+        volumes = [
+            qubesadmin.storage.Volume(self.app, vm='vm1', vm_name='private'),
+            qubesadmin.storage.Volume(self.app, vm='vm2', vm_name='private'),
+        ]
+        result = self.app.revert_volumes(zip(volumes, ['rev2', 'rev1']),
+            max_workers=2)
+        self.assertIsNone(result[0])
+        self.assertIsInstance(result[1], qubesadmin.exc.QubesException)
+        self.assertAllCalled()
+
+    def test_062_prune_revisions(self):
+        for vm in ('vm1', 'vm2'):
+            self.app.expected_calls[(vm,
+                'admin.vm.volume.Set.revisions_to_keep', 'private', b'1')] = \
+                b'0\x00'
+        volumes = [
+            qubesadmin.storage.Volume(self.app, vm='vm1', vm_name='private'),
+            qubesadmin.storage.Volume(self.app, vm='vm2', vm_name='private'),
+        ]
+        self.assertEqual(self.app.prune_revisions(volumes, 1), [None, None])
+        with self.assertRaises(ValueError):
+            self.app.prune_revisions(volumes, -1)
+        self.assertAllCalled()
+
+    def test_070_device_index(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00sys-usb class=AppVM state=Running\n' \
+            b'vm1 class=AppVM state=Running\n' \
+            b'vm2 class=AppVM state=Running\n' \
+            b'vm3 class=AppVM state=Running\n'
+        self.app.expected_calls[('sys-usb', 'admin.vm.device.usb.List', None,
+            None)] = b'0\x00'
+        self.app.expected_calls[('vm1', 'admin.vm.device.usb.List', None,
+            None)] = b'0\x00sys-usb+2-1 persistent=yes\nsys-usb+2-2\n'
+        self.app.expected_calls[('vm2', 'admin.vm.device.usb.List', None,
+            None)] = b'0\x00sys-usb+2-1\n'
+        self.app.expected_calls[('vm3', 'admin.vm.device.usb.List', None,
+            None)] = \
+            b'2\x00QubesVMNotFoundError\x00\x00No such domain: vm3\x00'
+        index = self.app.device_index('usb')
+        self.assertEqual(sorted(index), [('sys-usb', '2-1'),
+            ('sys-usb', '2-2')])
+        self.assertEqual(
+            [(a.frontend_domain.name, a.persistent)
+                for a in index[('sys-usb', '2-1')]],
+            [('vm1', True), ('vm2', False)])
+        assignment = index[('sys-usb', '2-2')][0]
+        self.assertEqual(assignment.backend_domain.name, 'sys-usb')
+        self.assertEqual(assignment.frontend_domain.name, 'vm1')
+        self.assertEqual(assignment.devclass, 'usb')
+        self.assertAllCalled()
+
+    def test_071_device_index_error(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00vm1 class=AppVM state=Running\n'
+        self.app.expected_calls[('vm1', 'admin.vm.device.usb.List', None,
+            None)] = b'2\x00QubesException\x00\x00Something went wrong\x00'
+        with self.assertRaises(qubesadmin.exc.QubesException):
+            self.app.device_index('usb')
+        self.assertAllCalled()
+
+    def setup_devices_batch(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00sys-usb class=AppVM state=Running\n' \
+            b'vm1 class=AppVM state=Running\n' \
+            b'vm2 class=AppVM state=Running\n'
+        backend = self.app.domains['sys-usb']
+        return [
+            qubesadmin.devices.DeviceAssignment(backend, '2-1',
+                frontend_domain=self.app.domains['vm1'], devclass='usb'),
+            qubesadmin.devices.DeviceAssignment(backend, '2-2',
+                frontend_domain=self.app.domains['vm2'], devclass='usb',
+                persistent=True),
+        ]
+
+    def test_080_attach_devices(self):
+        assignments = self.setup_devices_batch()
+        self.app.expected_calls[('vm1', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-1', b'')] = b'0\x00'
+        self.app.expected_calls[('vm2', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-2', b'persistent=yes')] = \
+            b'2\x00QubesException\x00\x00Something went wrong\x00'
+        results = self.app.attach_devices(assignments)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], qubesadmin.exc.QubesException)
+        self.assertAllCalled()
+
+    def test_081_attach_devices_rollback(self):
+        assignments = self.setup_devices_batch()
+        self.app.expected_calls[('vm1', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-1', b'')] = b'0\x00'
+        self.app.expected_calls[('vm2', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-2', b'persistent=yes')] = \
+            b'2\x00QubesException\x00\x00Something went wrong\x00'
+        self.app.expected_calls[('vm1', 'admin.vm.device.usb.Detach',
+            'sys-usb+2-1', None)] = b'0\x00'
+        results = self.app.attach_devices(assignments, rollback=True)
+        self.assertIsInstance(results[0],
+            qubesadmin.exc.DeviceOperationRolledBack)
+        self.assertNotIsInstance(results[1],
+            qubesadmin.exc.DeviceOperationRolledBack)
+        self.assertEqual(str(results[1]), 'Something went wrong')
+        self.assertAllCalled()
+
+    def test_082_detach_devices_rollback(self):
+        assignments = self.setup_devices_batch()
+        self.app.expected_calls[('vm1', 'admin.vm.device.usb.Detach',
+            'sys-usb+2-1', None)] = \
+            b'2\x00QubesException\x00\x00Something went wrong\x00'
+        self.app.expected_calls[('vm2', 'admin.vm.device.usb.Detach',
+            'sys-usb+2-2', None)] = b'0\x00'
+        self.app.expected_calls[('vm2', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-2', b'persistent=yes')] = b'0\x00'
+        results = self.app.detach_devices(assignments, rollback=True)
+        self.assertIsInstance(results[0], qubesadmin.exc.QubesException)
+        self.assertIsInstance(results[1],
+            qubesadmin.exc.DeviceOperationRolledBack)
+        self.assertAllCalled()
+
+    def test_083_devices_batch_no_rollback_needed(self):
+        assignments = self.setup_devices_batch()
+        self.app.expected_calls[('vm1', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-1', b'')] = b'0\x00'
+        self.app.expected_calls[('vm2', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-2', b'persistent=yes')] = b'0\x00'
+        self.assertEqual(self.app.attach_devices(assignments, rollback=True),
+            [None, None])
+        with self.assertRaises(ValueError):
+            self.app.attach_devices([qubesadmin.devices.DeviceAssignment(
+                self.app.domains['sys-usb'], '2-1')])
+        self.assertAllCalled()
+
 
 class TC_20_QubesLocal(unittest.TestCase):
     def setUp(self):
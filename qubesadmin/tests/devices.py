@@ -18,6 +18,11 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
 import qubesadmin.tests
 import qubesadmin.devices
 
@@ -293,3 +298,70 @@ class TC_00_DeviceCollection(qubesadmin.tests.QubesTestCase):
         self.assertEqual(devs[1].ident, 'dev2')
         self.assertAllCalled()
 
+    def test_061_attached_single_lookup(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.device.test.List', None, None)] = \
+            b'0\0test-vm2+dev1\n' \
+            b'test-vm2+dev2\n' \
+            b'test-vm2+dev3\n'
+        self.app.expected_calls[
+            ('test-vm2', 'admin.vm.device.test.Available', None, None)] = \
+            b'0\0dev1\ndev2\n'
+        devs = list(self.vm.devices['test'].attached())
+        self.assertEqual([dev.ident for dev in devs], ['dev1', 'dev2', 'dev3'])
+        self.assertIsInstance(devs[2], qubesadmin.devices.UnknownDevice)
+        self.assertEqual(self.app.actual_calls.count(
+            ('test-vm2', 'admin.vm.device.test.Available', None, None)), 1)
+        self.assertAllCalled()
+
+    def test_070_cache_disabled(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.device.test.Available', None, None)] = \
+            b'0\0dev1\n'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.device.test.List', None, None)] = \
+            b'0\0'
+        for _ in range(2):
+            self.assertEqual(len(list(self.vm.devices['test'].available())), 1)
+            self.assertEqual(list(self.vm.devices['test'].assignments()), [])
+        self.assertEqual(self.app.actual_calls.count(
+            ('test-vm', 'admin.vm.device.test.Available', None, None)), 2)
+        self.assertEqual(self.app.actual_calls.count(
+            ('test-vm', 'admin.vm.device.test.List', None, None)), 2)
+
+    def test_071_cache_ttl(self):
+        self.app.cache_enabled = True
+        self.app.cache_ttl = 5
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.device.test.Available', None, None)] = \
+            b'0\0dev1\n'
+        available_call = \
+            ('test-vm', 'admin.vm.device.test.Available', None, None)
+        with mock.patch('qubesadmin.base._clock', lambda: 100):
+            self.assertEqual(len(list(self.vm.devices['test'].available())), 1)
+        with mock.patch('qubesadmin.base._clock', lambda: 104):
+            self.assertEqual(len(list(self.vm.devices['test'].available())), 1)
+            self.assertIsInstance(self.vm.devices['test']['dev2'],
+                qubesadmin.devices.UnknownDevice)
+        self.assertEqual(self.app.actual_calls.count(available_call), 1)
+        with mock.patch('qubesadmin.base._clock', lambda: 106):
+            self.assertEqual(len(list(self.vm.devices['test'].available())), 1)
+        self.assertEqual(self.app.actual_calls.count(available_call), 2)
+
+    def test_072_cache_attach_invalidate(self):
+        self.app.cache_enabled = True
+        self.app._cache_coherent = True
+        list_call = ('test-vm', 'admin.vm.device.test.List', None, None)
+        self.app.expected_calls[list_call] = b'0\0'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.device.test.Attach', 'test-vm2+dev1',
+                b'')] = b'0\0'
+        self.assertEqual(list(self.vm.devices['test'].assignments()), [])
+        self.assertEqual(list(self.vm.devices['test'].assignments()), [])
+        self.assertEqual(self.app.actual_calls.count(list_call), 1)
+        self.vm.devices['test'].attach(qubesadmin.devices.DeviceAssignment(
+            self.app.domains['test-vm2'], 'dev1'))
+        self.app.expected_calls[list_call] = b'0\0test-vm2+dev1\n'
+        self.assertEqual(len(list(self.vm.devices['test'].assignments())), 1)
+        self.assertEqual(self.app.actual_calls.count(list_call), 2)
+        self.assertAllCalled()
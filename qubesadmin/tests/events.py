@@ -29,6 +29,7 @@ try:
     import asyncio
     import unittest.mock
     import qubesadmin.events
+    import qubesadmin.events.utils
 except ImportError:
     # don't run any tests on python2
     def load_tests(loader, tests, pattern):
@@ -233,3 +234,288 @@ class TC_00_Events(qubesadmin.tests.QubesTestCase):
             unittest.mock.call().kill.assert_called_once_with()
 
         loop.close()
+
+
+class TC_10_EventsCache(qubesadmin.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n' \
+            b'test-vm2 class=AppVM state=Running\n'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'prop1', None)] = \
+            b'0\x00default=False type=str value'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'prop2', None)] = \
+            b'0\x00default=True type=str value'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'prop3', None)] = \
+            b'0\x00default=False type=str value'
+        self.app.expected_calls[
+            ('dom0', 'admin.property.Get', 'prop1', None)] = \
+            b'0\x00default=False type=str value'
+        self.dispatcher = qubesadmin.events.EventsDispatcher(self.app,
+            enable_cache=True)
+        self.vm = self.app.domains['test-vm']
+
+    def count_calls(self, prop, dest='test-vm'):
+        method = 'admin.vm.property.Get' if dest != 'dom0' \
+            else 'admin.property.Get'
+        return self.app.actual_calls.count((dest, method, prop, None))
+
+    def test_000_enable_cache(self):
+        self.assertTrue(self.app.cache_enabled)
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.count_calls('prop1'), 1)
+
+    def test_001_property_set(self):
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.vm.prop3, 'value')
+        self.dispatcher.handle('test-vm', 'property-set:prop1',
+            name='prop1', newvalue='value', oldvalue='value')
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.vm.prop3, 'value')
+        self.assertEqual(self.count_calls('prop1'), 2)
+        self.assertEqual(self.count_calls('prop3'), 1)
+
+    def test_002_property_del(self):
+        self.assertEqual(self.vm.prop1, 'value')
+        self.dispatcher.handle('test-vm', 'property-del:prop1',
+            name='prop1', oldvalue='value')
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.count_calls('prop1'), 2)
+
+    def test_003_defaults_invalidated(self):
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.vm.prop2, 'value')
+        # default value may depend on some other VM property
+        self.dispatcher.handle('test-vm2', 'property-set:netvm',
+            name='netvm', newvalue='sys-net', oldvalue='')
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.vm.prop2, 'value')
+        self.assertEqual(self.count_calls('prop1'), 1)
+        self.assertEqual(self.count_calls('prop2'), 2)
+
+    def test_004_global_property(self):
+        self.assertEqual(self.app.prop1, 'value')
+        self.assertEqual(self.vm.prop1, 'value')
+        self.dispatcher.handle('', 'property-set:prop1',
+            name='prop1', newvalue='value', oldvalue='value')
+        self.assertEqual(self.app.prop1, 'value')
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.count_calls('prop1', 'dom0'), 2)
+        self.assertEqual(self.count_calls('prop1'), 1)
+
+    def test_005_connection_established(self):
+        self.assertEqual(self.vm.prop1, 'value')
+        self.dispatcher.handle('', 'connection-established')
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.count_calls('prop1'), 2)
+
+    def test_006_power_state(self):
+        self.app._cache_coherent = True
+        state_call = ('test-vm', 'admin.vm.List', None, None)
+        self.assertEqual(self.vm.get_power_state(), 'Running')
+        self.dispatcher.handle('test-vm', 'domain-paused')
+        self.assertTrue(self.vm.is_paused())
+        self.dispatcher.handle('test-vm', 'domain-unpaused')
+        self.assertEqual(self.vm.get_power_state(), 'Running')
+        self.dispatcher.handle('test-vm', 'domain-shutdown')
+        self.assertTrue(self.vm.is_halted())
+        self.assertNotIn(state_call, self.app.actual_calls)
+        # state in transition needs to be retrieved
+        self.app.expected_calls[state_call] = \
+            b'0\x00test-vm class=AppVM state=Transient\n'
+        self.dispatcher.handle('test-vm', 'domain-spawn')
+        self.assertEqual(self.vm.get_power_state(), 'Transient')
+        self.dispatcher.handle('test-vm', 'domain-start')
+        self.assertEqual(self.vm.get_power_state(), 'Running')
+        self.assertEqual(self.app.actual_calls.count(state_call), 1)
+
+    def test_007_volumes(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.List', None, None)] = \
+            b'0\x00private\n'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Info', 'private', None)] = \
+            b'0\x00pool=default\nvid=vm-test-vm-private\n'
+        info_call = ('test-vm', 'admin.vm.volume.Info', 'private', None)
+        volume = self.vm.volumes['private']
+        self.assertEqual(volume.pool, 'default')
+        self.assertEqual(volume.vid, 'vm-test-vm-private')
+        self.assertEqual(self.app.actual_calls.count(info_call), 1)
+        self.dispatcher.handle('test-vm', 'domain-volume-import-end',
+            volume='private', success='True')
+        self.assertEqual(volume.vid, 'vm-test-vm-private')
+        self.assertEqual(self.app.actual_calls.count(info_call), 2)
+        self.dispatcher.handle('', 'connection-established')
+        self.assertEqual(volume.vid, 'vm-test-vm-private')
+        self.assertEqual(self.app.actual_calls.count(info_call), 3)
+
+    def test_008_devices(self):
+        self.app._cache_coherent = True
+        available_call = ('test-vm', 'admin.vm.device.test.Available', None,
+            None)
+        list_call = ('test-vm', 'admin.vm.device.test.List', None, None)
+        self.app.expected_calls[available_call] = b'0\x00dev1\n'
+        self.app.expected_calls[list_call] = b'0\x00test-vm+dev1\n'
+        devices = self.vm.devices['test']
+        self.assertEqual([dev.ident for dev in devices.available()], ['dev1'])
+        self.assertEqual([dev.ident for dev in devices.attached()], ['dev1'])
+        self.assertEqual([dev.ident for dev in devices.available()], ['dev1'])
+        self.assertEqual([dev.ident for dev in devices.attached()], ['dev1'])
+        self.assertEqual(self.app.actual_calls.count(available_call), 1)
+        self.assertEqual(self.app.actual_calls.count(list_call), 1)
+        self.dispatcher.handle('test-vm', 'device-list-change:test')
+        self.assertEqual([dev.ident for dev in devices.available()], ['dev1'])
+        self.assertEqual(self.app.actual_calls.count(available_call), 2)
+        self.dispatcher.handle('test-vm', 'device-detach:test',
+            device='test-vm:dev1')
+        self.assertEqual([dev.ident for dev in devices.attached()], ['dev1'])
+        self.assertEqual(self.app.actual_calls.count(list_call), 2)
+        # other device class is not affected
+        self.dispatcher.handle('test-vm', 'device-attach:other',
+            device='test-vm:dev2')
+        self.assertEqual([dev.ident for dev in devices.attached()], ['dev1'])
+        self.assertEqual(self.app.actual_calls.count(list_call), 2)
+
+
+    def test_009_restart(self):
+        self.app._cache_coherent = True
+        xid_call = ('test-vm', 'admin.vm.property.Get', 'xid', None)
+        self.app.expected_calls[xid_call] = \
+            b'0\x00default=True type=int 12'
+        self.assertEqual(self.vm.xid, 12)
+        self.assertEqual(self.vm.prop1, 'value')
+        self.dispatcher.handle('test-vm', 'domain-shutdown')
+        self.dispatcher.handle('test-vm', 'domain-spawn')
+        self.dispatcher.handle('test-vm', 'domain-start')
+        self.app.expected_calls[xid_call] = \
+            b'0\x00default=True type=int 13'
+        self.assertEqual(self.vm.xid, 13)
+        self.assertEqual(self.vm.xid, 13)
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.app.actual_calls.count(xid_call), 3)
+        self.assertEqual(self.count_calls('prop1'), 2)
+
+
+class TC_20_EventsVMCollection(qubesadmin.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n'
+        self.dispatcher = qubesadmin.events.EventsDispatcher(self.app)
+        self.assertIn('test-vm', self.app.domains)
+
+    def list_calls(self):
+        return self.app.actual_calls.count(
+            ('dom0', 'admin.vm.List', None, None))
+
+    def test_000_domain_add(self):
+        self.app.expected_calls[('test-vm2', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm2 class=AppVM state=Halted\n'
+        self.dispatcher.handle('', 'domain-add', vm='test-vm2')
+        # do not block event loop with a qubesd call from the handler
+        self.assertNotIn(('test-vm2', 'admin.vm.List', None, None),
+            self.app.actual_calls)
+        self.assertIn('test-vm2', self.app.domains)
+        self.assertEqual(self.list_calls(), 1)
+        self.assertAllCalled()
+
+    def test_001_domain_delete(self):
+        self.dispatcher.handle('', 'domain-delete', vm='test-vm')
+        self.assertNotIn('test-vm', self.app.domains)
+        self.assertEqual(self.list_calls(), 1)
+
+    def test_002_rename(self):
+        self.dispatcher.handle('test-vm-new', 'property-set:name',
+            name='name', newvalue='test-vm-new', oldvalue='test-vm')
+        self.assertNotIn('test-vm', self.app.domains)
+        self.assertIn('test-vm-new', self.app.domains)
+        self.assertEqual(self.list_calls(), 1)
+
+    def test_003_reconnect(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        stream = asyncio.StreamReader()
+        stream.feed_eof()
+
+        @asyncio.coroutine
+        def get_events_reader(vm):
+            return stream, lambda: None
+        self.dispatcher._get_events_reader = get_events_reader
+        loop.run_until_complete(self.dispatcher.listen_for_events(
+            reconnect=False))
+        loop.close()
+        self.assertIn('test-vm', self.app.domains)
+        self.assertEqual(self.list_calls(), 2)
+
+
+class TC_30_WaitForStates(qubesadmin.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Running\n' \
+            b'other-vm class=AppVM state=Running\n'
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.stream = asyncio.StreamReader()
+
+        @asyncio.coroutine
+        def get_events_reader(_dispatcher, vm=None):
+            return self.stream, lambda: None
+        patch = unittest.mock.patch(
+            'qubesadmin.events.EventsDispatcher._get_events_reader',
+            get_events_reader)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_000_wait(self):
+        self.app.expected_calls[('some-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Halted\n'
+        self.app.expected_calls[('other-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00other-vm class=AppVM state=Running\n'
+        self.stream.feed_data(b'1\0\0connection-established\0\0')
+        self.stream.feed_data(b'1\0other-vm\0domain-paused\0\0')
+        self.stream.feed_data(b'1\0other-vm\0domain-shutdown\0\0')
+        vms = [self.app.domains['some-vm'], self.app.domains['other-vm']]
+        remaining = qubesadmin.events.utils.wait_for_states(self.app,
+            {vm: 'Halted' for vm in vms}, 1)
+        self.assertEqual(remaining, [])
+        self.assertAllCalled()
+
+    def test_001_timeout(self):
+        self.app.expected_calls[('some-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Running\n'
+        self.app.expected_calls[('other-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00other-vm class=AppVM state=Running\n'
+        self.stream.feed_data(b'1\0\0connection-established\0\0')
+        self.stream.feed_data(b'1\0some-vm\0domain-shutdown\0\0')
+        vms = [self.app.domains['some-vm'], self.app.domains['other-vm']]
+        remaining = qubesadmin.events.utils.wait_for_states(self.app,
+            {vm: 'Halted' for vm in vms}, 0.1)
+        self.assertEqual(remaining, [self.app.domains['other-vm']])
+        self.assertAllCalled()
+
+    def test_002_app_wait_for_states(self):
+        self.app.expected_calls[('some-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Running\n'
+        self.stream.feed_data(b'1\0\0connection-established\0\0')
+        self.stream.feed_data(b'1\0some-vm\0domain-unpaused\0\0')
+        vm = self.app.domains['some-vm']
+        self.assertEqual(self.app.wait_for_states({vm: 'Paused'}, 0.1), [vm])
+        self.assertEqual(self.app.wait_for_states({}, 0.1), [])
+
+    def test_003_zero_timeout(self):
+        '''timeout=0 checks the states once, without events'''
+        self.app.expected_calls[('some-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Halted\n'
+        self.app.expected_calls[('other-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00other-vm class=AppVM state=Running\n'
+        vms = [self.app.domains['some-vm'], self.app.domains['other-vm']]
+        remaining = qubesadmin.events.utils.wait_for_states(self.app,
+            {vm: 'Halted' for vm in vms}, 0)
+        self.assertEqual(remaining, [self.app.domains['other-vm']])
+        self.assertAllCalled()
@@ -464,4 +464,125 @@ class TC_11_Firewall(qubesadmin.tests.QubesTestCase):
         self.app.expected_calls[('test-vm', 'admin.vm.firewall.Set', None,
         ''.join(rule + '\n' for rule in rules_txt).encode('ascii'))] = b'0\0'
         self.vm.firewall.rules = rules
-        self.assertAllCalled()
\ No newline at end of file
+        self.assertAllCalled()
+    def test_030_compile(self):
+        self.app.expected_calls[('test-vm', 'admin.vm.firewall.Get',
+                None, None)] = \
+            b'0\0action=accept proto=tcp dst4=192.168.0.0/16 dstports=443\n' \
+            b'action=drop\n'
+        self.app.expected_calls[('test-vm', 'admin.vm.firewall.GetPolicy',
+            None, None)] = b'0\0accept'
+        matcher = self.vm.firewall.compile()
+        self.assertEqual(matcher.action('192.168.1.1', 'tcp', 443), 'accept')
+        self.assertEqual(matcher.action('192.168.1.1', 'tcp', 80), 'drop')
+        self.assertIs(matcher.match('10.0.0.1', 'udp', 53),
+            self.vm.firewall.rules[1])
+        self.assertAllCalled()
+
+
+class TC_12_RuleMatcher(qubesadmin.tests.QubesTestCase):
+    rules_txt = (
+        'action=accept proto=tcp dst4=10.1.0.0/16 dstports=80-443',
+        'action=drop proto=tcp dst4=10.1.2.0/24',
+        'action=accept dst4=10.1.2.0/24',
+        'action=accept proto=icmp icmptype=8',
+        'action=accept specialtarget=dns',
+        'action=accept proto=udp dst6=2001:db8::/32 dstports=1000-2000',
+        'action=drop dsthost=example.com',
+        'action=accept proto=tcp dst4=10.1.2.3 dstports=22',
+    )
+
+    def setUp(self):
+        super(TC_12_RuleMatcher, self).setUp()
+        self.rules = [qubesadmin.firewall.Rule(rule)
+            for rule in self.rules_txt]
+        self.matcher = qubesadmin.firewall.RuleMatcher(self.rules,
+            policy=qubesadmin.firewall.Action('drop'))
+
+    def assertMatch(self, dst, proto, port, rule_num):
+        rule = self.matcher.match(dst, proto, port)
+        if rule_num is None:
+            self.assertIsNone(rule, (dst, proto, port))
+        else:
+            self.assertIs(rule, self.rules[rule_num], (dst, proto, port))
+
+    def test_000_first_match(self):
+        self.assertMatch('10.1.2.3', 'tcp', 80, 0)
+        self.assertMatch('10.1.2.3', 'tcp', 443, 0)
+        self.assertMatch('10.1.2.3', 'tcp', 444, 1)
+        # shadowed by the drop rule above
+        self.assertMatch('10.1.2.3', 'tcp', 22, 1)
+        self.assertMatch('10.1.2.3', 'udp', 22, 2)
+        self.assertMatch('10.1.2.255', 'sctp', None, 2)
+        self.assertMatch('10.1.3.0', 'tcp', 79, None)
+        self.assertMatch('10.1.255.255', 'tcp', 80, 0)
+        self.assertMatch('10.2.0.0', 'tcp', 80, None)
+
+    def test_001_icmp(self):
+        self.assertMatch('8.8.8.8', 'icmp', 8, 3)
+        self.assertMatch('8.8.8.8', 'icmp', 0, None)
+        self.assertMatch('8.8.8.8', 'icmp', None, None)
+        self.assertMatch('10.1.2.3', 'icmp', 0, 2)
+
+    def test_002_dns(self):
+        self.assertMatch('10.139.1.1', 'udp', 53, 4)
+        self.assertMatch('10.139.1.2', 'tcp', 53, 4)
+        self.assertMatch('10.139.1.2', 'tcp', 54, None)
+        self.assertMatch('10.139.1.3', 'udp', 53, None)
+        self.assertMatch('10.139.1.1', 'icmp', 8, 3)
+        self.assertMatch('10.139.1.1', 'icmp', 0, None)
+
+    def test_003_ipv6(self):
+        self.assertMatch('2001:db8::1', 'udp', 1500, 5)
+        self.assertMatch('2001:db8:ffff:ffff:ffff:ffff:ffff:ffff', 'udp',
+            1000, 5)
+        self.assertMatch('2001:db9::1', 'udp', 1500, None)
+        self.assertMatch('2001:db8::1', 'udp', 999, None)
+        self.assertMatch('::ffff', 'icmp', 8, 3)
+
+    def test_004_unresolved(self):
+        self.assertEqual(self.matcher.unresolved, [self.rules[6]])
+        matcher = qubesadmin.firewall.RuleMatcher(self.rules,
+            resolve=lambda host: ['93.184.216.34', '2606:2800::1'])
+        self.assertEqual(matcher.unresolved, [])
+        self.assertIs(matcher.match('93.184.216.34', 'tcp', 443),
+            self.rules[6])
+        self.assertIs(matcher.match('2606:2800::1', 'udp', 53),
+            self.rules[6])
+        self.assertIsNone(matcher.match('93.184.216.35', 'tcp', 443))
+
+    def test_005_expired(self):
+        rules = [
+            qubesadmin.firewall.Rule('action=accept expire=1'),
+            qubesadmin.firewall.Rule('action=drop proto=tcp'),
+        ]
+        matcher = qubesadmin.firewall.RuleMatcher(rules)
+        self.assertIs(matcher.match('10.0.0.1', 'tcp', 22), rules[1])
+        self.assertIsNone(matcher.match('10.0.0.1', 'udp', 22))
+
+    def test_006_action(self):
+        self.assertEqual(self.matcher.action('10.1.2.3', 'tcp', 80),
+            'accept')
+        self.assertEqual(self.matcher.action('10.1.2.3', 'tcp', 22), 'drop')
+        self.assertEqual(self.matcher.action('10.2.0.0', 'tcp', 22), 'drop')
+
+    def test_007_invalid_address(self):
+        with self.assertRaises(ValueError):
+            self.matcher.match('example.com', 'tcp', 80)
+        with self.assertRaises(ValueError):
+            self.matcher.match_many([('10.0.0.1', 'tcp', 80),
+                ('10.0.0.256', 'tcp', 80)])
+
+    def test_010_match_many(self):
+        queries = [('10.1.{}.{}'.format(i % 4, i % 256),
+            ('tcp', 'udp', 'icmp')[i % 3], i % 1000) for i in range(5000)]
+        queries += [('2001:db8::{:x}'.format(i), 'udp', 900 + i)
+            for i in range(300)]
+        self.assertEqual(self.matcher.match_many(queries),
+            [self.matcher.match(*query) for query in queries])
+
+    def test_011_empty(self):
+        matcher = qubesadmin.firewall.RuleMatcher([], policy='accept')
+        self.assertIsNone(matcher.match('10.0.0.1', 'tcp', 80))
+        self.assertEqual(matcher.action('::1'), 'accept')
+        self.assertEqual(matcher.match_many([]), [])
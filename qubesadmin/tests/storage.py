@@ -17,8 +17,26 @@
 #
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import os
+import signal
 import subprocess
-
+import tempfile
+import threading
+import unittest
+import zlib
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+import qubesadmin.exc
 import qubesadmin.tests
 import qubesadmin.storage
 
@@ -151,6 +169,13 @@ class TestVMVolume(qubesadmin.tests.QubesTestCase):
         self.vol.revert('snapid1')
         self.assertAllCalled()
 
+    def test_032_set_revisions_to_keep(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Set.revisions_to_keep', 'volname',
+            b'2')] = b'0\x00'
+        self.vol.revisions_to_keep = 2
+        self.assertAllCalled()
+
     def test_040_import_data(self):
         self.app.expected_calls[
             ('test-vm', 'admin.vm.volume.Import', 'volname', b'some-data')] = \
@@ -161,6 +186,185 @@ class TestVMVolume(qubesadmin.tests.QubesTestCase):
         input_proc.stdout.close()
         self.assertAllCalled()
 
+    def test_041_import_data_sparse(self):
+        data = b'\0' * 3 * 1024**2 + b'some-data' + b'\0' * 1024**2
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Import', 'volname', data)] = \
+            b'0\x00'
+        with tempfile.TemporaryFile() as f:
+            f.seek(3 * 1024**2)
+            f.write(b'some-data')
+            f.truncate(len(data))
+            f.flush()
+            f.seek(0)
+            with mock.patch.object(self.app, 'qubesd_call',
+                    wraps=self.app.qubesd_call) as qubesd_call:
+                self.vol.import_data(f, sparse=True)
+            # nothing to do with the data here, give the file to the service
+            self.assertIs(qubesd_call.call_args[1]['payload_stream'], f)
+        self.assertAllCalled()
+
+    def test_042_import_data_digests(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Import', 'volname', b'some-data')] = \
+            b'0\x00'
+        with tempfile.TemporaryFile() as f:
+            f.write(b'some-data')
+            f.seek(0)
+            digests = self.vol.import_data(f, digests=['sha256'],
+                expected={'md5': hashlib.md5(b'some-data').hexdigest()})
+        self.assertEqual(digests, {
+            'sha256': hashlib.sha256(b'some-data').hexdigest(),
+            'md5': hashlib.md5(b'some-data').hexdigest(),
+        })
+        self.assertAllCalled()
+
+    def test_043_import_data_digest_mismatch(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Import', 'volname', b'some-data')] = \
+            b'0\x00'
+        with self.assertRaises(qubesadmin.exc.QubesException):
+            self.vol.import_data([b'some-', b'data'],
+                expected={'sha256': hashlib.sha256(b'other').hexdigest()})
+        self.assertAllCalled()
+
+    def test_044_import_data_chunks(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Import', 'volname', b'some-data')] = \
+            b'0\x00'
+        self.assertEqual(self.vol.import_data([b'some-', b'data']), {})
+        self.assertAllCalled()
+
+    def test_045_import_data_compressed(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Import', 'volname', b'some-data')] = \
+            b'0\x00'
+        with tempfile.TemporaryFile() as f:
+            f.write(gzip_compress(b'some-data'))
+            f.seek(0)
+            self.vol.import_data(f, compression='auto')
+        self.assertAllCalled()
+
+    def test_046_import_data_progress(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Import', 'volname',
+                b'some-data' * 1000)] = b'0\x00'
+        reports = []
+        def callback(progress):
+            reports.append((progress.transferred, progress.total_size,
+                progress.finished))
+        with tempfile.TemporaryFile() as f:
+            f.write(b'some-data' * 1000)
+            f.seek(0)
+            with mock.patch.object(qubesadmin.storage.ImportProgress,
+                    'interval', 0):
+                self.vol.import_data(f, progress=callback)
+        self.assertEqual(reports[-1], (9000, 9000, True))
+        self.assertAllCalled()
+
+    def test_047_import_data_error(self):
+        def chunks():
+            yield b'some-'
+            raise IOError('read error')
+        with self.assertRaises(IOError):
+            self.vol.import_data(chunks(), digests=['sha256'])
+        # truncated data was not imported
+        self.assertEqual(self.app.actual_calls, [])
+        self.assertAllCalled()
+
+    def info_calls(self):
+        return len([call for call in self.app.actual_calls
+            if call[1].endswith('.volume.Info')])
+
+    def test_048_import_data_sparse_digests(self):
+        data = b'\0' * 3 * 1024**2 + b'some-data' + b'\0' * 1024**2
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Import', 'volname', data)] = \
+            b'0\x00'
+        with tempfile.TemporaryFile() as f:
+            f.seek(3 * 1024**2)
+            f.write(b'some-data')
+            f.truncate(len(data))
+            f.flush()
+            f.seek(0)
+            digests = self.vol.import_data(f, sparse=True,
+                digests=['sha256'])
+        self.assertEqual(digests,
+            {'sha256': hashlib.sha256(data).hexdigest()})
+        self.assertAllCalled()
+
+    def test_050_info_snapshot(self):
+        self.expect_info()
+        self.app.cache_enabled = True
+        with mock.patch('qubesadmin.storage._clock', lambda: 100):
+            self.assertEqual(self.vol.size, 1024)
+            self.assertEqual(self.vol.usage, 512)
+            self.assertEqual(self.vol.pool, 'test-pool')
+            self.assertEqual(self.vol.vid, 'some-id')
+            self.assertEqual(self.vol, self.pool_vol)
+        self.assertEqual(self.info_calls(), 1)
+        self.assertAllCalled()
+
+    def test_051_info_max_age(self):
+        self.expect_info()
+        self.app.cache_enabled = True
+        self.vol.info_max_age = 2
+        with mock.patch('qubesadmin.storage._clock', lambda: 100):
+            self.assertEqual(self.vol.size, 1024)
+        with mock.patch('qubesadmin.storage._clock', lambda: 101):
+            self.assertEqual(self.vol.usage, 512)
+        self.assertEqual(self.info_calls(), 1)
+        with mock.patch('qubesadmin.storage._clock', lambda: 102):
+            self.assertEqual(self.vol.usage, 512)
+            # static properties do not expire
+            self.assertEqual(self.vol.rw, True)
+        self.assertEqual(self.info_calls(), 2)
+        self.assertAllCalled()
+
+    def test_052_refresh(self):
+        self.expect_info()
+        self.app.cache_enabled = True
+        self.assertEqual(self.vol.size, 1024)
+        self.vol.refresh()
+        self.assertEqual(self.info_calls(), 2)
+        self.vol.clear_cache()
+        self.assertEqual(self.info_calls(), 2)
+        self.assertEqual(self.vol.rw, True)
+        self.assertEqual(self.info_calls(), 3)
+        self.assertAllCalled()
+
+    def test_053_resize_invalidate(self):
+        self.expect_info()
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.volume.Resize', 'volname', b'2048')] = b'0\x00'
+        self.assertEqual(self.vol.size, 1024)
+        self.vol.resize(2048)
+        self.assertEqual(self.vol.size, 1024)
+        self.assertEqual(self.info_calls(), 2)
+        self.assertAllCalled()
+
+    def test_054_info_no_cache(self):
+        self.expect_info()
+        self.assertEqual(self.vol.size, 1024)
+        self.assertEqual(self.vol.rw, True)
+        self.assertEqual(self.vol.source, None)
+        self.assertEqual(self.info_calls(), 3)
+        self.assertAllCalled()
+
+    def test_055_info_cache_ttl(self):
+        self.expect_info()
+        self.app.cache_enabled = True
+        self.app.cache_ttl = 5
+        with mock.patch('qubesadmin.storage._clock', lambda: 100):
+            self.assertEqual(self.vol.rw, True)
+        with mock.patch('qubesadmin.storage._clock', lambda: 104):
+            self.assertEqual(self.vol.source, None)
+        self.assertEqual(self.info_calls(), 1)
+        with mock.patch('qubesadmin.storage._clock', lambda: 105):
+            self.assertEqual(self.vol.revisions_to_keep, 3)
+        self.assertEqual(self.info_calls(), 2)
+        self.assertAllCalled()
+
 
 class TestPoolVolume(TestVMVolume):
     def setUp(self):
@@ -244,9 +448,51 @@ class TestPoolVolume(TestVMVolume):
         self.vol.revert('snapid1')
         self.assertAllCalled()
 
+    def test_032_set_revisions_to_keep(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.pool.volume.Set.revisions_to_keep', 'test-pool',
+            b'some-id 2')] = b'0\x00'
+        self.vol.revisions_to_keep = 2
+        self.assertAllCalled()
+
     def test_040_import_data(self):
         self.skipTest('admin.pool.vm.Import not supported')
 
+    def test_041_import_data_sparse(self):
+        self.skipTest('admin.pool.vm.Import not supported')
+
+    def test_042_import_data_digests(self):
+        self.skipTest('admin.pool.vm.Import not supported')
+
+    def test_043_import_data_digest_mismatch(self):
+        self.skipTest('admin.pool.vm.Import not supported')
+
+    def test_044_import_data_chunks(self):
+        self.skipTest('admin.pool.vm.Import not supported')
+
+    def test_045_import_data_compressed(self):
+        self.skipTest('admin.pool.vm.Import not supported')
+
+    def test_046_import_data_progress(self):
+        self.skipTest('admin.pool.vm.Import not supported')
+
+    def test_047_import_data_error(self):
+        self.skipTest('admin.pool.vm.Import not supported')
+
+    def test_048_import_data_sparse_digests(self):
+        self.skipTest('admin.pool.vm.Import not supported')
+
+    def test_053_resize_invalidate(self):
+        self.expect_info()
+        self.app.expected_calls[
+            ('dom0', 'admin.pool.volume.Resize', 'test-pool',
+            b'some-id 2048')] = b'0\x00'
+        self.assertEqual(self.vol.size, 1024)
+        self.vol.resize(2048)
+        self.assertEqual(self.vol.size, 1024)
+        self.assertEqual(self.info_calls(), 2)
+        self.assertAllCalled()
+
 
 class TestPool(qubesadmin.tests.QubesTestCase):
     def test_000_list(self):
@@ -321,3 +567,306 @@ class TestPool(qubesadmin.tests.QubesTestCase):
             ('dom0', 'admin.pool.Remove', 'test-pool', None)] = b'0\x00'
         self.app.remove_pool('test-pool')
         self.assertAllCalled()
+
+
+class TestSelectRevision(unittest.TestCase):
+    revisions = ['1500000000-back', '1500003600-back', '1500007200-back']
+
+    def test_000_timestamp(self):
+        self.assertEqual(
+            qubesadmin.storage.revision_timestamp('1500000000-back'),
+            1500000000)
+        self.assertEqual(
+            qubesadmin.storage.revision_timestamp('1500000000'), 1500000000)
+        self.assertIsNone(qubesadmin.storage.revision_timestamp('snapid1'))
+
+    def test_010_latest(self):
+        self.assertEqual(
+            qubesadmin.storage.select_revision(self.revisions),
+            '1500007200-back')
+        self.assertEqual(
+            qubesadmin.storage.select_revision(['snapid1']), 'snapid1')
+        self.assertIsNone(qubesadmin.storage.select_revision([]))
+
+    def test_011_nth(self):
+        self.assertEqual(
+            qubesadmin.storage.select_revision(self.revisions, nth=3),
+            '1500000000-back')
+        self.assertIsNone(
+            qubesadmin.storage.select_revision(self.revisions, nth=4))
+        with self.assertRaises(ValueError):
+            qubesadmin.storage.select_revision(self.revisions, nth=0)
+
+    def test_012_min_age(self):
+        self.assertEqual(
+            qubesadmin.storage.select_revision(self.revisions,
+                min_age=3600, now=1500007200),
+            '1500003600-back')
+        self.assertEqual(
+            qubesadmin.storage.select_revision(self.revisions, nth=2,
+                min_age=3600, now=1500007200),
+            '1500000000-back')
+        self.assertIsNone(
+            qubesadmin.storage.select_revision(self.revisions,
+                min_age=7201, now=1500007200))
+        self.assertIsNone(
+            qubesadmin.storage.select_revision(['snapid1'],
+                min_age=0, now=1500007200))
+
+
+class TestSparseFile(unittest.TestCase):
+    def setUp(self):
+        super(TestSparseFile, self).setUp()
+        self.file = tempfile.TemporaryFile()
+        self.addCleanup(self.file.close)
+        # 1MiB hole, 1MiB data, 2MiB hole, 1 byte data, 3MiB hole
+        self.file.seek(1024**2)
+        self.file.write(b'\1' * 1024**2)
+        self.file.seek(4 * 1024**2)
+        self.file.write(b'\2')
+        self.file.truncate(7 * 1024**2 + 1)
+        self.file.flush()
+        self.file.seek(0)
+        self.expected = b'\0' * 1024**2 + b'\1' * 1024**2 + \
+            b'\0' * 2 * 1024**2 + b'\2' + b'\0' * 3 * 1024**2
+
+    def test_000_data_extents(self):
+        extents = qubesadmin.storage.data_extents(self.file.fileno())
+        if extents == [(0, len(self.expected))]:
+            self.skipTest('filesystem does not report holes')
+        # filesystem may report extents with block granularity
+        for start, length in extents:
+            self.assertEqual(start % 4096, 0)
+            self.assertLessEqual(start + length, len(self.expected))
+        self.assertTrue(any(start <= 1024**2 < start + length
+            for start, length in extents))
+        self.assertTrue(any(start <= 4 * 1024**2 < start + length
+            for start, length in extents))
+        self.assertLess(sum(length for _, length in extents), 2 * 1024**2)
+        self.assertEqual(self.file.tell(), 0)
+
+    def test_001_data_extents_empty(self):
+        self.file.truncate(0)
+        self.assertEqual(
+            qubesadmin.storage.data_extents(self.file.fileno()), [])
+
+    def test_010_chunks(self):
+        chunks = list(qubesadmin.storage.sparse_file_chunks(self.file,
+            bufsize=65536))
+        self.assertTrue(all(len(chunk) <= 65536 for chunk in chunks))
+        self.assertEqual(b''.join(chunks), self.expected)
+
+    def test_011_chunks_given_extents(self):
+        # holes are not read at all
+        extents = [(1024**2, 1024**2), (4 * 1024**2, 1)]
+        self.file.seek(0)
+        self.file.write(b'\3' * 1024)
+        self.file.flush()
+        self.assertEqual(b''.join(qubesadmin.storage.sparse_file_chunks(
+            self.file, extents)), self.expected)
+
+    def test_020_feeder(self):
+        feeder = qubesadmin.storage.StreamFeeder(
+            [b'abc', b'', b'def' * 100000])
+        self.assertEqual(feeder.stream.read(), b'abc' + b'def' * 100000)
+        feeder.stream.close()
+        feeder.wait()
+
+    def test_021_feeder_error(self):
+        def chunks():
+            yield b'abc'
+            raise IOError('read error')
+        feeder = qubesadmin.storage.StreamFeeder(chunks())
+        self.assertEqual(feeder.read(3), b'abc')
+        with self.assertRaises(IOError):
+            feeder.read(3)
+        feeder.close()
+        with self.assertRaises(IOError):
+            feeder.wait()
+
+    def test_023_feeder_error_kill_reader(self):
+        produce = threading.Event()
+        def chunks():
+            yield b'abc'
+            produce.wait()
+            raise IOError('read error')
+        feeder = qubesadmin.storage.StreamFeeder(chunks())
+        proc = subprocess.Popen(['cat'], stdin=feeder,
+            stdout=subprocess.PIPE)
+        feeder.attach_process(proc)
+        feeder.close()
+        produce.set()
+        proc.communicate()
+        # killed, not terminated by the end of input
+        self.assertEqual(proc.returncode, -signal.SIGKILL)
+        with self.assertRaises(IOError):
+            feeder.wait()
+
+    def test_024_feeder_error_before_reader(self):
+        def chunks():
+            yield b'abc'
+            raise IOError('read error')
+        feeder = qubesadmin.storage.StreamFeeder(chunks())
+        feeder._thread.join()
+        proc = subprocess.Popen(['cat'], stdin=feeder,
+            stdout=subprocess.PIPE)
+        feeder.attach_process(proc)
+        feeder.close()
+        proc.communicate()
+        self.assertEqual(proc.returncode, -signal.SIGKILL)
+        with self.assertRaises(IOError):
+            feeder.wait()
+
+    def test_022_feeder_reader_closed(self):
+        feeder = qubesadmin.storage.StreamFeeder(
+            iter(lambda: b'x' * 65536, None))
+        feeder.stream.read(10)
+        feeder.stream.close()
+        feeder.wait()
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestImportProgress(unittest.TestCase):
+    def setUp(self):
+        super(TestImportProgress, self).setUp()
+        self.now = 100.0
+        patch = mock.patch('qubesadmin.storage._clock', lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.reports = []
+        self.progress = qubesadmin.storage.ImportProgress(
+            lambda p: self.reports.append(
+                (p.transferred, p.current_rate, p.average_rate, p.eta)),
+            total_size=4000)
+
+    def test_000_rates(self):
+        self.now = 101.0
+        self.progress.update(1000, 0.5, 0.25)
+        self.now = 101.25
+        # too early for another report
+        self.progress.update(500, 0, 0)
+        self.now = 102.0
+        self.progress.update(500, 0, 0.5)
+        self.assertEqual(self.reports, [
+            (1000, 1000.0, 1000.0, 3.0),
+            (2000, 1000.0, 1000.0, 2.0),
+        ])
+        self.assertEqual(self.progress.read_time, 0.5)
+        self.assertEqual(self.progress.write_time, 0.75)
+        self.now = 104.0
+        self.progress.finish()
+        self.assertEqual(self.reports[-1], (2000, 0.0, 500.0, 0.0))
+
+    def test_001_unknown_size(self):
+        self.progress.total_size = None
+        self.now = 101.0
+        self.progress.update(1000, 0, 0)
+        self.assertEqual(self.reports, [(1000, 1000.0, 1000.0, None)])
+
+
+class TestCompression(unittest.TestCase):
+    def decompress(self, data, compression='auto', bufsize=65536,
+            chunk_size=1000):
+        chunks = [data[i:i+chunk_size]
+            for i in range(0, len(data), chunk_size)]
+        result = list(qubesadmin.storage.decompressed_chunks(chunks,
+            compression, bufsize=bufsize))
+        self.assertTrue(all(len(chunk) <= bufsize for chunk in result))
+        return b''.join(result)
+
+    def test_000_detect(self):
+        self.assertEqual(qubesadmin.storage.detect_compression(
+            gzip_compress(b'data')), 'gzip')
+        self.assertEqual(qubesadmin.storage.detect_compression(
+            b'\xfd7zXZ\x00\x00'), 'xz')
+        self.assertEqual(qubesadmin.storage.detect_compression(
+            b'\x28\xb5\x2f\xfd\x00\x00'), 'zstd')
+        self.assertIsNone(qubesadmin.storage.detect_compression(b'data'))
+
+    def test_010_gzip(self):
+        data = os.urandom(100000) + b'\0' * 10 * 1024**2
+        self.assertEqual(self.decompress(gzip_compress(data)), data)
+
+    def test_011_gzip_multiple_members(self):
+        self.assertEqual(
+            self.decompress(gzip_compress(b'abc') + gzip_compress(b'def'),
+                chunk_size=3),
+            b'abcdef')
+
+    @unittest.skipIf(lzma is None, 'lzma module not available')
+    def test_012_xz(self):
+        data = os.urandom(100000) + b'\0' * 10 * 1024**2
+        self.assertEqual(self.decompress(lzma.compress(data)), data)
+
+    @unittest.skipIf(lzma is None, 'lzma module not available')
+    def test_013_xz_multiple_streams(self):
+        self.assertEqual(
+            self.decompress(lzma.compress(b'abc') + lzma.compress(b'def'),
+                compression='xz'),
+            b'abcdef')
+
+    def test_014_zstd(self):
+        if qubesadmin.storage.zstandard is None:
+            self.skipTest('zstandard module not available')
+        data = os.urandom(100000) + b'\0' * 1024**2
+        compressed = qubesadmin.storage.zstandard.ZstdCompressor().compress(
+            data)
+        self.assertEqual(self.decompress(compressed), data)
+
+    def test_015_zstd_multiple_frames(self):
+        if qubesadmin.storage.zstandard is None:
+            self.skipTest('zstandard module not available')
+        compressor = qubesadmin.storage.zstandard.ZstdCompressor()
+        self.assertEqual(
+            self.decompress(compressor.compress(b'abc') +
+                compressor.compress(b'def'), chunk_size=3),
+            b'abcdef')
+
+    def test_016_zstd_zeros(self):
+        # highly compressible data must not be decompressed in one go
+        if qubesadmin.storage.zstandard is None:
+            self.skipTest('zstandard module not available')
+        data = b'\0' * 64 * 1024**2
+        compressed = qubesadmin.storage.zstandard.ZstdCompressor().compress(
+            data)
+        self.assertLess(len(compressed), 65536)
+        self.assertEqual(self.decompress(compressed, chunk_size=65536), data)
+
+    def test_020_uncompressed(self):
+        data = os.urandom(10000)
+        self.assertEqual(self.decompress(data), data)
+        self.assertEqual(self.decompress(b''), b'')
+        self.assertEqual(self.decompress(b'abc', chunk_size=1), b'abc')
+
+    @unittest.skipIf(lzma is None, 'lzma module not available')
+    def test_021_truncated(self):
+        with self.assertRaises(qubesadmin.exc.QubesException):
+            self.decompress(lzma.compress(os.urandom(10000))[:-100])
+        with self.assertRaises(qubesadmin.exc.QubesException):
+            self.decompress(gzip_compress(os.urandom(10000))[:-100])
+
+    def test_022_invalid(self):
+        with self.assertRaises(Exception):
+            self.decompress(b'\x1f\x8b' + b'invalid data')
+
+    def test_030_threaded_chunks_close(self):
+        produced = []
+        def chunks():
+            for i in range(1000):
+                produced.append(i)
+                yield b'x'
+        result = qubesadmin.storage.threaded_chunks(chunks(), queue_size=2)
+        self.assertEqual(next(result), b'x')
+        result.close()
+        self.assertLess(len(produced), 10)
+
+    def test_031_reader(self):
+        reader = qubesadmin.storage.ChunksReader([b'abc', b'', b'defgh'])
+        self.assertEqual(reader.read(2), b'ab')
+        self.assertEqual(reader.read(4), b'cdef')
+        self.assertEqual(reader.read(), b'gh')
+        self.assertEqual(reader.read(), b'')
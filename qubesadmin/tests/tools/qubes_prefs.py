@@ -28,6 +28,9 @@ class TC_00_qubes_prefs(qubesadmin.tests.QubesTestCase):
         self.app.expected_calls[
             ('dom0', 'admin.property.List', None, None)] = \
             b'0\x00prop1\nprop2\n'
+        # older qubesd, without bulk method
+        self.app.expected_calls[
+            ('dom0', 'admin.property.GetAll', None, None)] = b''
         self.app.expected_calls[
             ('dom0', 'admin.property.Get', 'prop1', None)] = \
             b'0\x00default=True type=str value1'
@@ -72,3 +75,20 @@ class TC_00_qubes_prefs(qubesadmin.tests.QubesTestCase):
         self.assertIn('no such property: \'no_such_property\'',
                       stderr.getvalue())
         self.assertAllCalled()
+
+    def test_005_list_bulk(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.property.List', None, None)] = \
+            b'0\x00prop1\nprop2\nprop3\n'
+        self.app.expected_calls[
+            ('dom0', 'admin.property.GetAll', None, None)] = \
+            b'0\x00prop1 default=True type=str value1\n' \
+            b'prop2 default=False type=str value\\\\2\\n\n' \
+            b'prop3 default=False type=int \n'
+        with qubesadmin.tests.tools.StdoutBuffer() as stdout:
+            self.assertEqual(0, qubesadmin.tools.qubes_prefs.main([], app=self.app))
+        self.assertEqual(stdout.getvalue(),
+            'prop1  D  value1\n'
+            'prop2  -  value\\2\n\n'
+            'prop3  U\n')
+        self.assertAllCalled()
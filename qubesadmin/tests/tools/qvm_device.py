@@ -124,6 +124,35 @@ class TC_00_qvm_device(qubesadmin.tests.QubesTestCase):
                 'test-vm1:dev1  Description here  test-vm3\n'
             )
 
+    def test_003_list_multiple_frontends(self):
+        ''' Device exposed by the `vm1` assigned to both `vm2` and `vm3`.
+        '''
+        self.app.expected_calls[('test-vm2', 'admin.vm.device.test.Available',
+            None, None)] = \
+            b'0\0'
+        self.app.expected_calls[('test-vm3', 'admin.vm.device.test.Available',
+            None, None)] = \
+            b'0\0'
+        self.app.expected_calls[('test-vm1', 'admin.vm.device.test.List',
+            None, None)] = b'0\0'
+        self.app.expected_calls[('test-vm2', 'admin.vm.device.test.List',
+            None, None)] = \
+            b'0\0test-vm1+dev1 persistent=yes\n'
+        self.app.expected_calls[('test-vm3', 'admin.vm.device.test.List',
+            None, None)] = \
+            b'0\0test-vm1+dev1\n'
+
+        with qubesadmin.tests.tools.StdoutBuffer() as buf:
+            qubesadmin.tools.qvm_device.main(
+                ['test', 'list'], app=self.app)
+            self.assertEqual(
+                buf.getvalue(),
+                'test-vm1:dev1  Description here  test-vm2, test-vm3\n'
+            )
+        self.assertEqual(self.app.actual_calls.count(
+            ('test-vm2', 'admin.vm.device.test.List', None, None)), 1)
+        self.assertAllCalled()
+
     def test_010_attach(self):
         ''' Test attach action '''
         self.app.expected_calls[('test-vm2', 'admin.vm.device.test.Attach',
@@ -199,3 +228,61 @@ class TC_00_qvm_device(qubesadmin.tests.QubesTestCase):
             ['test', 'detach', 'test-vm2', 'test-vm1:dev7'], app=self.app)
         self.assertAllCalled()
 
+    def test_015_attach_multiple(self):
+        ''' Test attach action with multiple devices '''
+        self.app.expected_calls[('test-vm1', 'admin.vm.device.test.Available',
+            None, None)] = \
+            b'0\0dev1 description=Description here\n' \
+            b'dev2 description=Description here2\n'
+        for dev in ('dev1', 'dev2'):
+            self.app.expected_calls[('test-vm2',
+                'admin.vm.device.test.Attach', 'test-vm1+' + dev,
+                b'persistent=yes')] = b'0\0'
+        self.assertEqual(0, qubesadmin.tools.qvm_device.main(
+            ['test', 'attach', '-p', 'test-vm2', 'test-vm1:dev1',
+                'test-vm1:dev2'], app=self.app))
+        self.assertAllCalled()
+
+    def test_016_attach_multiple_rollback(self):
+        ''' Test attach action with multiple devices, one failing '''
+        self.app.expected_calls[('test-vm1', 'admin.vm.device.test.Available',
+            None, None)] = \
+            b'0\0dev1 description=Description here\n' \
+            b'dev2 description=Description here2\n'
+        self.app.expected_calls[('test-vm2', 'admin.vm.device.test.Attach',
+            'test-vm1+dev1', b'')] = b'0\0'
+        self.app.expected_calls[('test-vm2', 'admin.vm.device.test.Attach',
+            'test-vm1+dev2', b'')] = \
+            b'2\0QubesException\0\0Device busy\0'
+        self.app.expected_calls[('test-vm2', 'admin.vm.device.test.Detach',
+            'test-vm1+dev1', None)] = b'0\0'
+        with qubesadmin.tests.tools.StderrBuffer() as stderr:
+            self.assertEqual(1, qubesadmin.tools.qvm_device.main(
+                ['test', 'attach', '--rollback', 'test-vm2', 'test-vm1:dev1',
+                    'test-vm1:dev2'], app=self.app))
+        self.assertEqual(stderr.getvalue().splitlines(), [
+            'test-vm1:dev1: Device [test-vm1]:dev1 attach to test-vm2 '
+            'reverted, because other operation failed',
+            'test-vm1:dev2: Device busy',
+            '2 of 2 devices failed',
+        ])
+        self.assertAllCalled()
+
+    def test_022_detach_multiple_rollback(self):
+        ''' Test detach action with multiple devices, one failing '''
+        self.app.expected_calls[('test-vm2', 'admin.vm.device.test.List',
+            None, None)] = \
+            b'0\0test-vm1+dev1 persistent=yes ro=True\ntest-vm1+dev7\n'
+        self.app.expected_calls[('test-vm2', 'admin.vm.device.test.Detach',
+            'test-vm1+dev1', None)] = b'0\0'
+        self.app.expected_calls[('test-vm2', 'admin.vm.device.test.Detach',
+            'test-vm1+dev7', None)] = \
+            b'2\0QubesException\0\0Device busy\0'
+        self.app.expected_calls[('test-vm2', 'admin.vm.device.test.Attach',
+            'test-vm1+dev1', b'persistent=yes ro=True')] = b'0\0'
+        with qubesadmin.tests.tools.StderrBuffer():
+            self.assertEqual(1, qubesadmin.tools.qvm_device.main(
+                ['test', 'detach', '--rollback', 'test-vm2', 'test-vm1:dev1',
+                    'test-vm1:dev7'], app=self.app))
+        self.assertAllCalled()
+
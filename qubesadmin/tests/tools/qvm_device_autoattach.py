@@ -0,0 +1,202 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Marek Marczykowski-Górecki
+#                               <marmarek@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+''' Tests for the `qvm-device-autoattach` tool. '''
+
+import unittest.mock as mock
+
+import qubesadmin.devices
+import qubesadmin.tests
+import qubesadmin.tools.qvm_device_autoattach
+
+
+POLICY = '''
+# BACKEND IDENT DESCRIPTION TARGET [OPTIONS]
+sys-usb 2-1 * work
+sys-usb * "*YubiKey*" vault
+sys-usb * "*Keyboard*" sys-usb
+sys-usb2 * * personal read-only=true
+
+* 2-* * untrusted
+'''
+
+
+class TC_00_policy(qubesadmin.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_00_policy, self).setUp()
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00sys-usb class=AppVM state=Running\n' \
+            b'sys-usb2 class=AppVM state=Running\n' \
+            b'work class=AppVM state=Running\n'
+        self.policy = qubesadmin.tools.qvm_device_autoattach.\
+            AutoAttachPolicy.parse(POLICY.splitlines())
+
+    def device(self, backend, ident, description=''):
+        return qubesadmin.devices.DeviceInfo(self.app.domains[backend], ident,
+            description=description)
+
+    def test_000_parse(self):
+        self.assertEqual([rule.number for rule in self.policy.rules],
+            [3, 4, 5, 6, 8])
+        self.assertEqual(self.policy.rules[1].description, '*YubiKey*')
+        self.assertEqual(self.policy.rules[3].options,
+            {'read-only': 'true'})
+
+    def test_001_parse_invalid(self):
+        with self.assertRaises(ValueError):
+            qubesadmin.tools.qvm_device_autoattach.AutoAttachPolicy.parse(
+                ['sys-usb * work'])
+        with self.assertRaises(ValueError):
+            qubesadmin.tools.qvm_device_autoattach.AutoAttachPolicy.parse(
+                ['sys-usb * * work invalid-option'])
+        with self.assertRaises(ValueError):
+            qubesadmin.tools.qvm_device_autoattach.AutoAttachPolicy.parse(
+                ['sys-usb * "unterminated work'])
+
+    def test_010_match(self):
+        self.assertEqual(
+            self.policy.match(self.device('sys-usb', '2-1', 'YubiKey')).target,
+            'work')
+        self.assertEqual(
+            self.policy.match(self.device('sys-usb', '2-2', 'Yubico YubiKey'))
+                .target,
+            'vault')
+        self.assertEqual(
+            self.policy.match(self.device('sys-usb', '2-3', 'USB Keyboard'))
+                .target,
+            'sys-usb')
+        self.assertEqual(
+            self.policy.match(self.device('sys-usb2', '3-1')).target,
+            'personal')
+        self.assertEqual(
+            self.policy.match(self.device('sys-usb', '2-4', 'Mouse')).target,
+            'untrusted')
+        self.assertIsNone(
+            self.policy.match(self.device('work', '1-1', 'Mouse')))
+
+    def test_011_match_precedence(self):
+        policy = qubesadmin.tools.qvm_device_autoattach.AutoAttachPolicy.parse(
+            ['* * * first', 'sys-usb 2-1 * second'])
+        self.assertEqual(policy.match(self.device('sys-usb', '2-1')).target,
+            'first')
+
+
+class TC_10_autoattach(qubesadmin.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_10_autoattach, self).setUp()
+        # as set up by EventsDispatcher(enable_cache=True)
+        self.app.cache_enabled = True
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00dom0 class=AdminVM state=Running\n' \
+            b'sys-usb class=AppVM state=Running\n' \
+            b'vault class=AppVM state=Running\n' \
+            b'work class=AppVM state=Halted\n'
+        policy = qubesadmin.tools.qvm_device_autoattach.AutoAttachPolicy.parse(
+            ['sys-usb * "*YubiKey*" vault', 'sys-usb * "*Disk*" work'])
+        self.autoattach = qubesadmin.tools.qvm_device_autoattach.AutoAttach(
+            self.app, 'usb', policy)
+
+    def test_000_initial_scan(self):
+        self.app.expected_calls[('sys-usb', 'admin.vm.device.usb.Available',
+            None, None)] = b'0\x002-1 description=YubiKey\n'
+        self.app.expected_calls[('vault', 'admin.vm.device.usb.Available',
+            None, None)] = b'0\x00'
+        self.autoattach.on_connection_established(None,
+            'connection-established')
+        self.assertEqual(self.autoattach.known,
+            {'sys-usb': {'2-1'}, 'vault': set()})
+        self.assertAllCalled()
+
+    def test_010_new_device(self):
+        self.autoattach.known['sys-usb'] = {'2-1'}
+        self.app.expected_calls[('sys-usb', 'admin.vm.device.usb.Available',
+            None, None)] = \
+            b'0\x002-1 description=YubiKey\n' \
+            b'2-2 description=Yubico YubiKey\n' \
+            b'2-3 description=Mouse\n'
+        self.app.expected_calls[('vault', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-2', b'')] = b'0\x00'
+        self.autoattach.on_device_list_change(self.app.domains['sys-usb'],
+            'device-list-change:usb')
+        self.assertEqual(self.autoattach.known['sys-usb'],
+            {'2-1', '2-2', '2-3'})
+        self.assertAllCalled()
+
+    def test_011_target_not_running(self):
+        self.app.expected_calls[('sys-usb', 'admin.vm.device.usb.Available',
+            None, None)] = b'0\x002-1 description=USB Disk\n'
+        self.autoattach.on_device_list_change(self.app.domains['sys-usb'],
+            'device-list-change:usb')
+        self.assertNotIn(('work', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-1', b''), self.app.actual_calls)
+        self.assertAllCalled()
+        # attached when the target starts
+        self.app.expected_calls[('work', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-1', b'')] = b'0\x00'
+        self.app.domains.set_cached_power_state('work', 'Running')
+        self.autoattach.on_domain_start(self.app.domains['work'],
+            'domain-start')
+        self.assertEqual(self.autoattach.pending, {})
+        self.assertAllCalled()
+
+    def test_013_target_not_running_device_removed(self):
+        self.app.expected_calls[('sys-usb', 'admin.vm.device.usb.Available',
+            None, None)] = b'0\x002-1 description=USB Disk\n'
+        self.autoattach.on_device_list_change(self.app.domains['sys-usb'],
+            'device-list-change:usb')
+        self.assertEqual(list(self.autoattach.pending), ['work'])
+        self.app.expected_calls[('sys-usb', 'admin.vm.device.usb.Available',
+            None, None)] = b'0\x00'
+        # as done by EventsDispatcher before calling handlers
+        self.app.domains['sys-usb'].devices['usb'].clear_cache()
+        self.autoattach.on_device_list_change(self.app.domains['sys-usb'],
+            'device-list-change:usb')
+        self.app.domains.set_cached_power_state('work', 'Running')
+        self.autoattach.on_domain_start(self.app.domains['work'],
+            'domain-start')
+        self.assertEqual(self.autoattach.pending, {})
+        self.assertNotIn(('work', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-1', b''), self.app.actual_calls)
+        self.assertAllCalled()
+
+    def test_012_attach_failed(self):
+        self.app.expected_calls[('sys-usb', 'admin.vm.device.usb.Available',
+            None, None)] = b'0\x002-1 description=YubiKey\n'
+        self.app.expected_calls[('vault', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-1', b'')] = \
+            b'2\x00DeviceAlreadyAttached\x00\x00Device already attached\x00'
+        with mock.patch.object(self.app.log, 'warning') as warning:
+            self.autoattach.on_device_list_change(self.app.domains['sys-usb'],
+                'device-list-change:usb')
+        self.assertEqual(warning.call_count, 1)
+        self.assertEqual(self.autoattach.known['sys-usb'], {'2-1'})
+        self.assertAllCalled()
+
+    def test_020_backend_restart(self):
+        self.autoattach.known['sys-usb'] = {'2-1'}
+        self.autoattach.on_domain_shutdown(self.app.domains['sys-usb'],
+            'domain-shutdown')
+        self.app.expected_calls[('sys-usb', 'admin.vm.device.usb.Available',
+            None, None)] = b'0\x002-1 description=YubiKey\n'
+        self.app.expected_calls[('vault', 'admin.vm.device.usb.Attach',
+            'sys-usb+2-1', b'')] = b'0\x00'
+        self.autoattach.on_device_list_change(self.app.domains['sys-usb'],
+            'device-list-change:usb')
+        self.assertAllCalled()
@@ -19,6 +19,10 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 import unittest
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
 
 import qubesadmin
 import qubesadmin.vm
@@ -151,3 +155,26 @@ class TC_90_List_with_qubesd_calls(qubesadmin.tests.QubesTestCase):
             'template1  t-U-----  black  -          sys-net\n'
             'vm1        ar------  green  template1  sys-net\n')
         self.assertAllCalled()
+
+    def test_101_list_volumes(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00vm1 class=AppVM state=Running\n'
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.List', None, None)] = \
+            b'0\x00root\nprivate\n'
+        for volume in ('root', 'private'):
+            self.app.expected_calls[
+                ('vm1', 'admin.vm.volume.Info', volume, None)] = \
+                b'0\x00pool=default\nvid=vm1-' + volume.encode() + \
+                b'\nsize=2147483648\nusage=1073741824\n'
+        with mock.patch('qubesadmin.tools.print_table') as print_table:
+            qubesadmin.tools.qvm_ls.main(['--fields',
+                'name,priv-curr,priv-max,priv-used,root-curr,root-max,'
+                'root-used'], app=self.app)
+        self.assertEqual(print_table.mock_calls[0][1][0][1][1:],
+            ['1024', '2048', '50', '1024', '2048', '50'])
+        self.assertEqual(
+            [call[1] for call in self.app.actual_calls].count(
+                'admin.vm.volume.Info'),
+            2)
@@ -92,3 +92,96 @@ class TC_00_qvm_pool(qubesadmin.tests.QubesTestCase):
             'volume_group  qubes_dom0\n'
             )
         self.assertAllCalled()
+
+    def test_050_volumes(self):
+        self.app.expected_calls[('dom0', 'admin.pool.List', None, None)] = \
+            b'0\x00pool-file\npool-lvm\n'
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00vm1 class=AppVM state=Running\n'
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.List', None, None)] = \
+            b'0\x00root\nprivate\n'
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.Info', 'root', None)] = \
+            b'0\x00pool=pool-file\nvid=vm1-root\nsize=10737418240\n' \
+            b'usage=1073741824\n'
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.Info', 'private', None)] = \
+            b'0\x00pool=pool-lvm\nvid=vm1-private\nsize=2147483648\n' \
+            b'usage=1048576\n'
+        self.app.expected_calls[
+            ('dom0', 'admin.pool.volume.List', 'pool-lvm', None)] = \
+            b'0\x00vm1-private\nold-private\n'
+        self.app.expected_calls[
+            ('dom0', 'admin.pool.volume.Info', 'pool-lvm', b'old-private')] = \
+            b'0\x00pool=pool-lvm\nvid=old-private\nsize=2147483648\n' \
+            b'usage=0\n'
+        with qubesadmin.tests.tools.StdoutBuffer() as stdout:
+            self.assertEqual(0,
+                qubesadmin.tools.qvm_pool.main(['--volumes', 'pool-lvm'],
+                    app=self.app))
+        self.assertEqual(stdout.getvalue(),
+            'POOL:VOLUME           VMNAME  VOLUME_NAME  SIZE     USAGE\n'
+            'pool-lvm:old-private  -       -            2.0 GiB  0\n'
+            'pool-lvm:vm1-private  vm1     private      2.0 GiB  1.0 MiB\n'
+            )
+        self.assertAllCalled()
+
+    def test_060_usage(self):
+        self.app.expected_calls[('dom0', 'admin.pool.List', None, None)] = \
+            b'0\x00pool-lvm\npool-file\n'
+        self.app.expected_calls[('dom0', 'admin.pool.Info', 'pool-file',
+                None)] = \
+            b'0\x00driver=file\ndir_path=/var/lib/qubes\n'
+        self.app.expected_calls[('dom0', 'admin.pool.Info', 'pool-lvm',
+                None)] = \
+            b'0\x00driver=lvm_thin\nsize=10737418240\nusage=2684354560\n'
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00vm1 class=AppVM state=Running\n' \
+            b'vm2 class=AppVM state=Halted\n'
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.List', None, None)] = \
+            b'0\x00root\nprivate\n'
+        self.app.expected_calls[
+            ('vm2', 'admin.vm.volume.List', None, None)] = \
+            b'0\x00private\n'
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.Info', 'root', None)] = \
+            b'0\x00pool=pool-file\nvid=vm1-root\nsize=10737418240\n' \
+            b'usage=1073741824\n'
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.Info', 'private', None)] = \
+            b'0\x00pool=pool-lvm\nvid=vm1-private\nsize=2147483648\n' \
+            b'usage=1048576\n'
+        self.app.expected_calls[
+            ('vm2', 'admin.vm.volume.Info', 'private', None)] = \
+            b'0\x00pool=pool-lvm\nvid=vm2-private\nsize=2147483648\n' \
+            b'usage=2147483648\n'
+        self.app.expected_calls[
+            ('dom0', 'admin.pool.volume.List', 'pool-file', None)] = \
+            b'0\x00vm1-root\n'
+        self.app.expected_calls[
+            ('dom0', 'admin.pool.volume.List', 'pool-lvm', None)] = \
+            b'0\x00vm1-private\nvm2-private\nold-private\n'
+        self.app.expected_calls[
+            ('dom0', 'admin.pool.volume.Info', 'pool-lvm', b'old-private')] = \
+            b'0\x00pool=pool-lvm\nvid=old-private\nsize=2147483648\n' \
+            b'usage=536870912\n'
+        with qubesadmin.tests.tools.StdoutBuffer() as stdout:
+            self.assertEqual(0,
+                qubesadmin.tools.qvm_pool.main(['--usage'], app=self.app))
+        self.assertEqual(stdout.getvalue(),
+            'POOL       DRIVER    SIZE      USAGE    USED  VOLUMES  '
+            'VOLUMES_SIZE  VOLUMES_USAGE\n'
+            'pool-file  file      -         -        -     1        '
+            '10.0 GiB      1.0 GiB\n'
+            'pool-lvm   lvm_thin  10.0 GiB  2.5 GiB  25%   3        '
+            '6.0 GiB       2.5 GiB\n'
+            '\n'
+            'VMNAME  POOL       VOLUMES  SIZE      USAGE\n'
+            'vm2     pool-lvm   1        2.0 GiB   2.0 GiB\n'
+            'vm1     pool-file  1        10.0 GiB  1.0 GiB\n'
+            '-       pool-lvm   1        2.0 GiB   512.0 MiB\n'
+            'vm1     pool-lvm   1        2.0 GiB   1.0 MiB\n'
+            )
+        self.assertAllCalled()
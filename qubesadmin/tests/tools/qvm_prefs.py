@@ -32,6 +32,9 @@ class TC_00_qvm_prefs(qubesadmin.tests.QubesTestCase):
         self.app.expected_calls[
             ('dom0', 'admin.vm.property.List', None, None)] = \
             b'0\x00prop1\nprop2\n'
+        # older qubesd, without bulk method
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.property.GetAll', None, None)] = b''
         self.app.expected_calls[
             ('dom0', 'admin.vm.property.Get', 'prop1', None)] = \
             b'0\x00default=True type=str value1'
@@ -97,3 +100,24 @@ class TC_00_qvm_prefs(qubesadmin.tests.QubesTestCase):
         self.assertIn('no such property: \'no_such_property\'',
             stderr.getvalue())
         self.assertAllCalled()
+
+    def test_005_list_bulk(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00dom0 class=AdminVM state=Running\n'
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.property.List', None, None)] = \
+            b'0\x00prop1\nprop2\nprop3\n'
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.property.GetAll', None, None)] = \
+            b'0\x00prop1 default=True type=str value1\n' \
+            b'prop2 default=False type=str value\\\\2\\n\n' \
+            b'prop3 default=False type=int \n'
+        with qubesadmin.tests.tools.StdoutBuffer() as stdout:
+            self.assertEqual(0, qubesadmin.tools.qvm_prefs.main([
+                'dom0'], app=self.app))
+        self.assertEqual(stdout.getvalue(),
+            'prop1  D  value1\n'
+            'prop2  -  value\\2\n\n'
+            'prop3  U\n')
+        self.assertAllCalled()
@@ -25,6 +25,7 @@ import subprocess
 import sys
 
 import qubesadmin.tests
+import qubesadmin.tests.tools
 import qubesadmin.tools.qvm_run
 
 
@@ -294,3 +295,170 @@ class TC_00_qvm_run(qubesadmin.tests.QubesTestCase):
             ('test-vm', 'service.name', b''),
         ])
         self.assertAllCalled()
+
+    def fake_run_service(self, processes, wait_session=None):
+        '''Replace app.run_service with one returning FakeProcess objects'''
+        def run_service(dest, service, **kwargs):
+            self.app.service_calls.append((dest, service, kwargs))
+            if service == 'qubes.WaitForSession':
+                if wait_session and dest in wait_session:
+                    return wait_session[dest]
+                return qubesadmin.tests.TestProcess()
+            return processes[dest]
+        self.app.run_service = run_service
+
+    def run_captured(self, args):
+        stdout = io.TextIOWrapper(io.BytesIO())
+        stderr = io.TextIOWrapper(io.BytesIO())
+        with unittest.mock.patch('sys.stdout', stdout), \
+                unittest.mock.patch('sys.stderr', stderr):
+            ret = qubesadmin.tools.qvm_run.main(args, app=self.app)
+        stdout.flush()
+        stderr.flush()
+        return (ret, stdout.buffer.getvalue().decode(),
+            stderr.buffer.getvalue().decode())
+
+    def test_010_jobs(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n' \
+            b'test-vm2 class=AppVM state=Running\n'
+        processes = {
+            'test-vm': FakeProcess(b'line1\nline2', b'err1\n', 0),
+            'test-vm2': FakeProcess(b'other\n', b'', 3),
+        }
+        self.fake_run_service(processes)
+        ret, stdout, stderr = self.run_captured(
+            ['--no-gui', '--no-filter-escape-chars', '--no-color-output',
+                '--jobs=2', 'test-vm', 'test-vm2', 'command'])
+        self.assertEqual(ret, 3)
+        lines = stdout.splitlines()
+        self.assertEqual(lines[-3:], [
+            'VM        EXIT CODE',
+            'test-vm   0',
+            'test-vm2  3',
+        ])
+        self.assertEqual(sorted(lines[:-3]),
+            ['test-vm2: other', 'test-vm: line1', 'test-vm: line2'])
+        self.assertLess(lines.index('test-vm: line1'),
+            lines.index('test-vm: line2'))
+        self.assertIn('test-vm: err1\n', stderr)
+        for proc in processes.values():
+            self.assertEqual(proc.input, b'command; exit\n')
+        self.assertEqual(sorted(self.app.service_calls), [
+            ('test-vm', 'qubes.VMShell', {
+                'filter_esc': False,
+                'localcmd': None,
+                'stdout': subprocess.PIPE,
+                'stderr': subprocess.PIPE,
+                'user': None,
+            }),
+            ('test-vm2', 'qubes.VMShell', {
+                'filter_esc': False,
+                'localcmd': None,
+                'stdout': subprocess.PIPE,
+                'stderr': subprocess.PIPE,
+                'user': None,
+            }),
+        ])
+        self.assertAllCalled()
+
+    def test_011_jobs_timeout(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n' \
+            b'test-vm2 class=AppVM state=Running\n'
+        processes = {
+            'test-vm': FakeProcess(b'', b'', 0),
+            'test-vm2': FakeProcess(b'', b'', 0, hang=True),
+        }
+        self.fake_run_service(processes)
+        ret, stdout, _ = self.run_captured(
+            ['--no-gui', '--no-filter-escape-chars', '--no-color-output',
+                '--jobs=1', '--timeout=10', 'test-vm', 'test-vm2',
+                'command'])
+        self.assertEqual(ret, 1)
+        self.assertEqual(stdout.splitlines(), [
+            'VM        EXIT CODE',
+            'test-vm   0',
+            'test-vm2  timeout',
+        ])
+        self.assertFalse(processes['test-vm'].killed)
+        self.assertTrue(processes['test-vm2'].killed)
+        self.assertAlmostEqual(processes['test-vm2'].timeout, 10, delta=1)
+        self.assertAllCalled()
+
+    def test_012_jobs_localcmd(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n'
+        with self.assertRaises(SystemExit):
+            with qubesadmin.tests.tools.StderrBuffer():
+                qubesadmin.tools.qvm_run.main(
+                    ['--jobs=2', '--pass-io', '--localcmd=cat', 'test-vm',
+                        'command'], app=self.app)
+
+    def test_013_timeout_without_jobs(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n'
+        with self.assertRaises(SystemExit):
+            with qubesadmin.tests.tools.StderrBuffer():
+                qubesadmin.tools.qvm_run.main(
+                    ['--timeout=1', 'test-vm', 'command'], app=self.app)
+
+    def test_014_jobs_timeout_wait_session(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Running\n'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'default_user', None)] = \
+            b'0\x00default=yes type=str user'
+        wait_session = FakeProcess(b'', b'', 0, hang=True)
+        self.fake_run_service({}, {'test-vm': wait_session})
+        ret, stdout, _ = self.run_captured(
+            ['--no-filter-escape-chars', '--no-color-output',
+                '--jobs=1', '--timeout=10', 'test-vm', 'command'])
+        self.assertEqual(ret, 1)
+        self.assertEqual(stdout.splitlines(), [
+            'VM       EXIT CODE',
+            'test-vm  timeout',
+        ])
+        self.assertTrue(wait_session.killed)
+        self.assertEqual(wait_session.timeout, 10)
+        self.assertEqual(wait_session.input, b'user')
+        self.assertAllCalled()
+
+
+class FakeProcess(object):
+    '''Process with predefined output, for --jobs tests'''
+    def __init__(self, stdout, stderr, returncode, hang=False):
+        self.stdin = io.BytesIO()
+        self.stdin.close = self._save_input
+        self.stdout = io.BytesIO(stdout)
+        self.stderr = io.BytesIO(stderr)
+        self.returncode = returncode
+        self.hang = hang
+        self.input = None
+        self.killed = False
+        self.timeout = None
+
+    def _save_input(self):
+        self.input = self.stdin.getvalue()
+
+    def communicate(self, input=None, timeout=None):
+        # pylint: disable=redefined-builtin
+        self.input = input
+        if self.hang and not self.killed:
+            self.timeout = timeout
+            raise subprocess.TimeoutExpired('qrexec-client', timeout)
+        return self.stdout.getvalue(), self.stderr.getvalue()
+
+    def wait(self, timeout=None):
+        if self.hang and not self.killed:
+            self.timeout = timeout
+            raise subprocess.TimeoutExpired('qrexec-client', timeout)
+        return self.returncode
+
+    def kill(self):
+        self.killed = True
@@ -18,6 +18,9 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import unittest.mock
+
 import qubesadmin.tests
 import qubesadmin.tools.qvm_shutdown
 
@@ -78,4 +81,207 @@ class TC_00_qvm_shutdown(qubesadmin.tests.QubesTestCase):
 
     def test_010_wait(self):
         '''test --wait option'''
-        self.skipTest('test not implemented')
\ No newline at end of file
+        self.app.expected_calls[
+            ('some-vm', 'admin.vm.Shutdown', None, None)] = b'0\x00'
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Running\n'
+        self.app.wait_for_states = unittest.mock.Mock(return_value=[])
+        qubesadmin.tools.qvm_shutdown.main(['--wait', 'some-vm'],
+            app=self.app)
+        self.app.wait_for_states.assert_called_once_with(
+            {self.app.domains['some-vm']: 'Halted'}, 60)
+        self.assertAllCalled()
+
+    def test_011_wait_timeout(self):
+        '''test --wait option, with VMs killed after timeout'''
+        self.app.expected_calls[
+            ('some-vm', 'admin.vm.Shutdown', None, None)] = b'0\x00'
+        self.app.expected_calls[
+            ('other-vm', 'admin.vm.Shutdown', None, None)] = b'0\x00'
+        self.app.expected_calls[
+            ('other-vm', 'admin.vm.Kill', None, None)] = b'0\x00'
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Running\n' \
+            b'other-vm class=AppVM state=Running\n'
+        self.app.wait_for_states = unittest.mock.Mock(
+            return_value=[self.app.domains['other-vm']])
+        qubesadmin.tools.qvm_shutdown.main(
+            ['--wait', '--timeout=1', 'some-vm', 'other-vm'], app=self.app)
+        self.app.wait_for_states.assert_called_once_with(
+            {self.app.domains['some-vm']: 'Halted',
+             self.app.domains['other-vm']: 'Halted'}, 1)
+        self.assertAllCalled()
+
+    def setup_dependencies(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00sys-net class=AppVM state=Running\n' \
+            b'sys-firewall class=AppVM state=Running\n' \
+            b'work class=AppVM state=Running\n' \
+            b'other class=AppVM state=Running\n'
+        deps = {
+            'sys-net': ('', ''),
+            'sys-firewall': ('sys-net', ''),
+            'work': ('sys-firewall', ''),
+            'other': ('', 'work'),
+        }
+        for vm, (netvm, default_dispvm) in deps.items():
+            self.app.expected_calls[
+                (vm, 'admin.vm.property.Get', 'netvm', None)] = \
+                b'0\x00default=False type=vm ' + netvm.encode()
+            self.app.expected_calls[
+                (vm, 'admin.vm.property.Get', 'default_dispvm', None)] = \
+                b'0\x00default=False type=vm ' + default_dispvm.encode()
+            self.app.expected_calls[
+                (vm, 'admin.vm.Shutdown', None, None)] = b'0\x00'
+
+    def shutdown_order(self):
+        return [call[0] for call in self.app.actual_calls
+            if call[1] == 'admin.vm.Shutdown']
+
+    def setup_events(self, stuck=()):
+        '''Send domain-shutdown event after each admin.vm.Shutdown call,
+        except for VMs in *stuck*'''
+        if not qubesadmin.tools.qvm_shutdown.have_events:
+            self.skipTest('qubesadmin.events not available')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        stream = asyncio.StreamReader()
+
+        @asyncio.coroutine
+        def send_events():
+            stream.feed_data(b'1\0\0connection-established\0\0')
+            reported = set()
+            while True:
+                for vm in self.shutdown_order():
+                    if vm not in reported and vm not in stuck:
+                        reported.add(vm)
+                        stream.feed_data(b'1\0' + vm.encode() +
+                            b'\0domain-shutdown\0\0')
+                yield from asyncio.sleep(0.01)
+
+        @asyncio.coroutine
+        def get_events_reader(_dispatcher, vm=None):
+            task = asyncio.ensure_future(send_events())
+            return stream, task.cancel
+        patch = unittest.mock.patch(
+            'qubesadmin.events.EventsDispatcher._get_events_reader',
+            get_events_reader)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_020_jobs(self):
+        '''test --jobs option'''
+        self.setup_dependencies()
+        self.setup_events()
+        self.assertEqual(qubesadmin.tools.qvm_shutdown.main(
+            ['--jobs=2', '--timeout=5', '--all'], app=self.app), 0)
+        order = self.shutdown_order()
+        self.assertEqual(sorted(order),
+            ['other', 'sys-firewall', 'sys-net', 'work'])
+        self.assertLess(order.index('other'), order.index('work'))
+        self.assertLess(order.index('work'), order.index('sys-firewall'))
+        self.assertLess(order.index('sys-firewall'), order.index('sys-net'))
+        self.assertAllCalled()
+
+    def test_021_jobs_kill(self):
+        '''test --jobs option, with a VM killed after its timeout'''
+        self.setup_dependencies()
+        self.app.expected_calls[
+            ('sys-firewall', 'admin.vm.Kill', None, None)] = b'0\x00'
+        self.setup_events(stuck=('sys-firewall',))
+        self.assertEqual(qubesadmin.tools.qvm_shutdown.main(
+            ['--jobs=4', '--timeout=0.2', '--all'], app=self.app), 0)
+        order = self.shutdown_order()
+        self.assertEqual(order, ['other', 'work', 'sys-firewall', 'sys-net'])
+        self.assertLess(
+            self.app.actual_calls.index(
+                ('sys-firewall', 'admin.vm.Kill', None, None)),
+            self.app.actual_calls.index(
+                ('sys-net', 'admin.vm.Shutdown', None, None)))
+        self.assertAllCalled()
+
+    def test_022_jobs_no_events(self):
+        '''test --jobs option, without qubesadmin.events'''
+        self.setup_dependencies()
+        self.app.expected_calls[
+            ('sys-net', 'admin.vm.Kill', None, None)] = b'0\x00'
+        self.app.wait_for_states = unittest.mock.Mock(
+            side_effect=lambda states, timeout:
+                [vm for vm in states if vm.name == 'sys-net'])
+        with unittest.mock.patch('qubesadmin.tools.qvm_shutdown.have_events',
+                False):
+            self.assertEqual(qubesadmin.tools.qvm_shutdown.main(
+                ['--jobs=1', '--all'], app=self.app), 0)
+        self.assertEqual(self.shutdown_order(),
+            ['other', 'work', 'sys-firewall', 'sys-net'])
+        self.assertEqual(self.app.wait_for_states.call_count, 4)
+        self.assertAllCalled()
+
+    def test_024_jobs_cycle(self):
+        '''test --jobs option, with a netvm/default_dispvm cycle'''
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00sys-net class=AppVM state=Running\n' \
+            b'sys-firewall class=AppVM state=Running\n' \
+            b'fedora-dvm class=AppVM state=Running\n' \
+            b'work class=AppVM state=Running\n'
+        deps = {
+            'sys-net': ('', 'fedora-dvm'),
+            'sys-firewall': ('sys-net', ''),
+            'fedora-dvm': ('sys-firewall', ''),
+            'work': ('sys-firewall', ''),
+        }
+        for vm, (netvm, default_dispvm) in deps.items():
+            self.app.expected_calls[
+                (vm, 'admin.vm.property.Get', 'netvm', None)] = \
+                b'0\x00default=False type=vm ' + netvm.encode()
+            self.app.expected_calls[
+                (vm, 'admin.vm.property.Get', 'default_dispvm', None)] = \
+                b'0\x00default=False type=vm ' + default_dispvm.encode()
+            self.app.expected_calls[
+                (vm, 'admin.vm.Shutdown', None, None)] = b'0\x00'
+        self.setup_events()
+        self.assertEqual(qubesadmin.tools.qvm_shutdown.main(
+            ['--jobs=2', '--timeout=5', '--all'], app=self.app), 0)
+        self.assertEqual(sorted(self.shutdown_order()),
+            ['fedora-dvm', 'sys-firewall', 'sys-net', 'work'])
+        self.assertAllCalled()
+
+    def test_025_jobs_events_not_connected(self):
+        '''test --jobs option, when connection for events fails'''
+        self.setup_dependencies()
+        if not qubesadmin.tools.qvm_shutdown.have_events:
+            self.skipTest('qubesadmin.events not available')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+
+        @asyncio.coroutine
+        def get_events_reader(_dispatcher, vm=None):
+            raise ConnectionRefusedError
+        patch = unittest.mock.patch(
+            'qubesadmin.events.EventsDispatcher._get_events_reader',
+            get_events_reader)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.app.wait_for_states = unittest.mock.Mock(return_value=[])
+        self.assertEqual(qubesadmin.tools.qvm_shutdown.main(
+            ['--jobs=4', '--timeout=0.2', '--all'], app=self.app), 0)
+        self.assertEqual(self.shutdown_order(),
+            ['other', 'work', 'sys-firewall', 'sys-net'])
+        self.assertEqual(self.app.wait_for_states.call_count, 4)
+        self.assertAllCalled()
+
+    def test_023_jobs_invalid(self):
+        '''test --jobs option with invalid value'''
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Running\n'
+        with self.assertRaises(SystemExit):
+            with qubesadmin.tests.tools.StderrBuffer():
+                qubesadmin.tools.qvm_shutdown.main(['--jobs=0', 'some-vm'],
+                    app=self.app)
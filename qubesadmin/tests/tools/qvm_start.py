@@ -65,3 +65,78 @@ class TC_00_qvm_start(qubesadmin.tests.QubesTestCase):
             1)
         self.assertAllCalled()
 
+
+    def setup_dependencies(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00sys-net class=AppVM state=Halted\n' \
+            b'sys-firewall class=AppVM state=Halted\n' \
+            b'work class=AppVM state=Halted\n' \
+            b'other class=AppVM state=Halted\n'
+        netvms = {
+            'sys-net': '',
+            'sys-firewall': 'sys-net',
+            'work': 'sys-firewall',
+            'other': 'sys-net',
+        }
+        for vm, netvm in netvms.items():
+            self.app.expected_calls[
+                (vm, 'admin.vm.property.Get', 'netvm', None)] = \
+                b'0\x00default=False type=vm ' + netvm.encode()
+            self.app.expected_calls[
+                (vm, 'admin.vm.Start', None, None)] = b'0\x00'
+
+    def start_order(self):
+        return [call[0] for call in self.app.actual_calls
+            if call[1] == 'admin.vm.Start']
+
+    def test_010_jobs(self):
+        self.setup_dependencies()
+        with qubesadmin.tests.tools.StdoutBuffer() as stdout:
+            self.assertEqual(
+                qubesadmin.tools.qvm_start.main(['--jobs=2', '--all'],
+                    app=self.app),
+                0)
+        self.assertEqual(
+            sorted(line.split(':')[0]
+                for line in stdout.getvalue().splitlines()),
+            ['other', 'sys-firewall', 'sys-net', 'work'])
+        self.assertIn('sys-net: started in ', stdout.getvalue())
+        order = self.start_order()
+        self.assertEqual(sorted(order),
+            ['other', 'sys-firewall', 'sys-net', 'work'])
+        self.assertEqual(order[0], 'sys-net')
+        self.assertLess(order.index('sys-firewall'), order.index('work'))
+        self.assertAllCalled()
+
+    def test_011_jobs_error(self):
+        self.setup_dependencies()
+        self.app.expected_calls[
+            ('other', 'admin.vm.Start', None, None)] = \
+            b'2\x00QubesException\x00\x00Start failed\x00'
+        with qubesadmin.tests.tools.StderrBuffer() as stderr, \
+                qubesadmin.tests.tools.StdoutBuffer() as stdout:
+            self.assertEqual(
+                qubesadmin.tools.qvm_start.main(['--jobs=4', '--all'],
+                    app=self.app),
+                1)
+        self.assertIn('other: Start failed', stderr.getvalue())
+        self.assertNotIn('other: started', stdout.getvalue())
+        self.assertEqual(len(self.start_order()), 4)
+        self.assertAllCalled()
+
+    def test_012_jobs_skip_if_running(self):
+        self.app.expected_calls[
+            ('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Running\n'
+        self.app.expected_calls[
+            ('some-vm', 'admin.vm.property.Get', 'netvm', None)] = \
+            b'0\x00default=False type=vm '
+        self.app.expected_calls[
+            ('some-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00some-vm class=AppVM state=Running\n'
+        self.assertEqual(
+            qubesadmin.tools.qvm_start.main(
+                ['--jobs=2', '--skip-if-running', 'some-vm'], app=self.app),
+            0)
+        self.assertAllCalled()
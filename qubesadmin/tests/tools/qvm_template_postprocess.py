@@ -18,11 +18,14 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 import asyncio
+import hashlib
 import os
 import subprocess
 import tempfile
 from unittest import mock
+import qubesadmin.app
 import qubesadmin.tests
+import qubesadmin.tests.tools
 import qubesadmin.tools.qvm_template_postprocess
 
 
@@ -38,6 +41,9 @@ class TC_00_qvm_template_postprocess(qubesadmin.tests.QubesTestCase):
     def setUp(self):
         super(TC_00_qvm_template_postprocess, self).setUp()
         self.source_dir = tempfile.TemporaryDirectory()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
 
     def tearDown(self):
         try:
@@ -131,6 +137,160 @@ class TC_00_qvm_template_postprocess(qubesadmin.tests.QubesTestCase):
             vm, template_dir)
         self.assertAllCalled()
 
+    def test_003_import_root_img_tar_sparse(self):
+        root_img = os.path.join(self.source_dir.name, 'root.img')
+        volume_data = b'\0' * 65536 + b'volume data' * 1000 + b'\0' * 65536
+        with open(root_img, 'wb') as f:
+            f.truncate(len(volume_data))
+            f.seek(65536)
+            f.write(b'volume data' * 1000)
+
+        subprocess.check_call(['tar', 'cSf', 'root.img.tar', 'root.img'],
+            cwd=self.source_dir.name)
+        subprocess.check_call(['split', '-d', '-b', '1024', 'root.img.tar',
+            'root.img.part.'], cwd=self.source_dir.name)
+        os.unlink(root_img)
+
+        self.assertEqual(
+            qubesadmin.tools.qvm_template_postprocess.get_root_img_size(
+                self.source_dir.name),
+            len(volume_data))
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\0test-vm class=TemplateVM state=Halted\n'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.List', None,
+                None)] = \
+            b'0\0root\nprivate\nvolatile\nkernel\n'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.Resize', 'root',
+                str(len(volume_data)).encode())] = \
+            b'0\0'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.Import', 'root',
+            volume_data)] = b'0\0'
+        vm = self.app.domains['test-vm']
+        qubesadmin.tools.qvm_template_postprocess.import_root_img(
+            vm, self.source_dir.name)
+        self.assertAllCalled()
+
+    def test_004_import_root_img_tar_invalid(self):
+        with open(os.path.join(self.source_dir.name, 'root.img.part.00'),
+                'wb') as f:
+            f.write(b'not a tar archive' * 100)
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\0test-vm class=TemplateVM state=Halted\n'
+        vm = self.app.domains['test-vm']
+        with self.assertRaises(qubesadmin.exc.QubesException):
+            qubesadmin.tools.qvm_template_postprocess.import_root_img(
+                vm, self.source_dir.name)
+        self.assertAllCalled()
+
+    def test_005_parts_reader(self):
+        for i, data in enumerate([b'abc', b'', b'defgh']):
+            with open(os.path.join(self.source_dir.name,
+                    'part.{:02}'.format(i)), 'wb') as f:
+                f.write(data)
+        paths = [os.path.join(self.source_dir.name, 'part.{:02}'.format(i))
+            for i in range(3)]
+        with qubesadmin.tools.qvm_template_postprocess.PartsReader(paths) \
+                as reader:
+            self.assertEqual(reader.read(2), b'ab')
+            self.assertEqual(reader.read(4), b'cdef')
+            self.assertEqual(reader.read(), b'gh')
+            self.assertEqual(reader.read(), b'')
+
+    def test_006_import_root_img_digest(self):
+        root_img = os.path.join(self.source_dir.name, 'root.img')
+        volume_data = b'volume data'
+        with open(root_img, 'wb') as f:
+            f.write(volume_data)
+
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\0test-vm class=TemplateVM state=Halted\n'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.List', None,
+                None)] = \
+            b'0\0root\nprivate\nvolatile\nkernel\n'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.Resize', 'root',
+                str(len(volume_data)).encode())] = \
+            b'0\0'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.Import', 'root',
+            volume_data)] = b'0\0'
+        vm = self.app.domains['test-vm']
+        digest = hashlib.sha256(volume_data).hexdigest()
+        qubesadmin.tools.qvm_template_postprocess.import_root_img(
+            vm, self.source_dir.name, expected_digests={'sha256': digest})
+        with self.assertRaises(qubesadmin.exc.QubesException):
+            qubesadmin.tools.qvm_template_postprocess.import_root_img(
+                vm, self.source_dir.name,
+                expected_digests={'sha256': '0' * 64})
+        self.assertAllCalled()
+
+    def test_007_verify_digest_option(self):
+        args = qubesadmin.tools.qvm_template_postprocess.parser.parse_args(
+            ['--verify-digest', 'sha256:ABCD', '--verify-digest', 'md5:1234',
+                'post-install', 'test-vm', self.source_dir.name],
+            app=self.app)
+        self.assertEqual(args.verify_digest,
+            [('sha256', 'abcd'), ('md5', '1234')])
+        with self.assertRaises(SystemExit):
+            with qubesadmin.tests.tools.StderrBuffer():
+                qubesadmin.tools.qvm_template_postprocess.parser.parse_args(
+                    ['--verify-digest', 'nosuchalgo:1234',
+                        'post-install', 'test-vm', self.source_dir.name],
+                    app=self.app)
+
+    def test_008_import_root_img_tar_compressed(self):
+        root_img = os.path.join(self.source_dir.name, 'root.img')
+        volume_data = b'volume data' * 1000
+        with open(root_img, 'wb') as f:
+            f.write(volume_data)
+
+        subprocess.check_call(['tar', 'czf', 'root.img.tar', 'root.img'],
+            cwd=self.source_dir.name)
+        subprocess.check_call(['split', '-d', '-b', '100', 'root.img.tar',
+            'root.img.part.'], cwd=self.source_dir.name)
+        os.unlink(root_img)
+
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\0test-vm class=TemplateVM state=Halted\n'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.List', None,
+                None)] = \
+            b'0\0root\nprivate\nvolatile\nkernel\n'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.Resize', 'root',
+                str(len(volume_data)).encode())] = \
+            b'0\0'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.Import', 'root',
+            volume_data)] = b'0\0'
+        vm = self.app.domains['test-vm']
+        qubesadmin.tools.qvm_template_postprocess.import_root_img(
+            vm, self.source_dir.name)
+        self.assertAllCalled()
+
+    def test_009_import_root_img_progress(self):
+        root_img = os.path.join(self.source_dir.name, 'root.img')
+        volume_data = b'volume data' * 1000
+        with open(root_img, 'wb') as f:
+            f.write(volume_data)
+
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\0test-vm class=TemplateVM state=Halted\n'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.List', None,
+                None)] = \
+            b'0\0root\nprivate\nvolatile\nkernel\n'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.Resize', 'root',
+                str(len(volume_data)).encode())] = \
+            b'0\0'
+        self.app.expected_calls[('test-vm', 'admin.vm.volume.Import', 'root',
+            volume_data)] = b'0\0'
+        vm = self.app.domains['test-vm']
+        with qubesadmin.tests.tools.StderrBuffer() as stderr:
+            qubesadmin.tools.qvm_template_postprocess.import_root_img(
+                vm, self.source_dir.name,
+                progress=qubesadmin.tools.qvm_template_postprocess.
+                    print_progress)
+        self.assertTrue(stderr.getvalue().startswith('\rroot.img: 0.0/0.0 '
+            'MiB (100%), '), stderr.getvalue())
+        self.assertIn(', ETA 0:00, ', stderr.getvalue())
+        self.assertTrue(stderr.getvalue().endswith('\n'))
+        self.assertAllCalled()
+
     def test_010_import_appmenus(self):
         with open(os.path.join(self.source_dir.name,
                 'vm-whitelisted-appmenus.list'), 'w') as f:
@@ -243,15 +403,7 @@ class TC_00_qvm_template_postprocess(qubesadmin.tests.QubesTestCase):
         self.app.expected_calls[
             ('test-vm', 'admin.vm.Shutdown', None, None)] = b'0\0'
 
-        if qubesadmin.tools.qvm_template_postprocess.have_events:
-            patch_domain_shutdown = mock.patch(
-                'qubesadmin.events.utils.wait_for_domain_shutdown')
-            self.addCleanup(patch_domain_shutdown.stop)
-            mock_domain_shutdown = patch_domain_shutdown.start()
-        else:
-            self.app.expected_calls[
-                ('test-vm', 'admin.vm.List', None, None)] = \
-                b'0\0test-vm class=TemplateVM state=Halted\n'
+        self.app.wait_for_states = mock.Mock(return_value=[])
 
         ret = qubesadmin.tools.qvm_template_postprocess.main([
             '--really', 'post-install', 'test-vm', self.source_dir.name],
@@ -260,12 +412,13 @@ class TC_00_qvm_template_postprocess(qubesadmin.tests.QubesTestCase):
         self.app.add_new_vm.assert_called_once_with('TemplateVM',
             name='test-vm', label='black')
         mock_import_root_img.assert_called_once_with(self.app.domains[
-            'test-vm'], self.source_dir.name)
+            'test-vm'], self.source_dir.name, expected_digests=None,
+            progress=None)
         mock_import_appmenus.assert_called_once_with(self.app.domains[
             'test-vm'], self.source_dir.name)
-        if qubesadmin.tools.qvm_template_postprocess.have_events:
-            mock_domain_shutdown.assert_called_once_with(self.app.domains[
-                'test-vm'], 60)
+        self.app.wait_for_states.assert_called_once_with(
+            {self.app.domains['test-vm']: 'Halted'}, 60)
+        self.assertEqual(self.loop.is_closed(), qubesadmin.app.have_events)
         self.assertEqual(self.app.service_calls, [
             ('test-vm', 'qubes.PostInstall', {}),
             ('test-vm', 'qubes.PostInstall', b''),
@@ -289,15 +442,7 @@ class TC_00_qvm_template_postprocess(qubesadmin.tests.QubesTestCase):
         self.app.expected_calls[
             ('test-vm', 'admin.vm.Shutdown', None, None)] = b'0\0'
 
-        if qubesadmin.tools.qvm_template_postprocess.have_events:
-            patch_domain_shutdown = mock.patch(
-                'qubesadmin.events.utils.wait_for_domain_shutdown')
-            self.addCleanup(patch_domain_shutdown.stop)
-            mock_domain_shutdown = patch_domain_shutdown.start()
-        else:
-            self.app.expected_calls[
-                ('test-vm', 'admin.vm.List', None, None)] = \
-                b'0\0test-vm class=TemplateVM state=Halted\n'
+        self.app.wait_for_states = mock.Mock(return_value=[])
 
         ret = qubesadmin.tools.qvm_template_postprocess.main([
             '--really', 'post-install', 'test-vm', self.source_dir.name],
@@ -305,12 +450,12 @@ class TC_00_qvm_template_postprocess(qubesadmin.tests.QubesTestCase):
         self.assertEqual(ret, 0)
         self.assertFalse(self.app.add_new_vm.called)
         mock_import_root_img.assert_called_once_with(self.app.domains[
-            'test-vm'], self.source_dir.name)
+            'test-vm'], self.source_dir.name, expected_digests=None,
+            progress=None)
         mock_import_appmenus.assert_called_once_with(self.app.domains[
             'test-vm'], self.source_dir.name)
-        if qubesadmin.tools.qvm_template_postprocess.have_events:
-            mock_domain_shutdown.assert_called_once_with(self.app.domains[
-                'test-vm'], 60)
+        self.app.wait_for_states.assert_called_once_with(
+            {self.app.domains['test-vm']: 'Halted'}, 60)
         self.assertEqual(self.app.service_calls, [
             ('test-vm', 'qubes.PostInstall', {}),
             ('test-vm', 'qubes.PostInstall', b''),
@@ -325,11 +470,7 @@ class TC_00_qvm_template_postprocess(qubesadmin.tests.QubesTestCase):
             b'0\0test-vm class=TemplateVM state=Halted\n'
         self.app.add_new_vm = mock.Mock()
 
-        if qubesadmin.tools.qvm_template_postprocess.have_events:
-            patch_domain_shutdown = mock.patch(
-                'qubesadmin.events.utils.wait_for_domain_shutdown')
-            self.addCleanup(patch_domain_shutdown.stop)
-            mock_domain_shutdown = patch_domain_shutdown.start()
+        self.app.wait_for_states = mock.Mock(return_value=[])
 
         ret = qubesadmin.tools.qvm_template_postprocess.main([
             '--really', '--skip-start', 'post-install', 'test-vm',
@@ -338,11 +479,11 @@ class TC_00_qvm_template_postprocess(qubesadmin.tests.QubesTestCase):
         self.assertEqual(ret, 0)
         self.assertFalse(self.app.add_new_vm.called)
         mock_import_root_img.assert_called_once_with(self.app.domains[
-            'test-vm'], self.source_dir.name)
+            'test-vm'], self.source_dir.name, expected_digests=None,
+            progress=None)
         mock_import_appmenus.assert_called_once_with(self.app.domains[
             'test-vm'], self.source_dir.name)
-        if qubesadmin.tools.qvm_template_postprocess.have_events:
-            self.assertFalse(mock_domain_shutdown.called)
+        self.assertFalse(self.app.wait_for_states.called)
         self.assertEqual(self.app.service_calls, [])
         self.assertAllCalled()
 
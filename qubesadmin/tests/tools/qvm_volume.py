@@ -18,6 +18,11 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
 import qubesadmin.tests
 import qubesadmin.tests.tools
 import qubesadmin.tools.qvm_volume
@@ -165,3 +170,98 @@ class TC_00_qvm_volume(qubesadmin.tests.QubesTestCase):
                     app=self.app))
         self.assertIn('shrink not allowed', stderr.getvalue())
         self.assertAllCalled()
+
+    def setup_expected_calls_for_revert(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00vm1 class=AppVM state=Halted\n' \
+            b'vm2 class=AppVM state=Halted\n'
+        for vm in ('vm1', 'vm2'):
+            self.app.expected_calls[
+                (vm, 'admin.vm.volume.List', None, None)] = \
+                b'0\x00root\nprivate\n'
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.ListSnapshots', 'private', None)] = \
+            b'0\x001500000000-back\n1500003600-back\n'
+        self.app.expected_calls[
+            ('vm2', 'admin.vm.volume.ListSnapshots', 'private', None)] = \
+            b'0\x001500001800-back\n'
+
+    def test_020_revert(self):
+        self.setup_expected_calls_for_revert()
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.Revert', 'private',
+            b'1500003600-back')] = b'0\x00'
+        self.app.expected_calls[
+            ('vm2', 'admin.vm.volume.Revert', 'private',
+            b'1500001800-back')] = b'0\x00'
+        self.assertEqual(0,
+            qubesadmin.tools.qvm_volume.main(
+                ['revert', 'vm1:private', 'vm2:private'],
+                app=self.app))
+        self.assertAllCalled()
+
+    def test_021_revert_older_than(self):
+        self.setup_expected_calls_for_revert()
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.Revert', 'private',
+            b'1500000000-back')] = b'0\x00'
+        self.app.expected_calls[
+            ('vm2', 'admin.vm.volume.Revert', 'private',
+            b'1500001800-back')] = b'0\x00'
+        with mock.patch('time.time', lambda: 1500005400):
+            self.assertEqual(0,
+                qubesadmin.tools.qvm_volume.main(
+                    ['revert', '--older-than', '1h', '-j', '1',
+                        'vm1:private', 'vm2:private'],
+                    app=self.app))
+        self.assertAllCalled()
+
+    def test_022_revert_no_revision(self):
+        self.setup_expected_calls_for_revert()
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.Revert', 'private',
+            b'1500000000-back')] = b'0\x00'
+        with qubesadmin.tests.tools.StderrBuffer() as stderr:
+            with self.assertRaises(SystemExit) as e:
+                qubesadmin.tools.qvm_volume.main(
+                    ['revert', '--nth', '2', 'vm1:private', 'vm2:private'],
+                    app=self.app)
+        self.assertEqual(e.exception.code, 1)
+        self.assertEqual(stderr.getvalue(),
+            'vm2:private: no matching revision to revert to\n')
+        self.assertAllCalled()
+
+    def test_023_revert_error(self):
+        self.setup_expected_calls_for_revert()
+        self.app.expected_calls[
+            ('vm1', 'admin.vm.volume.Revert', 'private',
+            b'1500003600-back')] = b'0\x00'
+        self.app.expected_calls[
+            ('vm2', 'admin.vm.volume.Revert', 'private',
+            b'1500001800-back')] = \
+            b'2\x00StoragePoolException\x00\x00Volume in use\x00'
+        with qubesadmin.tests.tools.StderrBuffer() as stderr:
+            with self.assertRaises(SystemExit) as e:
+                qubesadmin.tools.qvm_volume.main(
+                    ['revert', 'vm1:private', 'vm2:private'],
+                    app=self.app)
+        self.assertEqual(e.exception.code, 1)
+        self.assertEqual(stderr.getvalue(), 'vm2:private: Volume in use\n')
+        self.assertAllCalled()
+
+    def test_030_prune(self):
+        self.app.expected_calls[('dom0', 'admin.vm.List', None, None)] = \
+            b'0\x00vm1 class=AppVM state=Halted\n' \
+            b'vm2 class=AppVM state=Halted\n'
+        for vm in ('vm1', 'vm2'):
+            self.app.expected_calls[
+                (vm, 'admin.vm.volume.List', None, None)] = \
+                b'0\x00root\nprivate\n'
+            self.app.expected_calls[
+                (vm, 'admin.vm.volume.Set.revisions_to_keep', 'private',
+                b'0')] = b'0\x00'
+        self.assertEqual(0,
+            qubesadmin.tools.qvm_volume.main(
+                ['prune', '--keep', '0', 'vm1:private', 'vm2:private'],
+                app=self.app))
+        self.assertAllCalled()
@@ -18,6 +18,11 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program; if not, see <http://www.gnu.org/licenses/>.
 
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
 import qubesadmin.tests.vm
 
 
@@ -164,6 +169,58 @@ class TC_00_Properties(qubesadmin.tests.vm.VMTestCase):
         del self.vm.prop1
         self.assertAllCalled()
 
+    def test_040_snapshot(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.GetAll', None, None)] = \
+            b'0\x00prop1 default=False type=str value\\nwith newline\n' \
+            b'prop2 default=True type=int 123\n' \
+            b'prop3 default=False type=vm test-vm\n' \
+            b'prop4 default=True type=bool \n'
+        snapshot = self.vm.properties_snapshot()
+        self.assertEqual(sorted(snapshot), ['prop1', 'prop2', 'prop3'])
+        self.assertEqual(snapshot['prop1'],
+            ('value\nwith newline', 'str', False))
+        self.assertEqual(snapshot['prop2'], (123, 'int', True))
+        self.assertEqual(snapshot['prop3'][0].name, 'test-vm')
+        self.assertEqual(snapshot['prop3'][1:], ('vm', False))
+        self.assertAllCalled()
+
+    def test_041_snapshot_fallback(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.GetAll', None, None)] = b''
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.List', None, None)] = \
+            b'0\x00prop1\nprop2\nprop3\n'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'prop1', None)] = \
+            b'0\x00default=False type=str value'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'prop2', None)] = \
+            b'0\x00default=True type=int '
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'prop3', None)] = b''
+        self.assertEqual(self.vm.properties_snapshot(),
+            {'prop1': ('value', 'str', False)})
+        self.assertAllCalled()
+        # bulk call is not retried
+        del self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.GetAll', None, None)]
+        self.assertEqual(self.vm.properties_snapshot(['prop1']),
+            {'prop1': ('value', 'str', False)})
+
+    def test_042_snapshot_fallback_error(self):
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.GetAll', None, None)] = b''
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.List', None, None)] = \
+            b'0\x00prop1\n'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'prop1', None)] = \
+            b'2\x00QubesException\x00\x00An error occurred\x00'
+        with self.assertRaises(qubesadmin.exc.QubesException):
+            self.vm.properties_snapshot()
+        self.assertAllCalled()
+
 
 class TC_01_SpecialCases(qubesadmin.tests.vm.VMTestCase):
     def test_000_get_name(self):
@@ -219,3 +276,102 @@ class TC_01_SpecialCases(qubesadmin.tests.vm.VMTestCase):
         self.assertTrue(self.vm.is_running())
         self.assertFalse(self.vm.is_halted())
         self.assertFalse(self.vm.is_paused())
+
+
+class TC_02_Cache(qubesadmin.tests.vm.VMTestCase):
+    def setUp(self):
+        super(TC_02_Cache, self).setUp()
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'prop1', None)] = \
+            b'0\x00default=False type=str value'
+        self.get_call = ('test-vm', 'admin.vm.property.Get', 'prop1', None)
+
+    def test_000_disabled(self):
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.app.actual_calls.count(self.get_call), 2)
+
+    def test_001_enabled(self):
+        self.app.cache_enabled = True
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertFalse(self.vm.property_is_default('prop1'))
+        self.assertEqual(self.app.actual_calls.count(self.get_call), 1)
+
+    def test_002_ttl(self):
+        self.app.cache_enabled = True
+        self.app.cache_ttl = 5
+        with mock.patch('qubesadmin.base._clock',
+                lambda: 100):
+            self.assertEqual(self.vm.prop1, 'value')
+        with mock.patch('qubesadmin.base._clock',
+                lambda: 104):
+            self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.app.actual_calls.count(self.get_call), 1)
+        with mock.patch('qubesadmin.base._clock',
+                lambda: 106):
+            self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.app.actual_calls.count(self.get_call), 2)
+
+    def test_003_ttl_coherent(self):
+        self.app.cache_enabled = True
+        self.app.cache_ttl = 5
+        self.app._cache_coherent = True
+        with mock.patch('qubesadmin.base._clock',
+                lambda: 100):
+            self.assertEqual(self.vm.prop1, 'value')
+        with mock.patch('qubesadmin.base._clock',
+                lambda: 1000):
+            self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.app.actual_calls.count(self.get_call), 1)
+
+    def test_004_set_invalidate(self):
+        self.app.cache_enabled = True
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Set', 'prop1', b'value2')] = \
+            b'0\x00'
+        self.assertEqual(self.vm.prop1, 'value')
+        self.vm.prop1 = 'value2'
+        self.app.expected_calls[
+            ('test-vm', 'admin.vm.property.Get', 'prop1', None)] = \
+            b'0\x00default=False type=str value2'
+        self.assertEqual(self.vm.prop1, 'value2')
+        self.assertEqual(self.app.actual_calls.count(self.get_call), 2)
+        self.assertAllCalled()
+
+    def test_005_clear_cache(self):
+        self.app.cache_enabled = True
+        self.assertEqual(self.vm.prop1, 'value')
+        self.vm.clear_cache()
+        self.assertEqual(self.vm.prop1, 'value')
+        self.assertEqual(self.app.actual_calls.count(self.get_call), 2)
+
+    def test_010_power_state_from_list(self):
+        self.app.cache_enabled = True
+        self.assertTrue(self.vm.is_running())
+        self.assertEqual(self.vm.get_power_state(), 'Running')
+        self.assertNotIn(('test-vm', 'admin.vm.List', None, None),
+            self.app.actual_calls)
+
+    def test_011_power_state_disabled(self):
+        self.app.expected_calls[('test-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Halted\n'
+        self.assertEqual(self.vm.get_power_state(), 'Halted')
+        self.assertIn(('test-vm', 'admin.vm.List', None, None),
+            self.app.actual_calls)
+
+    def test_012_power_state_ttl(self):
+        self.app.cache_enabled = True
+        self.app.cache_ttl = 5
+        self.app.expected_calls[('test-vm', 'admin.vm.List', None, None)] = \
+            b'0\x00test-vm class=AppVM state=Halted\n'
+        get_call = ('test-vm', 'admin.vm.List', None, None)
+        with mock.patch('qubesadmin.base._clock', lambda: 100):
+            self.app.domains.refresh_cache(force=True)
+        with mock.patch('qubesadmin.base._clock', lambda: 104):
+            self.assertEqual(self.vm.get_power_state(), 'Running')
+        self.assertEqual(self.app.actual_calls.count(get_call), 0)
+        with mock.patch('qubesadmin.base._clock', lambda: 106):
+            self.assertEqual(self.vm.get_power_state(), 'Halted')
+            self.assertEqual(self.vm.get_power_state(), 'Halted')
+        self.assertEqual(self.app.actual_calls.count(get_call), 1)
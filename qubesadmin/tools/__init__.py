@@ -275,20 +275,36 @@ class VMVolumeAction(QubesAction):
         assert hasattr(namespace, 'app')
         app = namespace.app
 
+        values = getattr(namespace, self.dest)
+        if isinstance(values, list):
+            # nargs was given
+            setattr(namespace, self.dest,
+                [self._get_volume(parser, app, value) for value in values])
+        else:
+            setattr(namespace, self.dest,
+                self._get_volume(parser, app, values))
+
+    @staticmethod
+    def _get_volume(parser, app, value):
+        ''' Get the :py:class:``qubes.storage.Volume`` object for a VM:VOLUME
+            string.
+        '''
         try:
-            vm_name, vol_name = getattr(namespace, self.dest).split(':')
+            vm_name, vol_name = value.split(':')
             try:
                 vm = app.domains[vm_name]
                 try:
-                    volume = vm.volumes[vol_name]
-                    setattr(namespace, self.dest, volume)
+                    return vm.volumes[vol_name]
                 except KeyError:
                     parser.error_runtime('vm {!r} has no volume {!r}'.format(
                         vm_name, vol_name))
+                    return None
             except KeyError:
                 parser.error_runtime('no vm {!r}'.format(vm_name))
+                return None
         except ValueError:
             parser.error('expected a vm & volume combination like foo:bar')
+            return None
 
 
 class PoolsAction(QubesAction):
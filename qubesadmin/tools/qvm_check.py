@@ -53,6 +53,9 @@ def main(args=None, app=None):
     '''Main function of qvm-check tool'''
     args = parser.parse_args(args, app=app)
     domains = args.domains
+    if args.running or args.paused:
+        # power state of all the VMs is already known from the VM list
+        args.app.cache_enabled = True
     if args.running:
         running = [vm for vm in domains if vm.is_running()]
         if args.verbose:
@@ -94,37 +94,67 @@ def list_devices(args):
 
     result = {dev: Line(dev) for dev in devices}
 
+    index = app.device_index(args.devclass) if result else {}
     for dev in result:
-        for domain in app.domains:
-            if domain == dev.backend_domain:
+        for assignment in index.get(
+                (dev.backend_domain.name, dev.ident), []):
+            if assignment.frontend_domain == dev.backend_domain:
                 continue
+            result[dev].frontends.append(str(assignment.frontend_domain))
 
-            if dev in domain.devices[args.devclass].assignments():
-                result[dev].frontends.append(str(domain))
+    qubesadmin.tools.print_table(prepare_table(result.values()))
 
 
-    qubesadmin.tools.print_table(prepare_table(result.values()))
+def _devices_batch(args, operation):
+    '''Attach or detach all devices given on command line, using *operation*
+    (:py:meth:`qubesadmin.app.QubesBase.attach_devices` or
+    :py:meth:`qubesadmin.app.QubesBase.detach_devices`)
+    '''
+    vm = args.domains[0]
+    assignments = args.device_assignments
+    for device_assignment in assignments:
+        device_assignment.frontend_domain = vm
+        device_assignment.devclass = args.devclass
+    results = operation(assignments, rollback=args.rollback)
+    failed = [(assignment, result)
+        for assignment, result in zip(assignments, results)
+        if result is not None]
+    if len(assignments) == 1 and failed:
+        raise failed[0][1]
+    for assignment, result in failed:
+        print('{!s}:{!s}: {!s}'.format(assignment.backend_domain,
+            assignment.ident, result), file=sys.stderr)
+    if failed:
+        raise qubesadmin.exc.QubesException(
+            '{} of {} devices failed'.format(len(failed), len(assignments)))
 
 
 def attach_device(args):
     ''' Called by the parser to execute the :program:`qvm-devices attach`
         subcommand.
     '''
-    device_assignment = args.device_assignment
-    vm = args.domains[0]
     options = dict(opt.split('=', 1) for opt in args.option or [])
-    device_assignment.persistent = args.persistent
-    device_assignment.options = options
-    vm.devices[args.devclass].attach(device_assignment)
+    for device_assignment in args.device_assignments:
+        device_assignment.persistent = args.persistent
+        device_assignment.options = options.copy()
+    _devices_batch(args, args.app.attach_devices)
 
 
 def detach_device(args):
     ''' Called by the parser to execute the :program:`qvm-devices detach`
         subcommand.
     '''
-    device_assignment = args.device_assignment
-    vm = args.domains[0]
-    vm.devices[args.devclass].detach(device_assignment)
+    if args.rollback:
+        # use actual assignments, to attach devices back with the same options
+        vm = args.domains[0]
+        current = {(str(assignment.backend_domain), assignment.ident):
+            assignment
+            for assignment in vm.devices[args.devclass].assignments()}
+        args.device_assignments = [
+            current.get((str(assignment.backend_domain), assignment.ident),
+                assignment)
+            for assignment in args.device_assignments]
+    _devices_batch(args, args.app.detach_devices)
 
 
 def init_list_parser(sub_parsers):
@@ -158,8 +188,21 @@ class DeviceAction(qubesadmin.tools.QubesAction):
         setattr(namespace, self.dest, values)
 
     def parse_qubes_app(self, parser, namespace):
+        values = getattr(namespace, self.dest)
+        if isinstance(values, list):
+            # nargs was given
+            setattr(namespace, self.dest,
+                [self._get_assignment(parser, namespace, value)
+                    for value in values])
+        else:
+            setattr(namespace, self.dest,
+                self._get_assignment(parser, namespace, values))
+
+    def _get_assignment(self, parser, namespace, backend_device_id):
+        ''' Get :py:class:``qubesadmin.device.DeviceAssignment`` object for
+            a BACKEND:DEVICE_ID string.
+        '''
         app = namespace.app
-        backend_device_id = getattr(namespace, self.dest)
         devclass = namespace.devclass
 
         try:
@@ -168,6 +211,7 @@ class DeviceAction(qubesadmin.tools.QubesAction):
                 vm = app.domains[vmname]
             except KeyError:
                 parser.error_runtime("no backend vm {!r}".format(vmname))
+                return None
 
             try:
                 dev = vm.devices[devclass][device_id]
@@ -178,12 +222,12 @@ class DeviceAction(qubesadmin.tools.QubesAction):
                 parser.error_runtime(
                     "backend vm {!r} doesn't expose device {!r}"
                     .format(vmname, device_id))
-            device_assignment = qubesadmin.devices.DeviceAssignment(vm,
-                device_id)
-            setattr(namespace, self.dest, device_assignment)
+                return None
+            return qubesadmin.devices.DeviceAssignment(vm, device_id)
         except ValueError:
             parser.error('expected a backend vm & device id combination ' \
                          'like foo:bar got %s' % backend_device_id)
+            return None
 
 
 def get_parser(device_class=None):
@@ -217,12 +261,21 @@ def get_parser(device_class=None):
         action=qubesadmin.tools.VmNameAction)
 
     attach_parser.add_argument(metavar='BACKEND:DEVICE_ID',
-        dest='device_assignment',
+        dest='device_assignments', nargs='+',
         action=DeviceAction)
     detach_parser.add_argument(metavar='BACKEND:DEVICE_ID',
-        dest='device_assignment',
+        dest='device_assignments', nargs='+',
         action=DeviceAction, allow_unknown=True)
 
+    attach_parser.add_argument('--rollback', action='store_true',
+        default=False,
+        help="If attaching any of the devices fails, detach the ones "
+             "already attached")
+    detach_parser.add_argument('--rollback', action='store_true',
+        default=False,
+        help="If detaching any of the devices fails, attach again the ones "
+             "already detached")
+
     attach_parser.add_argument('--option', '-o', action='append',
         help="Set option for the device in opt=value form (can be specified "
              "multiple times)")
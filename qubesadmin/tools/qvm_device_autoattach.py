@@ -0,0 +1,356 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Marek Marczykowski-Górecki
+#                               <marmarek@invisiblethingslab.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+''' Automatically attach devices to qubes, according to a policy'''
+
+import fnmatch
+import heapq
+import re
+import shlex
+import signal
+
+import asyncio
+
+import qubesadmin
+import qubesadmin.devices
+import qubesadmin.exc
+import qubesadmin.tools
+import qubesadmin.vm
+have_events = False
+try:
+    # pylint: disable=wrong-import-position
+    import qubesadmin.events
+    have_events = True
+except ImportError:
+    pass
+
+
+def _compile_pattern(pattern):
+    '''Compile glob pattern to a match function, None if it matches
+    anything'''
+    if pattern == '*':
+        return None
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+def _is_literal(pattern):
+    '''Check if pattern matches only a single string'''
+    return not any(char in pattern for char in '*?[')
+
+
+class AutoAttachRule(object):
+    '''Single line of the auto-attach policy
+
+    :param int number: rule number (line number in the policy file), rules
+    with lower numbers take precedence
+    :param str backend: backend domain name pattern
+    :param str ident: device identifier pattern
+    :param str description: device description pattern
+    :param str target: name of the qube to attach device to
+    :param dict options: device options to attach with
+    '''
+    # pylint: disable=too-few-public-methods,too-many-arguments
+
+    def __init__(self, number, backend, ident, description, target,
+            options=None):
+        self.number = number
+        self.backend = backend
+        self.ident = ident
+        self.description = description
+        self.target = target
+        self.options = options or {}
+        self._match_backend = _compile_pattern(backend)
+        self._match_ident = _compile_pattern(ident)
+        self._match_description = _compile_pattern(description)
+
+    def matches(self, device):
+        '''Check if the rule matches given
+        :py:class:`qubesadmin.devices.DeviceInfo`'''
+        if self._match_backend and \
+                not self._match_backend(str(device.backend_domain)):
+            return False
+        if self._match_ident and not self._match_ident(device.ident):
+            return False
+        if self._match_description and \
+                not self._match_description(device.description or ''):
+            return False
+        return True
+
+    def __repr__(self):
+        return '<{} #{} {} {} {!r} {}>'.format(self.__class__.__name__,
+            self.number, self.backend, self.ident, self.description,
+            self.target)
+
+
+class AutoAttachPolicy(object):
+    '''Auto-attach policy - list of rules, first matching one wins.
+
+    Rules are indexed by backend domain name and device identifier, so only
+    rules which may match a device (those with exact backend and/or ident
+    equal to the device's, or with a pattern there) are checked. This keeps
+    lookup time flat as the number of rules grows.
+
+    :param list rules: list of :py:class:`AutoAttachRule`
+    '''
+
+    def __init__(self, rules):
+        self.rules = sorted(rules, key=lambda rule: rule.number)
+        #: (backend or None, ident or None) -> list of (number, rule),
+        #: None used for patterns
+        self._index = {}
+        for rule in self.rules:
+            key = (rule.backend if _is_literal(rule.backend) else None,
+                rule.ident if _is_literal(rule.ident) else None)
+            self._index.setdefault(key, []).append((rule.number, rule))
+
+    @classmethod
+    def parse(cls, lines):
+        '''Parse policy from lines of text.
+
+        Each line has format::
+
+            BACKEND IDENT DESCRIPTION TARGET [OPTION=VALUE ...]
+
+        The first three fields are glob patterns (`*` matches anything),
+        quoted like in shell if they contain spaces. Empty lines and lines
+        starting with `#` are ignored.
+
+        :param lines: iterable of lines
+        :raises ValueError: on invalid line
+        '''
+        rules = []
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                fields = shlex.split(line)
+            except ValueError as e:
+                raise ValueError('line {}: {!s}'.format(number, e))
+            if len(fields) < 4:
+                raise ValueError('line {}: expected at least 4 fields, got {}'
+                    .format(number, len(fields)))
+            backend, ident, description, target = fields[:4]
+            options = {}
+            for option in fields[4:]:
+                if '=' not in option:
+                    raise ValueError(
+                        'line {}: invalid option {!r}, expected NAME=VALUE'
+                        .format(number, option))
+                name, value = option.split('=', 1)
+                options[name] = value
+            rules.append(AutoAttachRule(number, backend, ident, description,
+                target, options))
+        return cls(rules)
+
+    @classmethod
+    def from_file(cls, path):
+        '''Load policy from a file'''
+        with open(path, encoding='utf-8') as policy_file:
+            return cls.parse(policy_file)
+
+    def match(self, device):
+        '''Find the first rule matching the device.
+
+        :param qubesadmin.devices.DeviceInfo device: device to match
+        :return: :py:class:`AutoAttachRule` or None
+        '''
+        backend = str(device.backend_domain)
+        candidates = [self._index[key]
+            for key in ((backend, device.ident), (backend, None),
+                (None, device.ident), (None, None))
+            if key in self._index]
+        for _, rule in heapq.merge(*candidates):
+            if rule.matches(device):
+                return rule
+        return None
+
+
+class AutoAttach(object):
+    '''Attach devices as soon as they appear, according to a policy
+
+    :param app: :py:class:`qubesadmin.app.QubesBase` instance
+    :param str devclass: device class to handle
+    :param AutoAttachPolicy policy: policy to follow
+    '''
+
+    def __init__(self, app, devclass, policy):
+        self.app = app
+        self.devclass = devclass
+        self.policy = policy
+        #: backend domain name -> set of idents of devices already seen
+        self.known = {}
+        #: target domain name -> dict of (backend domain name, ident) ->
+        #: device, waiting for the target to start
+        self.pending = {}
+        self._initialized = False
+
+    def scan(self, backend):
+        '''List devices of *backend* not seen before
+
+        :return: list of :py:class:`qubesadmin.devices.DeviceInfo`
+        '''
+        devices = list(backend.devices[self.devclass].available())
+        known = self.known.get(backend.name, set())
+        self.known[backend.name] = set(device.ident for device in devices)
+        return [device for device in devices if device.ident not in known]
+
+    def attach(self, device):
+        '''Attach the device according to the policy, if any rule matches
+
+        :return: frontend domain, or None if the device wasn't attached
+        '''
+        rule = self.policy.match(device)
+        if rule is None:
+            return None
+        try:
+            target = self.app.domains[rule.target]
+        except KeyError:
+            self.app.log.warning(
+                'Device %s: target qube %s of rule %d does not exist',
+                device, rule.target, rule.number)
+            return None
+        if target == device.backend_domain:
+            return None
+        if not target.is_running():
+            self.app.log.info('Device %s: target qube %s is not running, '
+                'will attach when it starts', device, target)
+            self.pending.setdefault(target.name, {})[
+                (device.backend_domain.name, device.ident)] = device
+            return None
+        assignment = qubesadmin.devices.DeviceAssignment(
+            device.backend_domain, device.ident, options=rule.options.copy(),
+            frontend_domain=target, devclass=self.devclass)
+        try:
+            target.devices[self.devclass].attach(assignment)
+        except qubesadmin.exc.QubesException as e:
+            self.app.log.warning('Failed to attach device %s to %s: %s',
+                device, target, e)
+            return None
+        self.app.log.info('Device %s attached to %s', device, target)
+        return target
+
+    def on_device_list_change(self, vm, _event, **_kwargs):
+        '''Handler of 'device-list-change:<class>' event, attaches new
+        devices'''
+        try:
+            new_devices = self.scan(vm)
+        except qubesadmin.exc.QubesException as e:
+            self.app.log.warning('Failed to list devices of %s: %s', vm, e)
+            return
+        for device in new_devices:
+            self.attach(device)
+
+    def on_domain_start(self, vm, _event, **_kwargs):
+        '''Handler of 'domain-start' event, attaches devices waiting for the
+        domain, if they are still present'''
+        pending = self.pending.pop(vm.name, {})
+        for (backend_name, ident), device in sorted(pending.items()):
+            if ident in self.known.get(backend_name, ()):
+                self.attach(device)
+
+    def on_domain_shutdown(self, vm, _event, **_kwargs):
+        '''Handler of 'domain-shutdown' event, forgets devices of the
+        domain'''
+        self.known.pop(vm.name, None)
+
+    def on_connection_established(self, _subject, _event, **_kwargs):
+        '''Handler of 'connection-established' event.
+
+        Record devices already present at startup (those are not attached),
+        and attach devices which appeared while events connection was
+        broken.
+        '''
+        for vm in self.app.domains:
+            if isinstance(vm, qubesadmin.vm.AdminVM) or not vm.is_running():
+                self.known.pop(vm.name, None)
+                continue
+            if self._initialized:
+                self.on_device_list_change(vm, None)
+                continue
+            try:
+                self.scan(vm)
+            except qubesadmin.exc.QubesException as e:
+                self.app.log.warning('Failed to list devices of %s: %s', vm, e)
+        self._initialized = True
+
+    def register_events(self, events):
+        '''Register handlers in events dispatcher'''
+        events.add_handler('device-list-change:' + self.devclass,
+            self.on_device_list_change)
+        events.add_handler('domain-start', self.on_domain_start)
+        events.add_handler('domain-shutdown', self.on_domain_shutdown)
+        events.add_handler('connection-established',
+            self.on_connection_established)
+
+
+parser = qubesadmin.tools.QubesArgumentParser(
+    description='automatically attach devices to qubes, according to a '
+                'policy')
+parser.add_argument('devclass', metavar='DEVICE_CLASS',
+    help="Device class to handle ('usb', 'block', etc)")
+parser.add_argument('policy', metavar='POLICY_FILE',
+    help='Path to the policy file; reloaded on SIGHUP')
+
+
+def main(args=None, app=None):
+    ''' Main function of qvm-device-autoattach tool'''
+    args = parser.parse_args(args, app=app)
+    if not have_events:
+        parser.error('this tool requires Python >= 3.5')
+    try:
+        policy = AutoAttachPolicy.from_file(args.policy)
+    except (OSError, ValueError) as e:
+        parser.error_runtime('failed to load policy {}: {!s}'.format(
+            args.policy, e))
+    autoattach = AutoAttach(args.app, args.devclass, policy)
+
+    def reload_policy():
+        '''Reload policy file, keep the old one if the new one is invalid'''
+        try:
+            autoattach.policy = AutoAttachPolicy.from_file(args.policy)
+        except (OSError, ValueError) as e:
+            args.app.log.error('Failed to reload policy %s: %s',
+                args.policy, e)
+
+    loop = asyncio.get_event_loop()
+    # pylint: disable=no-member
+    events = qubesadmin.events.EventsDispatcher(args.app, enable_cache=True)
+    # pylint: enable=no-member
+    autoattach.register_events(events)
+    events_listener = asyncio.ensure_future(events.listen_for_events())
+
+    for signame in ('SIGINT', 'SIGTERM'):
+        loop.add_signal_handler(getattr(signal, signame),
+            events_listener.cancel)  # pylint: disable=no-member
+    loop.add_signal_handler(signal.SIGHUP, reload_policy)
+
+    try:
+        loop.run_until_complete(events_listener)
+    except asyncio.CancelledError:
+        pass
+    loop.stop()
+    loop.run_forever()
+    loop.close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
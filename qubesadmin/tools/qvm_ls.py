@@ -29,7 +29,6 @@
 from __future__ import print_function
 
 import argparse
-import collections
 import sys
 import textwrap
 
@@ -101,7 +100,7 @@ class Column(object):
                 ret = vm
                 for attrseg in self._attr.split('.'):
                     ret = getattr(ret, attrseg)
-            elif isinstance(self._attr, collections.Callable):
+            elif callable(self._attr):
                 ret = self._attr(vm)
 
         except (AttributeError, ZeroDivisionError):
@@ -411,6 +410,12 @@ class Table(object):
                 stream.write('|'.join(self.get_row(vm)) + '\n')
 
 
+#: columns showing volume info - all of them are served from a single
+#: volume `Info` call per volume, if caching is enabled
+VOLUME_COLUMNS = ('PRIV-CURR', 'PRIV-MAX', 'PRIV-USED',
+    'ROOT-CURR', 'ROOT-MAX', 'ROOT-USED')
+
+
 #: Available formats. Feel free to plug your own one.
 formats = {
     'simple': ('name', 'status', 'label', 'template', 'netvm'),
@@ -547,6 +552,10 @@ def main(args=None, app=None):
         if col.upper() not in Column.columns:
             PropertyColumn(col)
 
+    if any(col.upper() in VOLUME_COLUMNS for col in columns):
+        # size and usage of a volume from one Info call
+        args.app.cache_enabled = True
+
     table = Table(args.app, columns)
     table.write_table(sys.stdout)
 
@@ -23,12 +23,14 @@
 from __future__ import print_function
 
 import argparse
+import collections
 import sys
 
 import qubesadmin
 import qubesadmin.exc
 import qubesadmin.storage
 import qubesadmin.tools
+import qubesadmin.utils
 
 
 class _Info(qubesadmin.tools.PoolsAction):
@@ -44,6 +46,20 @@ class _Info(qubesadmin.tools.PoolsAction):
         super(_Info, self).__call__(parser, namespace, values, option_string)
 
 
+class _Volumes(qubesadmin.tools.PoolsAction):
+    ''' Action for argument parser that lists pool volumes and exits. '''
+
+    def __init__(self, option_strings,
+                 help='list volumes in the pool and exit', **kwargs):
+        # pylint: disable=redefined-builtin
+        super(_Volumes, self).__init__(option_strings, help=help, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, 'command', 'volumes')
+        super(_Volumes, self).__call__(parser, namespace, values,
+            option_string)
+
+
 def pool_info(pool):
     ''' Prints out pool name and config '''
     data = [("name", pool.name)]
@@ -51,14 +67,96 @@ def pool_info(pool):
     qubesadmin.tools.print_table(data)
 
 
+def fetch_configs(app, pools):
+    ''' Fetch config of given pools concurrently '''
+    # pylint: disable=protected-access
+    pools = [pool for pool in pools if pool._config is None]
+    results = app.qubesd_call_many(
+        ('dom0', 'admin.pool.Info', pool.name) for pool in pools)
+    for pool, result in zip(pools, results):
+        if isinstance(result, Exception):
+            raise result
+        pool._set_config(result)
+
+
 def list_pools(app):
     ''' Prints out all known pools and their drivers '''
     result = [('NAME', 'DRIVER')]
-    for pool in app.pools:
+    pools = list(app.pools)
+    fetch_configs(app, pools)
+    for pool in pools:
         result += [(pool.name, pool.driver)]
     qubesadmin.tools.print_table(result)
 
 
+def _format_size(size):
+    ''' Format size for the usage report '''
+    if size is None:
+        return '-'
+    return qubesadmin.utils.size_to_human(size)
+
+
+def usage_report(app):
+    ''' Prints out usage of all pools, aggregated per pool and per VM '''
+    pools = sorted(app.pools)
+    fetch_configs(app, pools)
+    inventory = app.volume_inventory(unattached=True)
+
+    # pool name -> [volumes count, volumes size, volumes usage]
+    per_pool = collections.defaultdict(lambda: [0, 0, 0])
+    # (VM name, pool name) -> [volumes count, volumes size, volumes usage]
+    per_vm = collections.defaultdict(lambda: [0, 0, 0])
+    seen = set()
+    for entry in inventory:
+        owner = entry.vm.name if entry.vm else '-'
+        per_vm[(owner, entry.pool)][0] += 1
+        per_vm[(owner, entry.pool)][1] += entry.size
+        per_vm[(owner, entry.pool)][2] += entry.usage
+        if (entry.pool, entry.vid) in seen:
+            # the same volume attached to multiple VMs
+            continue
+        seen.add((entry.pool, entry.vid))
+        per_pool[entry.pool][0] += 1
+        per_pool[entry.pool][1] += entry.size
+        per_pool[entry.pool][2] += entry.usage
+
+    result = [('POOL', 'DRIVER', 'SIZE', 'USAGE', 'USED', 'VOLUMES',
+        'VOLUMES_SIZE', 'VOLUMES_USAGE')]
+    for pool in pools:
+        try:
+            size = int(pool.config['size'])
+            usage = int(pool.config['usage'])
+        except (KeyError, ValueError):
+            size = usage = None
+        volumes, volumes_size, volumes_usage = per_pool[pool.name]
+        result += [(pool.name, pool.driver, _format_size(size),
+            _format_size(usage),
+            '{:.0f}%'.format(100.0 * usage / size) if size else '-',
+            str(volumes), _format_size(volumes_size),
+            _format_size(volumes_usage))]
+    qubesadmin.tools.print_table(result)
+    print()
+
+    result = [('VMNAME', 'POOL', 'VOLUMES', 'SIZE', 'USAGE')]
+    for (owner, pool), (volumes, size, usage) in sorted(per_vm.items(),
+            key=lambda item: (-item[1][2], item[0])):
+        result += [(owner, pool, str(volumes), _format_size(size),
+            _format_size(usage))]
+    qubesadmin.tools.print_table(result)
+
+
+def list_volumes(app, pools):
+    ''' Prints out volumes in given pools, with owning VM (if any) '''
+    result = [('POOL:VOLUME', 'VMNAME', 'VOLUME_NAME', 'SIZE', 'USAGE')]
+    for entry in app.volume_inventory(pools=pools, unattached=True):
+        result += [('{}:{}'.format(entry.pool, entry.vid),
+            entry.vm.name if entry.vm else '-',
+            entry.name or '-',
+            qubesadmin.utils.size_to_human(entry.size),
+            qubesadmin.utils.size_to_human(entry.usage))]
+    qubesadmin.tools.print_table(result)
+
+
 class _Remove(argparse.Action):
     ''' Action for argument parser that removes a pool '''
 
@@ -121,6 +219,14 @@ def get_parser():
                        help='list all pools and exit (default action)')
     group.add_argument('-i', '--info', metavar='POOLNAME', dest='pools',
                        action=_Info, default=[])
+    group.add_argument('--volumes', metavar='POOLNAME', dest='volume_pools',
+                       action=_Volumes, default=[])
+    group.add_argument('--usage',
+                       dest='command',
+                       const='usage',
+                       action='store_const',
+                       help='show usage of all pools, per pool and per VM, '
+                            'and exit')
     group.add_argument('-a',
                        '--add',
                        action=_Add,
@@ -171,6 +277,10 @@ def main(args=None, app=None):
     elif args.command == 'info':
         for pool in args.pools:
             pool_info(pool)
+    elif args.command == 'volumes':
+        list_volumes(args.app, args.volume_pools)
+    elif args.command == 'usage':
+        usage_report(args.app)
     return 0
 
 
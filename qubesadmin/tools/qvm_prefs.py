@@ -92,16 +92,16 @@ def process_actions(parser, args, target):
     if args.property is None:
         properties = target.property_list()
         width = max(len(prop) for prop in properties)
+        snapshot = target.properties_snapshot(properties)
 
         for prop in sorted(properties):
-            try:
-                value = getattr(target, prop)
-            except AttributeError:
+            if prop not in snapshot:
                 print('{name:{width}s}  U'.format(
                     name=prop, width=width))
                 continue
 
-            if target.property_is_default(prop):
+            value, _, is_default = snapshot[prop]
+            if is_default:
                 print('{name:{width}s}  D  {value!s}'.format(
                     name=prop, width=width, value=value))
             else:
@@ -20,11 +20,13 @@
 
 ''' qvm-run tool'''
 
-import os
 import signal
 import sys
+import threading
+import time
 
 import asyncio
+import concurrent.futures
 
 import functools
 import subprocess
@@ -78,7 +80,7 @@ parser.add_argument('--no-colour-stderr', '--no-color-stderr',
 
 parser.add_argument('--filter-escape-chars',
     action='store_true', dest='filter_esc',
-    default=os.isatty(sys.stdout.fileno()),
+    default=sys.stdout.isatty(),
     help='filter terminal escape sequences (default if output is terminal)')
 
 parser.add_argument('--no-filter-escape-chars',
@@ -90,6 +92,18 @@ parser.add_argument('--service',
     action='store_true', dest='service',
     help='run a qrexec service (named by COMMAND) instead of shell command')
 
+parser.add_argument('--jobs', '-j', metavar='N',
+    action='store', type=int,
+    help='run the command on up to N qubes in parallel, prefix each output'
+        ' line with the qube name, and print summary of exit codes at the'
+        ' end; stdin is not passed')
+
+parser.add_argument('--timeout', metavar='SECONDS',
+    action='store', type=float,
+    help='with --jobs, terminate the command if it does not finish within'
+        ' given time (counted for each qube separately, including waiting'
+        ' for its GUI session)')
+
 parser.add_argument('cmd', metavar='COMMAND',
     help='command to run')
 
@@ -118,16 +132,137 @@ def stop_loop_if_terminated(proc, loop):
         loop.stop()
 
 
+def run_command_single(args, vm, run_kwargs, timeout=None):
+    '''Start the command in a single qube, after waiting for its GUI session
+    (if needed).
+
+    :param timeout: maximum time to wait for GUI session, in seconds
+    :return: :py:class:`subprocess.Popen` object, with stdin left open
+    :raise subprocess.TimeoutExpired: GUI session not started in time
+    '''
+    if args.gui:
+        wait_session = vm.run_service('qubes.WaitForSession',
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_session.communicate(vm.default_user.encode(),
+                timeout=timeout)
+        except subprocess.TimeoutExpired:
+            wait_session.kill()
+            wait_session.wait()
+            raise
+    if args.service:
+        proc = vm.run_service(args.cmd,
+            user=args.user,
+            localcmd=args.localcmd,
+            filter_esc=args.filter_esc,
+            **run_kwargs)
+    else:
+        proc = vm.run_service('qubes.VMShell',
+            user=args.user,
+            localcmd=args.localcmd,
+            filter_esc=args.filter_esc,
+            **run_kwargs)
+        proc.stdin.write(vm.prepare_input_for_vmshell(args.cmd))
+        proc.stdin.flush()
+    return proc
+
+
+def copy_lines(source, target, prefix, lock):
+    '''Copy lines from *source* to *target* stream, prefixing each of them
+    with *prefix*; *lock* prevents mixing lines from different sources'''
+    for line in iter(source.readline, b''):
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        with lock:
+            target.write(prefix + line)
+            target.flush()
+
+
+def run_fanout(args, verbose):
+    '''Run the command in multiple qubes concurrently (at most *args.jobs* at
+    a time), with output lines prefixed by the qube name. Print exit code
+    of each of them at the end.
+
+    :return: exit code
+    '''
+    lock = threading.Lock()
+    run_kwargs = {'stdout': subprocess.PIPE, 'stderr': subprocess.PIPE}
+
+    def run_in_vm(vm):
+        '''Run the command in a single qube.
+
+        :return: exit code, or a string describing why there is none
+        '''
+        if not args.autostart and not vm.is_running():
+            return 'skipped'
+        if verbose > 0:
+            with lock:
+                print('Running \'{}\' on {}'.format(args.cmd, vm.name),
+                    file=sys.stderr)
+        start_time = time.monotonic()
+        try:
+            proc = run_command_single(args, vm, run_kwargs, args.timeout)
+        except subprocess.TimeoutExpired:
+            return 'timeout'
+        except qubesadmin.exc.QubesException as e:
+            vm.log.error(str(e))
+            return 'error'
+        timeout = args.timeout
+        if timeout is not None:
+            timeout = max(0, timeout - (time.monotonic() - start_time))
+        proc.stdin.close()
+        prefix = '{}: '.format(vm.name).encode()
+        copiers = [
+            threading.Thread(target=copy_lines,
+                args=(proc.stdout, sys.stdout.buffer, prefix, lock)),
+            threading.Thread(target=copy_lines,
+                args=(proc.stderr, sys.stderr.buffer, prefix, lock)),
+        ]
+        for copier in copiers:
+            copier.start()
+        try:
+            returncode = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            returncode = 'timeout'
+        for copier in copiers:
+            copier.join()
+        return returncode
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.jobs) as executor:
+        results = list(executor.map(run_in_vm, args.domains))
+
+    retcode = 0
+    for result in results:
+        if isinstance(result, int):
+            retcode = max(retcode, result)
+        elif result != 'skipped':
+            retcode = max(retcode, 1)
+    sys.stdout.flush()
+    qubesadmin.tools.print_table([('VM', 'EXIT CODE')] +
+        [(vm.name, str(result)) for vm, result in zip(args.domains, results)])
+    return retcode
+
+
 def main(args=None, app=None):
     '''Main function of qvm-run tool'''
     args = parser.parse_args(args, app=app)
     if args.color_output is None and args.filter_esc:
         args.color_output = '31'
 
-    if args.color_output is None and os.isatty(sys.stderr.fileno()):
+    if args.color_output is None and sys.stderr.isatty():
         args.color_stderr = 31
 
-    if len(args.domains) > 1 and args.passio and not args.localcmd:
+    if args.jobs is not None:
+        if args.jobs < 1:
+            parser.error('--jobs must be at least 1')
+        if args.localcmd:
+            parser.error('--localcmd cannot be used with --jobs')
+    elif args.timeout is not None:
+        parser.error('--timeout have no effect without --jobs')
+    elif len(args.domains) > 1 and args.passio and not args.localcmd:
         parser.error('--passio cannot be used when more than 1 qube is chosen '
                      'and no --localcmd is used')
     if args.localcmd and not args.passio:
@@ -154,6 +289,9 @@ def main(args=None, app=None):
     verbose = args.verbose - args.quiet
     if args.passio:
         verbose -= 1
+    if args.jobs is not None:
+        # output is passed anyway
+        verbose = args.verbose - args.quiet - 1
 
     if args.color_output:
         sys.stdout.write('\033[0;{}m'.format(args.color_output))
@@ -162,6 +300,8 @@ def main(args=None, app=None):
         sys.stderr.write('\033[0;{}m'.format(args.color_stderr))
         sys.stderr.flush()
     try:
+        if args.jobs is not None:
+            return run_fanout(args, verbose)
         procs = []
         for vm in args.domains:
             if not args.autostart and not vm.is_running():
@@ -175,24 +315,7 @@ def main(args=None, app=None):
                     else:
                         print('Running \'{}\' on {}'.format(args.cmd, vm.name),
                             file=sys.stderr)
-                if args.gui:
-                    wait_session = vm.run_service('qubes.WaitForSession',
-                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                    wait_session.communicate(vm.default_user.encode())
-                if args.service:
-                    proc = vm.run_service(args.cmd,
-                        user=args.user,
-                        localcmd=args.localcmd,
-                        filter_esc=args.filter_esc,
-                        **run_kwargs)
-                else:
-                    proc = vm.run_service('qubes.VMShell',
-                        user=args.user,
-                        localcmd=args.localcmd,
-                        filter_esc=args.filter_esc,
-                        **run_kwargs)
-                    proc.stdin.write(vm.prepare_input_for_vmshell(args.cmd))
-                    proc.stdin.flush()
+                proc = run_command_single(args, vm, run_kwargs)
                 if args.passio and not args.localcmd:
                     loop = asyncio.new_event_loop()
                     loop.add_signal_handler(signal.SIGCHLD,
@@ -24,11 +24,23 @@
 
 from __future__ import print_function
 
+import asyncio
 import sys
-import time
 
 import qubesadmin.tools
 import qubesadmin.exc
+import qubesadmin.utils
+
+have_events = False
+try:
+    # pylint: disable=wrong-import-position
+    import qubesadmin.events
+    have_events = True
+except ImportError:
+    pass
+
+#: VM properties pointing at VMs that need to be shut down later
+DEPENDENCY_PROPERTIES = ('netvm', 'default_dispvm')
 
 parser = qubesadmin.tools.QubesArgumentParser(
     description=__doc__, vmname_nargs='+')
@@ -48,10 +60,151 @@ parser.add_argument('--timeout',
     help='timeout after which domains are killed when using --wait'
         ' (default: %d)')
 
+parser.add_argument('--jobs', '-j',
+    action='store', type=int, metavar='N',
+    help='shut down VMs in dependency order (a VM before its netvm and'
+        ' default_dispvm), at most N at a time; implies --wait, with'
+        ' --timeout applied to each VM separately')
+
+
+def shutdown_ordered(args):
+    '''Shut down VMs in dependency order, at most *args.jobs* at a time.
+
+    A VM is shut down as soon as all the (selected) VMs depending on it are
+    halted. Dependency cycles are broken the same way as in
+    :py:func:`qubesadmin.utils.dependency_layers`. Each VM not halted within
+    *args.timeout* seconds is killed.
+
+    :return: list of VMs which failed to shut down
+    '''
+    dependencies = qubesadmin.utils.vm_dependencies(args.domains,
+        DEPENDENCY_PROPERTIES)
+    if not have_events:
+        return shutdown_layers(args, dependencies)
+
+    loop = asyncio.get_event_loop()
+    connected = asyncio.Future(loop=loop)
+    halted = dict((vm, asyncio.Future(loop=loop)) for vm in dependencies)
+    # VMs which need to be halted before given VM can be shut down; only
+    # follow dependencies between layers, to not wait forever on a cycle
+    layer_index = {}
+    for index, layer in enumerate(
+            qubesadmin.utils.dependency_layers(dependencies)):
+        for vm in layer:
+            layer_index[vm] = index
+    dependents = dict((vm, []) for vm in dependencies)
+    for vm, vm_deps in dependencies.items():
+        for dep in vm_deps:
+            if layer_index[dep] < layer_index[vm]:
+                dependents[dep].append(halted[vm])
+    semaphore = asyncio.Semaphore(args.jobs)
+    failed = []
+
+    def mark_halted(vm):
+        '''Record that VM is halted'''
+        if not halted[vm].done():
+            halted[vm].set_result(True)
+
+    def handle_event(subject, event, **kwargs):
+        '''Handle connection-established and domain-shutdown events'''
+        # pylint: disable=unused-argument
+        if event == 'connection-established':
+            if not connected.done():
+                connected.set_result(True)
+        elif subject in halted:
+            mark_halted(subject)
+
+    @asyncio.coroutine
+    def shutdown_vm(vm):
+        '''Shut down a single VM, after VMs depending on it'''
+        if dependents[vm]:
+            yield from asyncio.wait(dependents[vm])
+        with (yield from semaphore):
+            try:
+                yield from loop.run_in_executor(None, vm.shutdown, args.force)
+            except qubesadmin.exc.QubesVMNotStartedError:
+                mark_halted(vm)
+                return
+            except qubesadmin.exc.QubesException as e:
+                args.app.log.error('Failed to shut down {}: {!s}'.format(
+                    vm, e))
+                failed.append(vm)
+                # let the others try anyway
+                mark_halted(vm)
+                return
+            try:
+                yield from asyncio.wait_for(asyncio.shield(halted[vm]),
+                    args.timeout)
+            except asyncio.TimeoutError:
+                args.app.log.info('Killing {}'.format(vm))
+                try:
+                    yield from loop.run_in_executor(None, vm.kill)
+                except qubesadmin.exc.QubesVMNotStartedError:
+                    pass
+                mark_halted(vm)
+
+    dispatcher = qubesadmin.events.EventsDispatcher(args.app)
+    dispatcher.add_handler('connection-established', handle_event)
+    dispatcher.add_handler('domain-shutdown', handle_event)
+    events_task = asyncio.ensure_future(dispatcher.listen_for_events(),
+        loop=loop)
+    events_failed = False
+    try:
+        # do not miss any domain-shutdown event
+        loop.run_until_complete(asyncio.wait_for(connected, args.timeout))
+        loop.run_until_complete(asyncio.gather(
+            *[shutdown_vm(vm) for vm in sorted(dependencies)]))
+    except asyncio.TimeoutError:
+        # listen_for_events keeps reconnecting, don't wait for it forever
+        args.app.log.warning('Failed to connect to qubesd for events, '
+            'shutting down VMs one dependency layer at a time')
+        events_failed = True
+    finally:
+        events_task.cancel()
+        try:
+            loop.run_until_complete(events_task)
+        except asyncio.CancelledError:
+            pass
+    if events_failed:
+        return shutdown_layers(args, dependencies)
+    return sorted(failed)
+
+
+def shutdown_layers(args, dependencies):
+    '''Shut down VMs in dependency order, without events: each layer of
+    dependency graph in groups of at most *args.jobs* VMs.
+
+    :return: list of VMs which failed to shut down
+    '''
+    failed = []
+    for layer in reversed(qubesadmin.utils.dependency_layers(dependencies)):
+        for i in range(0, len(layer), args.jobs):
+            group = layer[i:i + args.jobs]
+            for vm in list(group):
+                try:
+                    vm.shutdown(force=args.force)
+                except qubesadmin.exc.QubesVMNotStartedError:
+                    pass
+                except qubesadmin.exc.QubesException as e:
+                    args.app.log.error('Failed to shut down {}: {!s}'.format(
+                        vm, e))
+                    failed.append(vm)
+                    group.remove(vm)
+            for vm in args.app.wait_for_states(
+                    dict((vm, 'Halted') for vm in group), args.timeout):
+                args.app.log.info('Killing {}'.format(vm))
+                vm.kill()
+    return sorted(failed)
+
 
 def main(args=None, app=None):  # pylint: disable=missing-docstring
     args = parser.parse_args(args, app=app)
 
+    if args.jobs is not None:
+        if args.jobs < 1:
+            parser.error('--jobs must be at least 1')
+        return 1 if shutdown_ordered(args) else 0
+
     for vm in args.domains:
         try:
             vm.shutdown(force=args.force)
@@ -61,22 +214,17 @@ def main(args=None, app=None):  # pylint: disable=missing-docstring
     if not args.wait:
         return
 
-    timeout = args.timeout
-    current_vms = list(sorted(args.domains))
-    while timeout >= 0:
-        current_vms = [vm for vm in current_vms
-            if vm.get_power_state() != 'Halted']
-        if not current_vms:
-            return 0
-        args.app.log.info('Waiting for shutdown ({}): {}'.format(
-            timeout, ', '.join([str(vm) for vm in current_vms])))
-        time.sleep(1)
-        timeout -= 1
+    args.app.log.info('Waiting for shutdown ({}): {}'.format(
+        args.timeout, ', '.join([str(vm) for vm in sorted(args.domains)])))
+    remaining_vms = args.app.wait_for_states(
+        dict((vm, 'Halted') for vm in args.domains), args.timeout)
+    if not remaining_vms:
+        return 0
 
     args.app.log.info(
         'Killing remaining qubes: {}'
-        .format(', '.join([str(vm) for vm in current_vms])))
-    for vm in current_vms:
+        .format(', '.join([str(vm) for vm in remaining_vms])))
+    for vm in remaining_vms:
         vm.kill()
 
 
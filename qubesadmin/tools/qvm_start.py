@@ -21,9 +21,13 @@
 '''qvm-start - start a domain'''
 
 
+import concurrent.futures
 import sys
+import time
+
 import qubesadmin.exc
 import qubesadmin.tools
+import qubesadmin.utils
 
 parser = qubesadmin.tools.QubesArgumentParser(
     description='start a domain', vmname_nargs='+')
@@ -32,6 +36,63 @@ parser.add_argument('--skip-if-running',
     action='store_true', default=False,
     help='Do not fail if the qube is already runnning')
 
+parser.add_argument('--jobs', '-j',
+    action='store', type=int, metavar='N',
+    help='start up to N qubes in parallel, each one after its netvm;'
+        ' report start time of each qube')
+
+
+def start_domain(args, domain):
+    '''Start a single domain, report errors.
+
+    :return: True on success (or when skipped), False otherwise
+    '''
+    if args.skip_if_running and domain.is_running():
+        return True
+    start_time = time.time()
+    try:
+        domain.start()
+    except (IOError, OSError, qubesadmin.exc.QubesException) as e:
+        parser.print_error('{}: {!s}'.format(domain.name, e))
+        return False
+    print('{}: started in {:.1f}s'.format(
+        domain.name, time.time() - start_time))
+    return True
+
+
+def start_parallel(args):
+    '''Start domains in parallel (at most *args.jobs* at a time), following
+    netvm dependencies: each domain is started after its netvm (if
+    selected too), independent branches are started concurrently.
+
+    :return: exit code
+    '''
+    remaining = qubesadmin.utils.vm_dependencies(args.domains, ('netvm',))
+    exit_code = 0
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.jobs) as executor:
+        in_progress = {}
+        while remaining or in_progress:
+            ready = sorted(domain for domain, deps in remaining.items()
+                if not deps)
+            if not ready and not in_progress:
+                # dependency loop, shouldn't happen; ignore dependencies
+                ready = sorted(remaining)
+            for domain in ready:
+                del remaining[domain]
+                in_progress[executor.submit(start_domain, args, domain)] = \
+                    domain
+            done, _ = concurrent.futures.wait(in_progress,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                domain = in_progress.pop(future)
+                if not future.result():
+                    exit_code = 1
+                for deps in remaining.values():
+                    deps.discard(domain)
+    return exit_code
+
+
 def main(args=None, app=None):
     '''Main routine of :program:`qvm-start`.
 
@@ -41,6 +102,11 @@ def main(args=None, app=None):
 
     args = parser.parse_args(args, app=app)
 
+    if args.jobs is not None:
+        if args.jobs < 1:
+            parser.error('--jobs must be at least 1')
+        return start_parallel(args)
+
     exit_code = 0
     for domain in args.domains:
         if args.skip_if_running and domain.is_running():
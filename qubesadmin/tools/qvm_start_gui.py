@@ -348,7 +348,8 @@ def main(args=None):
         with daemon.pidfile.TimeoutPIDLockFile(args.pidfile):
             loop = asyncio.get_event_loop()
             # pylint: disable=no-member
-            events = qubesadmin.events.EventsDispatcher(args.app)
+            events = qubesadmin.events.EventsDispatcher(args.app,
+                enable_cache=True)
             # pylint: enable=no-member
             launcher.register_events(events)
 
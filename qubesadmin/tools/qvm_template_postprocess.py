@@ -20,28 +20,40 @@
 
 ''' Tool for importing rpm-installed template'''
 
+import argparse
 import asyncio
+import contextlib
 import glob
+import hashlib
 import os
 
 import shutil
 import subprocess
+import tarfile
+import time
 
 import sys
 
 import grp
 
-import time
-
 import qubesadmin
+import qubesadmin.app
+import qubesadmin.config
 import qubesadmin.exc
+import qubesadmin.storage
 import qubesadmin.tools
-try:
-    # pylint: disable=wrong-import-position
-    import qubesadmin.events.utils
-    have_events = True
-except ImportError:
-    have_events = False
+
+def digest_type(value):
+    '''Parse ALGORITHM:HEXDIGEST argument'''
+    try:
+        algorithm, digest = value.split(':', 1)
+        hashlib.new(algorithm)
+        int(digest, 16)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid digest {!r}, expected ALGORITHM:HEXDIGEST'.format(value))
+    return algorithm, digest.lower()
+
 
 parser = qubesadmin.tools.QubesArgumentParser(
     description='Postprocess template package')
@@ -51,6 +63,12 @@ parser.add_argument('--skip-start', action='store_true',
     help='Do not start the VM - do not retrieve menu entries etc.')
 parser.add_argument('--keep-source', action='store_true',
     help='Do not remove imported data')
+parser.add_argument('--progress', action='store_true',
+    help='Show root.img import progress and throughput')
+parser.add_argument('--verify-digest', metavar='ALGORITHM:HEXDIGEST',
+    action='append', type=digest_type, default=[],
+    help='Verify digest of root.img while importing it, for example '
+         'sha256:<hex>; can be given multiple times')
 parser.add_argument('action', choices=['post-install', 'pre-remove'],
     help='Action to perform')
 parser.add_argument('name', action='store',
@@ -65,16 +83,113 @@ def move_if_exists(source, dest_dir):
         shutil.move(source, os.path.join(dest_dir, os.path.basename(source)))
 
 
+class PartsReader(object):
+    '''Read-only file-like object, reading consecutive files as a single
+    stream (like `cat` would do)'''
+
+    def __init__(self, paths):
+        self._paths = list(paths)
+        self._current = None
+
+    def read(self, size=-1):
+        '''Read up to *size* bytes (till the end of all files if negative)'''
+        data = []
+        while size != 0:
+            if self._current is None:
+                if not self._paths:
+                    break
+                # pylint: disable=consider-using-with
+                self._current = open(self._paths.pop(0), 'rb')
+            chunk = self._current.read(size)
+            if not chunk:
+                self._current.close()
+                self._current = None
+                continue
+            data.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(data)
+
+    def close(self):
+        '''Close currently open file and skip the remaining ones'''
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        self._paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@contextlib.contextmanager
+def open_root_img_parts(paths):
+    '''Open root.img tar archive split into root.img.part.* files as a single
+    stream; if the archive is compressed, decompress it on the fly
+
+    :param list paths: paths of archive parts, in order
+    '''
+    with open(paths[0], 'rb') as first_part:
+        compression = qubesadmin.storage.detect_compression(
+            first_part.read(6))
+    with PartsReader(paths) as parts:
+        if compression is None:
+            yield parts
+            return
+        source = qubesadmin.storage.ChunksReader(
+            qubesadmin.storage.decompressed_chunks(
+                qubesadmin.storage.file_chunks(parts), compression))
+        try:
+            yield source
+        finally:
+            source.close()
+
+
+def open_root_img_tar(parts):
+    '''Open root.img tar archive (split into root.img.part.* files) for
+    streaming, read the first member header
+
+    :param parts: archive stream (see :py:func:`open_root_img_parts`)
+    :return: tuple of (opened tarfile.TarFile, its first member)
+    '''
+    try:
+        tar = tarfile.open(fileobj=parts, mode='r|',
+            bufsize=qubesadmin.config.IMPORT_BUF_SIZE)
+        member = tar.next()
+    except tarfile.TarError as e:
+        raise qubesadmin.exc.QubesException(
+            'root.img extraction failed: {!s}'.format(e))
+    if member is None or not member.isfile():
+        raise qubesadmin.exc.QubesException(
+            'root.img extraction failed: no file in the archive')
+    return tar, member
+
+
+def tar_member_chunks(tar, member):
+    '''Read tar archive member in chunks'''
+    source = tar.extractfile(member)
+    while True:
+        try:
+            data = source.read(qubesadmin.config.IMPORT_BUF_SIZE)
+        except tarfile.TarError as e:
+            raise qubesadmin.exc.QubesException(
+                'root.img extraction failed: {!s}'.format(e))
+        if not data:
+            break
+        yield data
+
+
 def get_root_img_size(source_dir):
     '''Extract size of root.img to be imported'''
     root_path = os.path.join(source_dir, 'root.img')
     if os.path.exists(root_path + '.part.00'):
         # get just file root_size from the tar header
-        p = subprocess.Popen(['tar', 'tvf', root_path + '.part.00'],
-            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        (stdout, _) = p.communicate()
-        # -rw-r--r-- 0/0      1073741824 1970-01-01 01:00 root.img
-        root_size = int(stdout.split()[2])
+        input_files = sorted(glob.glob(root_path + '.part.*'))
+        with open_root_img_parts(input_files) as parts:
+            _, member = open_root_img_tar(parts)
+        root_size = member.size
     elif os.path.exists(root_path):
         root_size = os.path.getsize(root_path)
     else:
@@ -82,26 +197,51 @@ def get_root_img_size(source_dir):
     return root_size
 
 
-def import_root_img(vm, source_dir):
-    '''Import root.img into VM object'''
+def print_progress(progress):
+    '''Print root.img import progress (see
+    :py:class:`qubesadmin.storage.ImportProgress`) to stderr'''
+    mib = 1024 ** 2
+    line = 'root.img: {:.1f}'.format(progress.transferred / mib)
+    if progress.total_size:
+        line += '/{:.1f} MiB ({:.0f}%)'.format(progress.total_size / mib,
+            100.0 * progress.transferred / progress.total_size)
+    else:
+        line += ' MiB'
+    line += ', {:.1f} MiB/s (avg {:.1f} MiB/s)'.format(
+        progress.current_rate / mib, progress.average_rate / mib)
+    if progress.eta is not None:
+        line += ', ETA {:d}:{:02d}'.format(*divmod(int(progress.eta), 60))
+    elapsed = progress.elapsed
+    if elapsed > 0:
+        line += ', waiting for source {:.0f}%, for target {:.0f}%'.format(
+            min(100.0, 100.0 * progress.read_time / elapsed),
+            min(100.0, 100.0 * progress.write_time / elapsed))
+    sys.stderr.write('\r' + line + ('\n' if progress.finished else ''))
+    sys.stderr.flush()
+
+
+def import_root_img(vm, source_dir, expected_digests=None, progress=None):
+    '''Import root.img into VM object
+
+    :param dict expected_digests: expected digests of root.img (algorithm \
+        name -> hexadecimal digest), verified during import
+    :param progress: import progress callback, see \
+        :py:meth:`qubesadmin.storage.Volume.import_data`
+    '''
 
     root_size = get_root_img_size(source_dir)
     vm.volumes['root'].resize(root_size)
 
     root_path = os.path.join(source_dir, 'root.img')
+    start_time = time.time()
+    digests = {}
     if os.path.exists(root_path + '.part.00'):
-        input_files = glob.glob(root_path + '.part.*')
-        cat = subprocess.Popen(['cat'] + sorted(input_files),
-            stdout=subprocess.PIPE)
-        tar = subprocess.Popen(['tar', 'xSOf', '-'],
-            stdin=cat.stdout,
-            stdout=subprocess.PIPE)
-        cat.stdout.close()
-        vm.volumes['root'].import_data(stream=tar.stdout)
-        if tar.wait() != 0:
-            raise qubesadmin.exc.QubesException('root.img extraction failed')
-        if cat.wait() != 0:
-            raise qubesadmin.exc.QubesException('root.img extraction failed')
+        input_files = sorted(glob.glob(root_path + '.part.*'))
+        with open_root_img_parts(input_files) as parts:
+            tar, member = open_root_img_tar(parts)
+            digests = vm.volumes['root'].import_data(
+                stream=tar_member_chunks(tar, member),
+                expected=expected_digests, progress=progress, size=root_size)
     elif os.path.exists(root_path):
         if vm.app.qubesd_connection_type == 'socket':
             # check if root.img was already overwritten, i.e. if the source
@@ -113,7 +253,16 @@ def import_root_img(vm, source_dir):
                 vm.log.info('root.img already in place, do not re-import')
                 return
         with open(root_path, 'rb') as root_file:
-            vm.volumes['root'].import_data(stream=root_file)
+            digests = vm.volumes['root'].import_data(stream=root_file,
+                sparse=True, expected=expected_digests, progress=progress,
+                size=root_size)
+    elapsed = time.time() - start_time
+    vm.log.info('root.img imported: {:.1f} MiB in {:.1f}s ({:.1f} MiB/s)'
+        .format(root_size / 1024**2, elapsed,
+            root_size / 1024**2 / max(elapsed, 0.001)))
+    for algorithm, digest in sorted(digests.items()):
+        vm.log.info('root.img {} digest verified: {}'.format(
+            algorithm, digest))
 
 
 def import_appmenus(vm, source_dir):
@@ -162,7 +311,9 @@ def post_install(args):
             label=qubesadmin.config.defaults['template_label'])
 
     vm.log.info('Importing data')
-    import_root_img(vm, args.dir)
+    import_root_img(vm, args.dir,
+        expected_digests=dict(args.verify_digest) or None,
+        progress=(print_progress if args.progress else None))
     import_appmenus(vm, args.dir)
 
     if not args.skip_start:
@@ -174,23 +325,12 @@ def post_install(args):
         except qubesadmin.exc.QubesVMError:
             vm.log.error('qubes.PostInstall service failed')
         vm.shutdown()
-        if have_events:
-            try:
-                # pylint: disable=no-member
-                qubesadmin.events.utils.wait_for_domain_shutdown(vm,
-                    qubesadmin.config.defaults['shutdown_timeout'])
-            except qubesadmin.exc.QubesVMShutdownTimeout:
-                vm.kill()
+        if vm.app.wait_for_states({vm: 'Halted'},
+                qubesadmin.config.defaults['shutdown_timeout']):
+            vm.kill()
+        if qubesadmin.app.have_events:
+            # the events connection used by wait_for_states is done
             asyncio.get_event_loop().close()
-        else:
-            timeout = qubesadmin.config.defaults['shutdown_timeout']
-            while timeout >= 0:
-                if vm.is_halted():
-                    break
-                time.sleep(1)
-                timeout -= 1
-            if not vm.is_halted():
-                vm.kill()
 
         vm.netvm = qubesadmin.DEFAULT
 
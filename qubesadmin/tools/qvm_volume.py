@@ -24,10 +24,12 @@
 
 from __future__ import print_function
 
+import argparse
 import sys
 
 import qubesadmin
 import qubesadmin.exc
+import qubesadmin.storage
 import qubesadmin.tools
 import qubesadmin.utils
 
@@ -49,15 +51,15 @@ def prepare_table(vd_list, full=False):
 
     for volume in sorted(vd_list):
         if volume.domains:
-            vmname, volume_name = volume.domains.pop()
-            output += [(str(volume), vmname, volume_name, volume.revisions)]
+            vmname, vol_name = volume.domains.pop()
+            output += [(str(volume), vmname, vol_name, volume.revisions)]
             for tupple in volume.domains:
-                vmname, volume_name = tupple
+                vmname, vol_name = tupple
                 if full or not sys.stdout.isatty():
-                    output += [(str(volume), vmname, volume_name,
+                    output += [(str(volume), vmname, vol_name,
                             volume.revisions)]
                 else:
-                    output += [('', vmname, volume_name, volume.revisions)]
+                    output += [('', vmname, vol_name, volume.revisions)]
         else:
             output += [(str(volume), "")]
 
@@ -69,10 +71,12 @@ class VolumeData(object):
         the domains a volume is attached to.
     '''
     # pylint: disable=too-few-public-methods
-    def __init__(self, volume):
+    def __init__(self, volume, revisions=None):
         self.pool = volume.pool
         self.vid = volume.vid
-        if volume.revisions:
+        if revisions is None:
+            revisions = volume.revisions
+        if revisions:
             self.revisions = 'Yes'
         else:
             self.revisions = 'No'
@@ -92,55 +96,107 @@ def list_volumes(args):
     if hasattr(args, 'domains') and args.domains:
         domains = args.domains
     else:
-        domains = app.domains
-    volumes = [v for vm in domains for v in vm.volumes.values()]
+        domains = None
 
-    if args.pools:
-        # only specified pools
-        volumes = [v for v in volumes if v.pool in args.pools]
+    vd_dict = {}
+    for entry in app.volume_inventory(domains=domains,
+            pools=args.pools or None, internal=args.internal,
+            revisions=True):
+        key = (entry.pool, entry.vid)
+        if key not in vd_dict:
+            vd_dict[key] = VolumeData(entry.volume, entry.revisions)
+        vd_dict[key].domains += [(entry.vm.name, entry.name)]
 
-    if not args.internal:  # hide internal volumes
-        volumes = [v for v in volumes if not v.internal]
+    qubesadmin.tools.print_table(
+        prepare_table(list(vd_dict.values()), full=args.full))
 
-    vd_dict = {}
-    for volume in volumes:
-        volume_data = VolumeData(volume)
-        try:
-            vd_dict[volume.pool][volume.vid] = volume_data
-        except KeyError:
-            vd_dict[volume.pool] = {volume.vid: volume_data}
-
-    for domain in domains:  # gather the domain names
-        try:
-            for name, volume in domain.volumes.items():
-                try:
-                    volume_data = vd_dict[volume.pool][volume.vid]
-                    volume_data.domains += [(domain.name, name)]
-                except KeyError:
-                    # Skipping volume
-                    continue
-        except AttributeError:
-            # Skipping domain without volumes
-            continue
 
-    if hasattr(args, 'domains') and args.domains:
-        result = [x  # reduce to only VolumeData with assigned domains
-                  for p in vd_dict.values() for x in p.values()
-                  if x.domains]
-    else:
-        result = [x for p in vd_dict.values() for x in p.values()]
-    qubesadmin.tools.print_table(prepare_table(result, full=args.full))
+def parse_age(value):
+    ''' Parse age given as number of seconds, optionally with one of `s`, \
+        `m`, `h`, `d` or `w` suffix.
+    '''
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    multiplier = 1
+    if value and value[-1] in units:
+        multiplier = units[value[-1]]
+        value = value[:-1]
+    if not value.isdigit():
+        raise argparse.ArgumentTypeError(
+            'invalid age: expected a number with optional s, m, h, d or w '
+            'suffix')
+    return int(value) * multiplier
+
+
+def non_negative_int(value):
+    ''' Parse non-negative integer argument '''
+    try:
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a number')
+    if value < 0:
+        raise argparse.ArgumentTypeError('expected a non-negative number')
+    return value
+
+
+def positive_int(value):
+    ''' Parse positive integer argument '''
+    value = non_negative_int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError('expected a positive number')
+    return value
+
+
+def volume_name(volume):
+    ''' Name of the volume, as given on the command line '''
+    # pylint: disable=protected-access
+    return '{!s}:{!s}'.format(volume._vm, volume._vm_name)
 
 
 def revert_volume(args):
-    ''' Revert volume to previous state '''
-    volume = args.volume
+    ''' Revert volumes to previous state '''
     app = args.app
-    try:
-        pool = app.pools[volume.pool]
-        pool.revert(volume)
-    except qubesadmin.exc.StoragePoolException as e:
-        print(str(e), file=sys.stderr)
+    failed = False
+    targets = []
+    revisions = app.volumes_revisions(args.volumes, max_workers=args.jobs)
+    for volume, volume_revisions in zip(args.volumes, revisions):
+        if isinstance(volume_revisions, Exception):
+            print('{}: {!s}'.format(volume_name(volume), volume_revisions),
+                file=sys.stderr)
+            failed = True
+            continue
+        revision = qubesadmin.storage.select_revision(volume_revisions,
+            nth=args.nth, min_age=args.older_than)
+        if revision is None:
+            print('{}: no matching revision to revert to'.format(
+                volume_name(volume)), file=sys.stderr)
+            failed = True
+            continue
+        targets.append((volume, revision))
+
+    results = app.revert_volumes(targets, max_workers=args.jobs)
+    for (volume, revision), result in zip(targets, results):
+        if isinstance(result, Exception):
+            print('{}: {!s}'.format(volume_name(volume), result),
+                file=sys.stderr)
+            failed = True
+        elif args.verbose - args.quiet > 1:
+            print('{}: reverted to {}'.format(volume_name(volume), revision))
+    if failed:
+        sys.exit(1)
+
+
+def prune_revisions(args):
+    ''' Limit number of revisions kept for volumes '''
+    app = args.app
+    failed = False
+    results = app.prune_revisions(args.volumes, args.keep,
+        max_workers=args.jobs)
+    for volume, result in zip(args.volumes, results):
+        if isinstance(result, Exception):
+            print('{}: {!s}'.format(volume_name(volume), result),
+                file=sys.stderr)
+            failed = True
+    if failed:
         sys.exit(1)
 
 
@@ -178,11 +234,43 @@ def init_revert_parser(sub_parsers):
     revert_parser = sub_parsers.add_parser(
         'revert', aliases=('rv', 'r'),
         help='revert volume to previous revision')
-    revert_parser.add_argument(metavar='VM:VOLUME', dest='volume',
-                               action=qubesadmin.tools.VMVolumeAction)
+    revert_parser.add_argument(metavar='VM:VOLUME', dest='volumes',
+                               nargs='+',
+                               action=qubesadmin.tools.VMVolumeAction,
+                               help='volume(s) to revert')
+    revert_parser.add_argument('--nth', type=positive_int, default=1,
+                               help='revert to N-th most recent (matching) '
+                                    'revision, default: 1')
+    revert_parser.add_argument('--older-than', metavar='AGE',
+                               type=parse_age, default=None,
+                               help='consider only revisions at least AGE '
+                                    'old (seconds, or with s, m, h, d, w '
+                                    'suffix)')
+    revert_parser.add_argument('--jobs', '-j', type=positive_int,
+                               default=None,
+                               help='maximum number of volumes processed '
+                                    'in parallel')
     revert_parser.set_defaults(func=revert_volume)
 
 
+def init_prune_parser(sub_parsers):
+    ''' Add 'prune' action related options '''
+    prune_parser = sub_parsers.add_parser(
+        'prune', help='limit number of revisions kept for volumes')
+    prune_parser.add_argument(metavar='VM:VOLUME', dest='volumes',
+                              nargs='+',
+                              action=qubesadmin.tools.VMVolumeAction,
+                              help='volume(s) to prune revisions of')
+    prune_parser.add_argument('--keep', type=non_negative_int,
+                              required=True,
+                              help='number of most recent revisions to keep')
+    prune_parser.add_argument('--jobs', '-j', type=positive_int,
+                              default=None,
+                              help='maximum number of volumes processed '
+                                   'in parallel')
+    prune_parser.set_defaults(func=prune_revisions)
+
+
 def init_extend_parser(sub_parsers):
     ''' Add 'extend' action related options '''
     extend_parser = sub_parsers.add_parser(
@@ -206,6 +294,7 @@ def get_parser():
         dest='command')
     init_extend_parser(sub_parsers)
     init_list_parser(sub_parsers)
+    init_prune_parser(sub_parsers)
     init_revert_parser(sub_parsers)
 
     return parser
@@ -122,3 +122,57 @@ def get_entry_point_one(group, name):
                 ', '.join('{}.{}'.format(ep.module_name, '.'.join(ep.attrs))
                     for ep in epoints)))
     return epoints[0].load()
+
+
+def vm_dependencies(domains, properties=('netvm',)):
+    '''Find dependencies between given VMs.
+
+    VM depends on another VM if that one is set as one of its *properties*
+    (for example ``netvm``). Only dependencies between *domains* themselves
+    are considered.
+
+    :param domains: VMs to consider
+    :param properties: names of VM properties to follow
+    :return: dict of VM -> set of VMs it depends on
+    '''
+    domains = list(domains)
+    by_name = dict((vm.name, vm) for vm in domains)
+    dependencies = {}
+    for vm in domains:
+        dependencies[vm] = set()
+        for prop in properties:
+            try:
+                value = getattr(vm, prop)
+            except AttributeError:
+                # no such property (for example dom0), or no access to it
+                continue
+            if value is None:
+                continue
+            dep = by_name.get(str(value))
+            if dep is not None and dep is not vm:
+                dependencies[vm].add(dep)
+    return dependencies
+
+
+def dependency_layers(dependencies):
+    '''Sort VMs into layers, each VM after all the VMs it depends on.
+
+    VMs in a single layer do not depend on each other. Dependency cycles,
+    if any, are broken by placing all the remaining VMs in the last layer.
+
+    :param dict dependencies: VM -> set of VMs it depends on, as returned \
+        by :py:func:`vm_dependencies`
+    :return: list of layers (sorted lists of VMs)
+    '''
+    remaining = dict((vm, set(deps)) for vm, deps in dependencies.items())
+    layers = []
+    while remaining:
+        layer = sorted(vm for vm, deps in remaining.items() if not deps)
+        if not layer:
+            layer = sorted(remaining)
+        for vm in layer:
+            del remaining[vm]
+        for deps in remaining.values():
+            deps.difference_update(layer)
+        layers.append(layer)
+    return layers
@@ -28,6 +28,18 @@ import qubesadmin.features
 import qubesadmin.devices
 import qubesadmin.firewall
 
+#: VM power state after given lifecycle event; None means the VM is in
+#: transition and the state needs to be retrieved from qubesd
+POWER_STATE_EVENTS = {
+    'domain-spawn': None,
+    'domain-start': 'Running',
+    'domain-start-failed': None,
+    'domain-paused': 'Paused',
+    'domain-unpaused': 'Running',
+    'domain-pre-shutdown': None,
+    'domain-shutdown': 'Halted',
+}
+
 
 class QubesVM(qubesadmin.base.PropertyHolder):
     '''Qubes domain.'''
@@ -40,6 +52,8 @@ class QubesVM(qubesadmin.base.PropertyHolder):
 
     firewall = None
 
+    _volatile_properties = ('xid', 'stubdom_xid')
+
     def __init__(self, app, name):
         super(QubesVM, self).__init__(app, 'admin.vm.property.', name)
         self._volumes = None
@@ -72,6 +86,9 @@ class QubesVM(qubesadmin.base.PropertyHolder):
             return self.name < other.name
         return NotImplemented
 
+    def __hash__(self):
+        return hash(self.name)
+
     def __eq__(self, other):
         if isinstance(other, QubesVM):
             return self.name == other.name
@@ -180,10 +197,14 @@ class QubesVM(qubesadmin.base.PropertyHolder):
 
         '''
 
+        vm_state = self.app.domains.get_cached_power_state(self._method_dest)
+        if vm_state is not None:
+            return vm_state
         vm_list_info = self.qubesd_call(
             self._method_dest, 'admin.vm.List', None, None).decode('ascii')
         #  name class=... state=... other=...
         vm_state = vm_list_info.strip().partition('state=')[2].split(' ')[0]
+        self.app.domains.set_cached_power_state(self._method_dest, vm_state)
         return vm_state
 
 
@@ -228,20 +249,36 @@ class QubesVM(qubesadmin.base.PropertyHolder):
 
         return self.netvm is not None
 
+    def clear_cache(self):
+        '''Clear cached property values, volumes and devices info'''
+        super(QubesVM, self).clear_cache()
+        self.clear_volumes_cache()
+        self.devices.clear_cache()
+
+    def clear_volumes_cache(self):
+        '''Drop cached info about this VM volumes (but not list of them)'''
+        if self._volumes is not None:
+            for volume in self._volumes.values():
+                volume.clear_cache()
+
     @property
     def volumes(self):
         '''VM disk volumes'''
         if self._volumes is None:
             volumes_list = self.qubesd_call(
                 self._method_dest, 'admin.vm.volume.List')
-            self._volumes = {}
-            for volname in volumes_list.decode('ascii').splitlines():
-                if not volname:
-                    continue
-                self._volumes[volname] = qubesadmin.storage.Volume(self.app,
-                    vm=self.name, vm_name=volname)
+            self._set_volumes(volumes_list)
         return self._volumes
 
+    def _set_volumes(self, volumes_list):
+        '''Create volume objects from raw `admin.vm.volume.List` response'''
+        self._volumes = {}
+        for volname in volumes_list.decode('ascii').splitlines():
+            if not volname:
+                continue
+            self._volumes[volname] = qubesadmin.storage.Volume(self.app,
+                vm=self.name, vm_name=volname)
+
     def run_service(self, service, **kwargs):
         '''Run service on this VM
 
@@ -6,7 +6,7 @@ import sys
 
 exclude=[]
 if sys.version_info[0:2] < (3, 4):
-    exclude += ['qubesadmin.tools', 'qubesadmin.tests.tools']
+    exclude += ['qubesadmin.tools', 'qubesadmin.tests.tools', 'qubesadmin.aio']
 if sys.version_info[0:2] < (3, 5):
     exclude += ['qubesadmin.events']
 